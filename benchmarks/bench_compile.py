@@ -0,0 +1,199 @@
+"""
+Benchmark on the compilation throughput of the optimizer.
+
+Optimize all Python modules of a directory tree (the standard library by
+default) with all optimizations enabled, and compare the time with the time
+of a plain compile(). With --lazy or --background, functions defined at the
+module level are not optimized: only the compilation is measured.
+"""
+
+import argparse
+import ast
+import fatoptimizer
+import json
+import os.path
+import sys
+import sysconfig
+import time
+import tokenize
+import warnings
+from fatoptimizer.benchmark import format_dt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?',
+                        default=sysconfig.get_paths()['stdlib'],
+                        help='directory of Python modules '
+                             '(default: the standard library)')
+    parser.add_argument('-n', '--loops', type=int, default=1,
+                        help='number of runs per module, '
+                             'the minimum time is kept (default: 1)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='maximum number of modules')
+    parser.add_argument('--lazy', metavar='NCALLS', type=int,
+                        help='optimize functions lazily at their NCALLS-th '
+                             'call (lazy_specialization option)')
+    parser.add_argument('--background', metavar='NTHREAD', type=int,
+                        help='optimize functions in NTHREAD background '
+                             'threads (background_specialization option)')
+    parser.add_argument('--json', metavar='FILENAME',
+                        help='write results to a JSON file')
+    return parser.parse_args()
+
+
+def find_modules(directory, limit=None):
+    filenames = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith('.py'):
+                continue
+            filenames.append(os.path.join(root, name))
+            if limit is not None and len(filenames) >= limit:
+                return filenames
+    return filenames
+
+
+def parse_module(filename):
+    with tokenize.open(filename) as fp:
+        source = fp.read()
+    with warnings.catch_warnings():
+        # ignore DeprecationWarning on invalid escape sequences
+        warnings.simplefilter('ignore')
+        tree = ast.parse(source, filename)
+    return source, tree
+
+
+def bench_min(loops, func, *args):
+    best = None
+    for loop in range(loops):
+        start = time.perf_counter()
+        result = func(*args)
+        dt = time.perf_counter() - start
+        if best is None or dt < best:
+            best = dt
+    return best, result
+
+
+def compile_tree(tree, filename):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return compile(tree, filename, 'exec')
+
+
+def fix_locations(tree):
+    # Nodes created by the optimizer don't have the end positions required
+    # by recent Python versions
+    ast.fix_missing_locations(tree)
+    for node in ast.walk(tree):
+        if 'end_lineno' in node._attributes:
+            node.end_lineno = None
+            node.end_col_offset = None
+
+
+def bench_module(config, filename, loops):
+    source, tree = parse_module(filename)
+    nlines = source.count('\n') + 1
+    nnodes = sum(1 for node in ast.walk(tree))
+
+    optimize_dt, new_tree = bench_min(loops, fatoptimizer.optimize,
+                                      tree, filename, config)
+    compile_dt = bench_min(loops, compile_tree, tree, filename)[0]
+    fix_locations(new_tree)
+    compile_opt_dt = bench_min(loops, compile_tree, new_tree, filename)[0]
+
+    return {'lines': nlines,
+            'nodes': nnodes,
+            'optimize': optimize_dt,
+            'compile': compile_dt,
+            'compile_optimized': compile_opt_dt}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = round((len(values) - 1) * percent / 100)
+    return values[index]
+
+
+def main():
+    args = parse_args()
+
+    config = fatoptimizer.Config()
+    config.enable_all()
+    config.lazy_specialization = args.lazy
+    config.background_specialization = args.background
+
+    filenames = find_modules(args.directory, args.limit)
+    modules = {}
+    failures = {}
+    for filename in filenames:
+        name = os.path.relpath(filename, args.directory)
+        try:
+            modules[name] = bench_module(config, filename, args.loops)
+        except (SyntaxError, UnicodeDecodeError) as exc:
+            # not a valid Python 3 module
+            failures[name] = 'parse error: %s' % exc
+        except Exception as exc:
+            failures[name] = '%s: %s' % (type(exc).__name__, exc)
+            print("ERROR: %s: %s" % (name, failures[name]), file=sys.stderr)
+
+    if not modules:
+        print("ERROR: no module found in %s" % args.directory)
+        sys.exit(1)
+
+    results = list(modules.values())
+    lines = sum(result['lines'] for result in results)
+    nodes = sum(result['nodes'] for result in results)
+    optimize_dt = sum(result['optimize'] for result in results)
+    compile_dt = sum(result['compile'] for result in results)
+    compile_opt_dt = sum(result['compile_optimized'] for result in results)
+    latencies = [result['optimize'] for result in results]
+    ratio = (optimize_dt + compile_opt_dt) / compile_dt
+
+    summary = {
+        'modules': len(modules),
+        'failures': len(failures),
+        'lines': lines,
+        'nodes': nodes,
+        'optimize': optimize_dt,
+        'lines_per_sec': lines / optimize_dt,
+        'nodes_per_sec': nodes / optimize_dt,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'compile': compile_dt,
+        'compile_optimized': compile_opt_dt,
+        'compile_ratio': ratio,
+    }
+
+    print("Directory: %s" % args.directory)
+    print("Modules: %s (%s failures)" % (len(modules), len(failures)))
+    print("Lines: %s, AST nodes: %s" % (lines, nodes))
+    print()
+    print("optimize(): %s" % format_dt(optimize_dt))
+    print("Throughput: %.0f lines/s, %.0f nodes/s"
+          % (summary['lines_per_sec'], summary['nodes_per_sec']))
+    print("Latency per module: p50=%s, p99=%s"
+          % (format_dt(summary['latency_p50']),
+             format_dt(summary['latency_p99'])))
+    print()
+    print("Plain compile(): %s" % format_dt(compile_dt))
+    print("optimize() + compile(): %s (%.1fx plain compile)"
+          % (format_dt(optimize_dt + compile_opt_dt), ratio))
+
+    if args.json:
+        data = {'fatoptimizer': fatoptimizer.__version__,
+                'python': sys.version,
+                'directory': args.directory,
+                'loops': args.loops,
+                'summary': summary,
+                'modules': modules,
+                'failures': failures}
+        with open(args.json, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        print()
+        print("Results written into %s" % args.json)
+
+
+if __name__ == "__main__":
+    main()
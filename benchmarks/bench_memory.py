@@ -0,0 +1,141 @@
+"""
+Benchmark on the peak memory usage of the optimizer.
+
+Optimize and compile all Python modules of a directory tree (the standard
+library by default) with all optimizations enabled, and measure the peak of
+memory allocated by the optimizer and compile() using tracemalloc. The peak
+is compared with the peak of a plain compile() of the same tree.
+"""
+
+import argparse
+import fatoptimizer
+import gc
+import json
+import os.path
+import sys
+import sysconfig
+import tracemalloc
+from bench_compile import find_modules, parse_module, compile_tree, fix_locations
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?',
+                        default=sysconfig.get_paths()['stdlib'],
+                        help='directory of Python modules '
+                             '(default: the standard library)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='maximum number of modules')
+    parser.add_argument('--top', type=int, default=5,
+                        help='number of modules with the largest peak '
+                             'to display (default: 5)')
+    parser.add_argument('--json', metavar='FILENAME',
+                        help='write results to a JSON file')
+    return parser.parse_args()
+
+
+def format_size(size):
+    return '%.1f kB' % (size / 1024)
+
+
+def measure_peak(func, *args):
+    # Peak of memory allocated by func(*args), excluding memory allocated
+    # before the call
+    gc.collect()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    return tracemalloc.get_traced_memory()[1] - start
+
+
+def optimize_compile(tree, filename, config):
+    tree = fatoptimizer.optimize(tree, filename, config)
+    fix_locations(tree)
+    compile_tree(tree, filename)
+
+
+def bench_module(config, filename):
+    tree = parse_module(filename)[1]
+    compile_peak = measure_peak(compile_tree, tree, filename)
+    optimize_peak = measure_peak(optimize_compile, tree, filename, config)
+    return {'compile': compile_peak,
+            'optimize_compile': optimize_peak}
+
+
+def main():
+    args = parse_args()
+
+    config = fatoptimizer.Config()
+    config.enable_all()
+
+    filenames = find_modules(args.directory, args.limit)
+    modules = {}
+    failures = {}
+    tracemalloc.start()
+    for filename in filenames:
+        name = os.path.relpath(filename, args.directory)
+        try:
+            modules[name] = bench_module(config, filename)
+        except (SyntaxError, UnicodeDecodeError) as exc:
+            # not a valid Python 3 module
+            failures[name] = 'parse error: %s' % exc
+        except Exception as exc:
+            failures[name] = '%s: %s' % (type(exc).__name__, exc)
+            print("ERROR: %s: %s" % (name, failures[name]), file=sys.stderr)
+    tracemalloc.stop()
+
+    if not modules:
+        print("ERROR: no module found in %s" % args.directory)
+        sys.exit(1)
+
+    results = list(modules.values())
+    compile_peak = sum(result['compile'] for result in results)
+    optimize_peak = sum(result['optimize_compile'] for result in results)
+    summary = {
+        'modules': len(modules),
+        'failures': len(failures),
+        'compile': compile_peak,
+        'optimize_compile': optimize_peak,
+        'max_compile': max(result['compile'] for result in results),
+        'max_optimize_compile': max(result['optimize_compile']
+                                    for result in results),
+        'ratio': optimize_peak / compile_peak,
+    }
+
+    print("Directory: %s" % args.directory)
+    print("Modules: %s (%s failures)" % (len(modules), len(failures)))
+    print()
+    print("Sum of peaks, plain compile(): %s" % format_size(compile_peak))
+    print("Sum of peaks, optimize() + compile(): %s (%.1fx plain compile)"
+          % (format_size(optimize_peak), summary['ratio']))
+    print("Largest peak, plain compile(): %s"
+          % format_size(summary['max_compile']))
+    print("Largest peak, optimize() + compile(): %s"
+          % format_size(summary['max_optimize_compile']))
+
+    if args.top:
+        print()
+        print("Modules with the largest peak:")
+        largest = sorted(modules.items(),
+                         key=lambda item: item[1]['optimize_compile'],
+                         reverse=True)
+        for name, result in largest[:args.top]:
+            print("- %s: %s (plain compile: %s)"
+                  % (name, format_size(result['optimize_compile']),
+                     format_size(result['compile'])))
+
+    if args.json:
+        data = {'fatoptimizer': fatoptimizer.__version__,
+                'python': sys.version,
+                'directory': args.directory,
+                'summary': summary,
+                'modules': modules,
+                'failures': failures}
+        with open(args.json, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        print()
+        print("Results written into %s" % args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark on the pure-Python runtime (fatoptimizer.runtime) used by
+optimized code when the fat module is missing.
+
+Functions are optimized with all optimizations enabled and run with the
+pure-Python runtime, and compared with the unoptimized functions. The
+dispatcher of the pure-Python runtime checks guards at each call: the
+specialized function is only faster if the optimization saves more than
+the cost of the dispatcher.
+"""
+
+import argparse
+import ast
+import fatoptimizer
+import fatoptimizer.runtime
+import sys
+import textwrap
+import timeit
+from fatoptimizer.benchmark import format_dt, compared_dt
+from fatoptimizer.precompile import fix_locations
+
+
+SOURCE = '''
+def call_len():
+    return len("abc")
+
+def parse_int():
+    return int("12345") + ord("a")
+
+def loop_len(seq):
+    total = 0
+    for i in range(8):
+        total += len(seq) * i
+    return total
+
+def loop_builtins(seq):
+    total = 0
+    for item in seq:
+        total += abs(item) + len(str(item))
+    return total
+'''
+
+# (function name, arguments)
+CALLS = (
+    ('call_len', ()),
+    ('parse_int', ()),
+    ('loop_len', ('abc',)),
+    ('loop_builtins', (list(range(-10, 10)),)),
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='number of calls per timing (default: 10000)')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='number of timings, the minimum is kept '
+                             '(default: 20)')
+    return parser.parse_args()
+
+
+def create_functions(optimize):
+    tree = ast.parse(textwrap.dedent(SOURCE), '<bench>')
+    if optimize:
+        config = fatoptimizer.Config()
+        config.enable_all()
+        tree = fatoptimizer.optimize(tree, '<bench>', config)
+        fix_locations(tree)
+
+    ns = {}
+    # force the pure-Python runtime even if the fat module is installed
+    old_fat = sys.modules.get('fat')
+    sys.modules['fat'] = None
+    try:
+        exec(compile(tree, '<bench>', 'exec'), ns, ns)
+    finally:
+        if old_fat is not None:
+            sys.modules['fat'] = old_fat
+        else:
+            del sys.modules['fat']
+    return ns
+
+
+def bench_call(func, args, number, repeat):
+    timer = timeit.Timer('func(*args)',
+                         globals={'func': func, 'args': args})
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    args = parse_args()
+    original = create_functions(False)
+    optimized = create_functions(True)
+
+    for name, call_args in CALLS:
+        func = optimized[name]
+        if not fatoptimizer.runtime.get_specialized(func):
+            print("ERROR: %s() is not specialized" % name)
+            sys.exit(1)
+        code = fatoptimizer.runtime.get_specialized(func)[0][0]
+        specialized = type(func)(code, func.__globals__)
+
+        original_dt = bench_call(original[name], call_args,
+                                 args.number, args.repeat)
+        specialized_dt = bench_call(specialized, call_args,
+                                    args.number, args.repeat)
+        runtime_dt = bench_call(func, call_args, args.number, args.repeat)
+
+        print("%s():" % name)
+        print("- original: %s" % format_dt(original_dt))
+        print("- specialized, without guard: %s"
+              % compared_dt(specialized_dt, original_dt))
+        print("- specialized, pure-Python runtime: %s"
+              % compared_dt(runtime_dt, original_dt))
+        print("- cost of the dispatcher: %s"
+              % format_dt(runtime_dt - specialized_dt))
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,78 @@
-from .tools import pretty_dump, OptimizerError
+from .tools import pretty_dump, OptimizerError, OptimizerStep
 from .config import Config
-from .optimizer import ModuleOptimizer as _ModuleOptimizer
+from .profiler import Profiler
+from .cache import FunctionCache, TreeCache
+from .plugin import register_step, unregister_step, STAGE1, SPECIALIZE
 import sys
 
 
 __version__ = '0.3'
 
 
+def _is_tiny(tree, config):
+    min_nodes = config.min_module_nodes
+    if min_nodes is None:
+        return False
+    from .tools import count_nodes
+    return count_nodes(tree, min_nodes) < min_nodes
+
+
+def _create_optimizer(config, filename):
+    # optimizer steps are only imported when the first module is optimized
+    from .optimizer import ModuleOptimizer
+    from .plugin import compose_optimizer
+
+    return compose_optimizer(ModuleOptimizer)(config, filename)
+
+
 def optimize(tree, filename, config):
-    optimizer = _ModuleOptimizer(config, filename)
+    if _is_tiny(tree, config):
+        return tree
+    optimizer = _create_optimizer(config, filename)
     return optimizer.optimize(tree)
 
 
 class FATOptimizer:
     name = "fat"
 
-    def __init__(self, config):
+    def __init__(self, config, cache_size=128):
         self.config = config
+        # cache of the optimized trees of code compiled by compile(),
+        # eval() and exec(), or None
+        if cache_size:
+            self.tree_cache = TreeCache(cache_size)
+        else:
+            self.tree_cache = None
 
     def ast_transformer(self, tree, context):
         filename = context.filename
-        if sys.flags.verbose and not filename.startswith('<'):
-            print("# run fatoptimizer on %s" % filename, file=sys.stderr)
-        return optimize(tree, context.filename, self.config)
+        config = self.config
+        if _is_tiny(tree, config):
+            return tree
 
+        cache = self.tree_cache
+        if not filename.startswith('<'):
+            if sys.flags.verbose:
+                print("# run fatoptimizer on %s" % filename, file=sys.stderr)
+            # modules are only compiled once: don't cache them
+            cache = None
+        key = None
+        if cache is not None:
+            key = cache.get_key(tree, filename, config.fingerprint())
+        if key is not None:
+            new_tree = cache.load(key)
+            if new_tree is not None:
+                return new_tree
+
+        optimizer = _create_optimizer(config, filename)
+        new_tree = optimizer.optimize(tree)
+        # don't store trees partially optimized because of a time budget
+        if key is not None and not optimizer.deadline_exceeded:
+            cache.store(key, new_tree)
+        return new_tree
 
-def _register():
-    # First, import the fat module to create the copy of the builtins dict
-    import fat
 
+def _register():
     import sys
 
     config = Config()
@@ -36,6 +80,15 @@ def _register():
     if sys.flags.verbose:
         config.logger = sys.stderr
 
+    if not hasattr(sys, 'set_code_transformers'):
+        # Python without PEP 511: optimize modules when they are imported
+        from .importer import install
+        install(config)
+        return
+
+    # First, import the fat module to create the copy of the builtins dict
+    import fat
+
     transformers = sys.get_code_transformers()
     # add the FAT optimizer before the peephole optimizer
     transformers.insert(0, FATOptimizer(config))
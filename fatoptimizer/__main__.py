@@ -0,0 +1,115 @@
+"""
+Command line interface of fatoptimizer.
+
+Usage: python -m fatoptimizer compile [options] path [path ...]
+"""
+
+import argparse
+import importlib
+import os
+import sys
+
+from .benchmark import format_dt
+from .cache import FunctionCache
+from .config import Config
+from .precompile import find_sources, compile_files
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m fatoptimizer')
+    commands = parser.add_subparsers(dest='command')
+
+    cmd = commands.add_parser('compile',
+                              help='optimize Python modules and write '
+                                   'optimized bytecode files')
+    cmd.add_argument('paths', nargs='+', metavar='path',
+                     help='Python module or directory of Python modules')
+    cmd.add_argument('-j', '--workers', type=int, default=0,
+                     help='number of worker processes, 0 to use the number '
+                          'of CPUs (default: 0)')
+    cmd.add_argument('-f', '--force', action='store_true',
+                     help='compile modules even if their bytecode file '
+                          'is up to date')
+    cmd.add_argument('-q', '--quiet', action='store_true',
+                     help='only report failures and the summary')
+    cmd.add_argument('--optim-tag',
+                     help='optimization tag of bytecode filenames '
+                          '(default: tag of the import hook, depending on '
+                          'the version of fatoptimizer and the '
+                          'configuration)')
+    cmd.add_argument('--max-module-time', type=float, metavar='SECONDS',
+                     help='time budget of the optimization of a module')
+    cmd.add_argument('--max-function-time', type=float, metavar='SECONDS',
+                     help='time budget of the optimization of a function')
+    cmd.add_argument('--cache-dir',
+                     help='directory of the cache of optimized functions '
+                          '(default: no cache)')
+    cmd.add_argument('--plugin', action='append', default=[],
+                     metavar='MODULE', dest='plugins',
+                     help='import a module registering optimizer steps, '
+                          'can be used multiple times')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_usage()
+        sys.exit(2)
+    if args.workers < 0:
+        parser.error('number of workers must be positive or zero')
+    return args
+
+
+def cmd_compile(args):
+    for name in args.plugins:
+        importlib.import_module(name)
+
+    config = Config()
+    config.enable_all()
+    config.max_module_time = args.max_module_time
+    config.max_function_time = args.max_function_time
+    if args.cache_dir:
+        config.function_cache = FunctionCache(args.cache_dir)
+
+    workers = args.workers or None
+    filenames = list(find_sources(args.paths))
+
+    compiled = skipped = specialized = cutoffs = 0
+    failures = []
+    total_dt = 0.0
+    for result in compile_files(filenames, config, workers,
+                                args.optim_tag, args.force, args.plugins):
+        if result.error is not None:
+            failures.append(result)
+            print("ERROR: %s: %s" % (result.filename, result.error),
+                  file=sys.stderr)
+        elif result.skipped:
+            skipped += 1
+        else:
+            compiled += 1
+            specialized += result.specialized
+            cutoffs += result.cutoffs
+            total_dt += result.time
+            if not args.quiet:
+                msg = ("%s: %s, %s specialized functions"
+                       % (result.filename, format_dt(result.time),
+                          result.specialized))
+                if result.cutoffs:
+                    msg += ", %s budget cutoffs" % result.cutoffs
+                print(msg)
+        sys.stdout.flush()
+
+    print("Compiled %s modules in %s (%s up to date, %s failures), "
+          "%s specialized functions, %s budget cutoffs"
+          % (compiled, format_dt(total_dt), skipped, len(failures),
+             specialized, cutoffs))
+    if failures:
+        sys.exit(1)
+
+
+def main():
+    args = parse_args()
+    if args.command == 'compile':
+        cmd_compile(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,15 +12,13 @@ class BaseOptimizer(NodeTransformer):
         super().__init__(filename)
         self.namespace = Namespace()
 
-    def _visit_attr(self, parent_node, attr_name, node):
+    def _attr_context(self, parent_node, attr_name):
         parent_type = type(parent_node)
         if (parent_type in _COND_BLOCK
            and attr_name != "finalbody"
            and not(attr_name == "test" and parent_type == ast.If)):
-            with self.namespace.cond_block():
-                return self.visit(node)
-        else:
-            return self.visit(node)
+            return self.namespace.cond_block()
+        return None
 
     def _run_new_optimizer(self, node):
         optimizer = BaseOptimizer()
@@ -9,6 +9,8 @@ CONSTANTS = {
 
 
 class ReplaceBuiltinConstant(OptimizerStep):
+    config_option = 'replace_builtin_constant'
+
     def visit_Name(self, node):
         if not self.config.replace_builtin_constant:
             return
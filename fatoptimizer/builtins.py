@@ -1,5 +1,5 @@
 import builtins
-import functools
+import types
 
 from .tools import (UNSET,
     FLOAT_TYPES, COMPLEX_TYPES, STR_TYPES, ITERABLE_TYPES)
@@ -44,15 +44,19 @@ def _pow_check_args(config, args):
     return check_pow(config, num, exp, mod)
 
 
-def add_pure_builtins(config):
+# Read-only mapping: name => PureFunction, created by get_pure_builtins()
+_PURE_BUILTINS = None
+
+
+def _create_pure_builtins():
+    pure_builtins = {}
+
     def add(name, *args, **kw):
         func = getattr(builtins, name)
-        pure_func = PureFunction(func, name, *args, **kw)
-        config._pure_builtins[name] = pure_func
+        pure_builtins[name] = PureFunction(func, name, *args, **kw)
 
     ANY_TYPE = None
 
-    pow_check_args = functools.partial(_pow_check_args, config)
     add('abs', 1, COMPLEX_TYPES)
     add('ascii', 1, ANY_TYPE)
     add('bin', 1, int)
@@ -87,7 +91,7 @@ def add_pure_builtins(config):
         # catch TypeError for non comparable values
         exceptions=TypeError)
     add('pow', (2, 3), FLOAT_TYPES, FLOAT_TYPES, FLOAT_TYPES,
-        check_args=pow_check_args,
+        check_config=_pow_check_args,
         exceptions=(ValueError, TypeError, OverflowError))
     add('repr', 1, COMPLEX_TYPES + STR_TYPES)
     add('round', (1, 2), FLOAT_TYPES, int)
@@ -98,3 +102,26 @@ def add_pure_builtins(config):
     add('sum', (1, 2), ANY_TYPE, ANY_TYPE,
         exceptions=TypeError)
     add('tuple', 1, ITERABLE_TYPES)
+
+    return types.MappingProxyType(pure_builtins)
+
+
+def get_pure_builtins():
+    """Get the read-only mapping name => PureFunction of pure builtins.
+
+    The mapping is created once and shared by all configurations.
+    """
+    global _PURE_BUILTINS
+    if _PURE_BUILTINS is None:
+        _PURE_BUILTINS = _create_pure_builtins()
+    return _PURE_BUILTINS
+
+
+def add_pure_builtins(config):
+    pure_builtins = get_pure_builtins()
+    if config._pure_builtins and config._pure_builtins is not pure_builtins:
+        # copy the table of the configuration, don't modify it
+        table = dict(config._pure_builtins)
+        table.update(pure_builtins)
+        pure_builtins = table
+    config._pure_builtins = pure_builtins
@@ -0,0 +1,339 @@
+"""
+Persistent cache of optimized functions and in-memory cache of optimized
+trees.
+"""
+
+import ast
+import collections
+import os
+import sys
+import threading
+
+
+# Version of the format of cache entries
+CACHE_FORMAT = 1
+
+# Suffix of cache entry filenames
+ENTRY_SUFFIX = '.fatcache'
+
+
+def dump_function(func_node):
+    """Dump a function for the cache key.
+
+    Line numbers are relative to the function definition, to reuse the
+    function if its position changed in the file.
+
+    Return (data, names) where data is a list and names is the set of
+    the names used in the function.
+    """
+    base = func_node.lineno
+    data = []
+    names = set()
+    items = [func_node]
+    while items:
+        item = items.pop()
+        if isinstance(item, ast.AST):
+            data.append(item.__class__)
+            if isinstance(item, ast.Name):
+                names.add(item.id)
+            if 'lineno' in item._attributes:
+                lineno = getattr(item, 'lineno', None)
+                end_lineno = getattr(item, 'end_lineno', None)
+                data.append((
+                    lineno - base if lineno is not None else None,
+                    getattr(item, 'col_offset', None),
+                    end_lineno - base if end_lineno is not None else None,
+                    getattr(item, 'end_col_offset', None)))
+            fields = [getattr(item, field, None) for field in item._fields]
+            fields.reverse()
+            items.extend(fields)
+        elif isinstance(item, list):
+            data.append(list)
+            data.append(len(item))
+            items.extend(reversed(item))
+        else:
+            data.append(item)
+    return data, names
+
+
+def _shift_lineno(tree, delta):
+    if not delta:
+        return
+    nodes = list(tree) if isinstance(tree, list) else [tree]
+    # nodes can be shared by the function and its specialized version
+    seen = set()
+    while nodes:
+        node = nodes.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if getattr(node, 'lineno', None) is not None:
+            node.lineno += delta
+        if getattr(node, 'end_lineno', None) is not None:
+            node.end_lineno += delta
+        nodes.extend(ast.iter_child_nodes(node))
+
+
+class CacheEntry:
+    """Result of the optimization of a function.
+
+    The entry also records names created in the parent namespace, which
+    depend on the whole module: they are checked before reusing the entry.
+    """
+
+    def __init__(self, lineno, tree, str_constants, tmp_name):
+        # line number of the function definition
+        self.lineno = lineno
+        # optimized tree: FunctionDef node or list of nodes,
+        # None if the optimizer didn't modify the function
+        self.tree = tree
+        # list of (value, unique value) of str constants created by
+        # new_str_constant()
+        self.str_constants = str_constants
+        # (name, unique name) of the local variable created in the parent
+        # namespace, or None
+        self.tmp_name = tmp_name
+
+    def get_tree(self, func_node):
+        """Get the optimized tree of a function."""
+        tree = self.tree
+        if tree is None:
+            return func_node
+        _shift_lineno(tree, func_node.lineno - self.lineno)
+        return tree
+
+
+class FunctionCache:
+    """On-disk cache of optimized functions.
+
+    An entry is stored per function, keyed by the source of the function,
+    facts of its enclosing namespaces, the configuration and the versions of
+    Python and fatoptimizer. Least recently used entries are removed when
+    the total size of the cache exceeds max_size bytes.
+
+    The cache can be used by multiple threads and the cache directory can be
+    shared by multiple processes. Entries are loaded with pickle: the
+    directory must not be writable by untrusted users.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        # statistics: number of reused functions, number of optimized
+        # functions and number of stored entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        # estimation of the total size of the cache, None if unknown
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_lookup(self, hit):
+        """Update statistics on the lookup of a function."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _get_prefix(self):
+        from . import __version__
+        return ('fatoptimizer-%s-format%s-%s'
+                % (__version__, CACHE_FORMAT, sys.implementation.cache_tag))
+
+    def get_key(self, func_data, config_fingerprint, facts):
+        """Compute the key of a function.
+
+        func_data is the data returned by dump_function(). facts is a list
+        of facts of the enclosing namespaces used to optimize the function.
+        """
+        import hashlib
+
+        data = (self._get_prefix(), config_fingerprint, func_data, facts)
+        data = repr(data).encode('utf-8', 'surrogatepass')
+        return hashlib.sha256(data).hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def load(self, key):
+        """Load a CacheEntry: return None if the key is not in the cache."""
+        import pickle
+
+        filename = self._get_filename(key)
+        try:
+            with open(filename, 'rb') as fp:
+                entry = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # corrupted entry
+            self._remove(filename)
+            return None
+
+        if not isinstance(entry, CacheEntry):
+            self._remove(filename)
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, entry):
+        import pickle
+        import tempfile
+
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write into a temporary file and then rename it to not expose
+        # incomplete entries to other processes
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory,
+                                            prefix='tmp', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_filename, self._get_filename(key))
+        except BaseException:
+            self._remove(tmp_filename)
+            raise
+        with self._lock:
+            self.stores += 1
+            if self._size is not None:
+                self._size += len(data)
+                if self._size <= self.max_size:
+                    return
+        self.prune()
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            # already removed by another process
+            pass
+
+    def _list_entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def prune(self):
+        """Remove least recently used entries until the total size of the
+        cache is smaller than max_size."""
+        with self._lock:
+            entries = self._list_entries()
+            size = sum(entry[1] for entry in entries)
+            if size > self.max_size:
+                entries.sort()
+                for mtime, entry_size, filename in entries:
+                    self._remove(filename)
+                    size -= entry_size
+                    if size <= self.max_size:
+                        break
+            self._size = size
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            for mtime, size, filename in self._list_entries():
+                self._remove(filename)
+            self._size = 0
+
+
+class TreeCache:
+    """In-memory cache of optimized trees.
+
+    Entries are keyed by the tree, its filename and the configuration.
+    Least recently used entries are removed when the cache has more than
+    max_entries entries. Trees are stored serialized with pickle: a tree
+    loaded from the cache is a new tree.
+
+    The cache can be used by multiple threads.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        # statistics: number of reused trees, number of optimized trees and
+        # number of stored entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        # mapping: key => serialized tree, from the least recently used
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, tree, filename, config_fingerprint):
+        """Compute the key of a tree.
+
+        Return None if the tree cannot be serialized.
+        """
+        import hashlib
+        import pickle
+
+        try:
+            data = pickle.dumps((tree, filename, config_fingerprint),
+                                pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return None
+        return hashlib.sha256(data).digest()
+
+    def load(self, key):
+        """Load an optimized tree: return None if the key is not in the
+        cache."""
+        import pickle
+
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return pickle.loads(data)
+
+    def store(self, key, tree):
+        import pickle
+
+        try:
+            data = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # constant which cannot be serialized
+            return
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
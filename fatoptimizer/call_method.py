@@ -6,9 +6,14 @@ from .specialized import BuiltinGuard
 
 class CallPureMethods(OptimizerStep):
     """Call methods of builtin types which have no side effect."""
+    config_option = '_pure_methods'
 
     def call_method(self, pure_func, obj, node):
-        value = pure_func.call_method(obj, node)
+        args = pure_func.get_call_args(obj, node, self.config)
+        if args is None:
+            return
+        value = self.evaluate(node, pure_func.func, args,
+                              pure_func.exceptions)
         if value is UNSET:
             return
 
@@ -5,8 +5,14 @@ from .specialized import BuiltinGuard
 
 
 class CallPureBuiltin(OptimizerStep):
+    config_option = '_pure_builtins'
+
     def call_builtin(self, node, pure_func):
-        value = pure_func.call_func(node)
+        args = pure_func.get_call_args(UNSET, node, self.config)
+        if args is None:
+            return
+        value = self.evaluate(node, pure_func.func, args,
+                              pure_func.exceptions)
         if value is UNSET:
             return
 
@@ -1,27 +1,106 @@
 import builtins
+import types
 
+from . import plugin
 from .tools import get_constant_size, ITERABLE_TYPES
 
 
+# Names of the builtin namespace, shared by configurations
+_BUILTIN_NAMES = frozenset(dir(builtins))
+
+# Fingerprint data of read-only tables shared by configurations.
+# Mapping: id(table) => (table, data)
+_shared_table_data = {}
+
+
+def _get_table_data(table, get_data):
+    # Get the fingerprint data of a table: the repr() of get_data(table).
+    # The data of large shared tables is only computed once.
+    if not isinstance(table, (types.MappingProxyType, frozenset)):
+        return repr(get_data(table))
+    try:
+        return _shared_table_data[id(table)][1]
+    except KeyError:
+        pass
+    data = repr(get_data(table))
+    # keep a reference to the table to not reuse its identifier
+    _shared_table_data[id(table)] = (table, data)
+    return data
+
+
+def _get_object_data(obj):
+    # Get the fingerprint data of a function, a type or a tuple of types
+    # attribute of a PureFunction: the data must not depend on the process
+    if isinstance(obj, tuple):
+        return tuple(_get_object_data(item) for item in obj)
+    if obj is None:
+        return None
+    data = (getattr(obj, '__module__', None),
+            getattr(obj, '__qualname__', None))
+    code = getattr(obj, '__code__', None)
+    if code is not None:
+        # distinguish lambda functions
+        data += (code.co_firstlineno,)
+    return data
+
+
+def _get_pure_func_data(pure_func):
+    return (_get_object_data(pure_func.func),
+            pure_func.name,
+            pure_func.min_narg,
+            pure_func.max_narg,
+            _get_object_data(pure_func.arg_types),
+            _get_object_data(pure_func._check_args_cb),
+            _get_object_data(pure_func._check_config_cb),
+            _get_object_data(pure_func.exceptions))
+
+
+def _get_builtins_data(pure_builtins):
+    return sorted((name, _get_pure_func_data(pure_func))
+                  for name, pure_func in pure_builtins.items())
+
+
+def _get_methods_data(pure_methods):
+    return sorted((obj_type.__qualname__, _get_builtins_data(methods))
+                  for obj_type, methods in pure_methods.items())
+
+
 class Config:
     # FIXME: use dir()?
     _attributes = '''
         _pure_builtins
         _pure_methods
+        background_specialization
         constant_folding
         constant_propagation
         copy_builtin_to_constant
         enabled
+        function_cache
+        guard_cost
         inlining
+        lazy_specialization
         logger
         max_bytes_len
         max_constant_size
+        max_eval_ops
+        max_eval_time
+        max_function_nodes
+        max_function_time
         max_int_bits
+        max_module_nodes
+        max_module_time
+        min_module_nodes
+        max_passes
         max_str_len
         max_seq_len
+        max_unroll_growth
+        max_unroll_nodes
+        min_specialize_gain
+        profiler
         remove_dead_code
         replace_builtin_constant
         simplify_iterable
+        specialization_table
         unroll_loops
     '''.strip().split()
 
@@ -32,6 +111,14 @@ class Config:
         # File where logs are written to
         self.logger = None
 
+        # Profiler instance used to collect statistics on optimizer steps,
+        # or None to disable profiling
+        self.profiler = None
+
+        # FunctionCache instance used to reuse optimized functions,
+        # or None to disable the cache
+        self.function_cache = None
+
         # Maximum size of a constant in bytes: the constant size is computed
         # using the size in bytes of marshal.dumps() output
         self.max_constant_size = 128
@@ -49,10 +136,68 @@ class Config:
         # preliminary check: max_constant_size still applies for sequences.
         self.max_seq_len = self.max_constant_size // 4
 
+        # Maximum number of optimization passes on nodes modified by an
+        # optimization, until a fixed point is reached.
+        self.max_passes = 4
+
+        # Budget of the optimization of a module and of a function: maximum
+        # time in seconds and maximum number of AST nodes, None means no
+        # limit. A module or a function with too many nodes is not
+        # optimized. When the time budget is exceeded, the optimizer stops
+        # and keeps the nodes optimized so far.
+        self.max_module_time = None
+        self.max_module_nodes = None
+        self.max_function_time = None
+        self.max_function_nodes = None
+
+        # Minimum number of AST nodes of a module, None means no minimum.
+        # Smaller trees are not optimized: it avoids the cost of the
+        # optimizer on tiny snippets compiled by compile(), eval() or exec().
+        self.min_module_nodes = None
+
+        # Cost model of specialization: minimum estimated gain in
+        # nanoseconds per call of a specialized function, after the cost
+        # of its guards and of its code in memory. None means that functions
+        # are always specialized. See fatoptimizer.cost.
+        self.min_specialize_gain = None
+
+        # Estimated cost of guards in nanoseconds per call: (cost of the
+        # check, cost per watched builtin). The default is the cost of the
+        # fat module, fatoptimizer.cost.calibrate() measures it.
+        self.guard_cost = (11.0, 1.0)
+
+        # Lazy specialization: number of calls of a function of the module
+        # before it is optimized and specialized, None means that functions
+        # are optimized when the module is compiled. Only functions defined
+        # at the module level without decorator are optimized lazily.
+        self.lazy_specialization = None
+
+        # Background specialization: number of threads optimizing functions
+        # defined at the module level after the module is executed, None
+        # means that functions are not optimized in background. It has the
+        # priority over lazy_specialization.
+        self.background_specialization = None
+
+        # Emit specializations of functions of the module namespace in a
+        # table installed by a single call to
+        # fatoptimizer.runtime.specialize_table(), instead of emitting
+        # statements after each specialized function.
+        self.specialization_table = False
+
+        # Budget of the evaluation of a pure function during the
+        # compilation: maximum estimated number of operations and maximum
+        # time in seconds, None means no limit. Evaluations exceeding a
+        # budget are not retried.
+        self.max_eval_ops = 100000
+        self.max_eval_time = None
+
         # Methods of builtin types which have no side effect.
         #
         # Mapping: type => method_mapping
         # where method_mapping is a mapping: name => PureFunction
+        #
+        # Tables of pure functions are shared by configurations and must not
+        # be modified: set a modified copy instead.
         self._pure_methods = {}
 
         # Builtin functions (PureFunction instances) which have no side effect
@@ -65,12 +210,20 @@ class Config:
         # This optimizations breaks test_dynamic which explicitly modifies
         # builtins in the middle of a generator.
         self.copy_builtin_to_constant = False
-        self._copy_builtin_to_constant = set(dir(builtins))
+        self._copy_builtin_to_constant = _BUILTIN_NAMES
 
         # Loop unrolling (disabled by default): maximum number of loop
         # iterations (ex: n in 'for index in range(n):')
         self.unroll_loops = 16
 
+        # Code size budget of loop unrolling, None means no limit: maximum
+        # number of AST nodes of an unrolled loop or comprehension (number
+        # of iterations x size of the body), and maximum number of AST nodes
+        # added by unrolling in a function, shared by nested loops. Loops
+        # exceeding the budget are not unrolled.
+        self.max_unroll_nodes = 2048
+        self.max_unroll_growth = 8192
+
         # Constant propagation
         self.constant_propagation = True
 
@@ -99,16 +252,92 @@ class Config:
             from .methods import add_pure_methods
             add_pure_methods(self)
 
+    def __getattr__(self, name):
+        # Options of registered optimizer steps which are not set
+        # get their default value
+        try:
+            return plugin.get_options()[name]
+        except KeyError:
+            raise AttributeError("%r object has no attribute %r"
+                                 % (type(self).__name__, name)) from None
+
+    def _get_attributes(self):
+        return self._attributes + sorted(plugin.get_options())
+
     def replace(self, config):
         new_config = Config(_optimize=False)
-        for attr in self._attributes:
+        for attr in self._get_attributes():
             if not attr.startswith('_') and attr in config:
                 value = config[attr]
             else:
                 value = getattr(self, attr)
             setattr(new_config, attr, value)
+        new_config._copy_builtin_to_constant = self._copy_builtin_to_constant
         return new_config
 
+    def __getstate__(self):
+        from .builtins import get_pure_builtins
+        from .methods import get_pure_methods
+
+        # Shared tables are read-only mappings which cannot be pickled:
+        # replace them with None
+        state = self.__dict__.copy()
+        pure_builtins = state['_pure_builtins']
+        if pure_builtins is get_pure_builtins():
+            state['_pure_builtins'] = None
+        else:
+            state['_pure_builtins'] = dict(pure_builtins)
+        pure_methods = state['_pure_methods']
+        if pure_methods is get_pure_methods():
+            state['_pure_methods'] = None
+        else:
+            state['_pure_methods'] = {obj_type: dict(methods)
+                                      for obj_type, methods
+                                      in pure_methods.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._pure_builtins is None:
+            from .builtins import get_pure_builtins
+            self._pure_builtins = get_pure_builtins()
+        if self._pure_methods is None:
+            from .methods import get_pure_methods
+            self._pure_methods = get_pure_methods()
+
+    def fingerprint(self):
+        """Get a fingerprint of the options modifying the optimized code.
+
+        Return a string.
+        """
+        import hashlib
+
+        options = []
+        for attr in self._get_attributes():
+            # the result of the optimization exceeding a time budget
+            # is not cached
+            if attr in ('logger', 'profiler', 'function_cache',
+                        'max_module_time', 'max_function_time',
+                        'max_eval_time'):
+                continue
+            value = getattr(self, attr)
+            if attr == '_pure_builtins':
+                value = _get_table_data(value, _get_builtins_data)
+            elif attr == '_pure_methods':
+                value = _get_table_data(value, _get_methods_data)
+            options.append((attr, value))
+        options.append(('_copy_builtin_to_constant',
+                        _get_table_data(self._copy_builtin_to_constant,
+                                        sorted)))
+        registrations = plugin.get_registrations()
+        if registrations:
+            options.append(('_steps',
+                            [(reg.stage, reg.step.__module__,
+                              reg.step.__qualname__)
+                             for reg in registrations]))
+        data = repr(options).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
     def disable_all(self):
         self.max_constant_size = 128
         self.max_int_bits = 256
@@ -126,6 +355,14 @@ class Config:
         self.remove_dead_code = False
         self.simplify_iterable = False
         # inlining is disabled, too experimental and buggy
+        self._enable_steps(False)
+
+    def _enable_steps(self, enabled):
+        # Set the options enabling registered optimizer steps
+        for reg in plugin.get_registrations():
+            option = reg.step.config_option
+            if option in reg.options:
+                setattr(self, option, enabled)
 
     def enable_all(self):
         self.max_constant_size = 1024   # 1 KB
@@ -135,7 +372,7 @@ class Config:
         self.max_seq_len = self.max_constant_size
 
         self.copy_builtin_to_constant = True
-        self._copy_builtin_to_constant = set(dir(builtins))
+        self._copy_builtin_to_constant = _BUILTIN_NAMES
         self.unroll_loops = 256
         self.constant_propagation = True
         self.constant_folding = True
@@ -143,6 +380,7 @@ class Config:
         self.remove_dead_code = True
         self.simplify_iterable = True
         self.inlining = True
+        self._enable_steps(True)
 
         from .builtins import add_pure_builtins
         add_pure_builtins(self)
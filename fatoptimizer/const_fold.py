@@ -137,6 +137,8 @@ def check_pow(config, num, exp, mod=None):
 
 
 class ConstantFolding(OptimizerStep):
+    config_option = 'constant_folding'
+
     def check_binop(self, op, left, right):
         if isinstance(left, COMPLEX_TYPES) and isinstance(right, COMPLEX_TYPES):
             if isinstance(op, DIVIDE_BINOPS) and not right:
@@ -225,7 +227,9 @@ class ConstantFolding(OptimizerStep):
         if not ok:
             return
 
-        result = eval_binop(left, right)
+        result = self.evaluate(node, eval_binop, (left, right))
+        if result is UNSET:
+            return
         new_node = self.new_constant(node, result)
         if new_node is None:
             return
@@ -267,7 +271,9 @@ class ConstantFolding(OptimizerStep):
 
         value = get_constant(node.operand, types=types)
         if value is not UNSET:
-            result = eval_unaryop(value)
+            result = self.evaluate(node, eval_unaryop, (value,))
+            if result is UNSET:
+                return
             return self.new_constant(node, result)
 
         if (isinstance(node.op, ast.Not)
@@ -305,7 +311,11 @@ class ConstantFolding(OptimizerStep):
             step = None
 
         myslice = slice(start, stop, step)
-        result = value[myslice]
+        # [1, 2][::0] raises a ValueError
+        result = self.evaluate(node, operator.getitem, (value, myslice),
+                               ValueError)
+        if result is UNSET:
+            return
         return self.new_constant(node, result)
 
     def subscript_index(self, node):
@@ -322,9 +332,9 @@ class ConstantFolding(OptimizerStep):
         if index is UNSET:
             return
 
-        try:
-            result = value[index]
-        except (IndexError, KeyError):
+        result = self.evaluate(node, operator.getitem, (value, index),
+                               (IndexError, KeyError))
+        if result is UNSET:
             return
 
         return self.new_constant(node, result)
@@ -373,9 +383,8 @@ class ConstantFolding(OptimizerStep):
             # on runtime option
             return
 
-        try:
-            result = eval_op(left, right)
-        except TypeError:
+        result = self.evaluate(node, eval_op, (left, right), TypeError)
+        if result is UNSET:
             return
         return self.new_constant(node, result)
 
@@ -399,7 +408,7 @@ class ConstantFolding(OptimizerStep):
             return
 
         new_node = copy_node(node)
-        new_node.comparators[0] = new_seq_ast
+        new_node.comparators = [new_seq_ast] + node.comparators[1:]
         return new_node
 
     def visit_Compare(self, node):
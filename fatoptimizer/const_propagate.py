@@ -8,6 +8,8 @@ class ConstantPropagation(OptimizerStep):
 
     This optimizer step requires the NamespaceStep step.
     """
+    config_option = 'constant_propagation'
+
     def visit_Name(self, node):
         if not self.config.constant_propagation:
             return
@@ -4,12 +4,16 @@ from .tools import OptimizerStep
 
 
 class CopyBuiltinToConstant:
+    __slots__ = ('global_name', 'unique_constant')
+
     def __init__(self, global_name, unique_constant):
         self.global_name = global_name
         self.unique_constant = unique_constant
 
 
 class CopyBuiltinToConstantStep(OptimizerStep):
+    config_option = 'copy_builtin_to_constant'
+
     def visit_Call(self, node):
         if not self.config.copy_builtin_to_constant:
             return
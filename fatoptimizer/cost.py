@@ -0,0 +1,204 @@
+"""
+Cost model deciding if the specialization of a function is worth its guards.
+
+Costs are estimated times in nanoseconds of one call of a function. Loop
+bodies are weighted by their estimated number of iterations.
+
+The costs of AST nodes and MEMORY_COST are uncalibrated estimates: they
+are only meant to be right relative to each other, calibrate() doesn't
+measure them. Only the cost of guards, the guard_cost option, is measured
+by calibrate().
+"""
+
+import ast
+import textwrap
+import timeit
+
+
+# Estimated cost of AST nodes in nanoseconds (not measured)
+LOCAL_NAME_COST = 2         # LOAD_FAST
+GLOBAL_NAME_COST = 7        # LOAD_GLOBAL
+CONSTANT_COST = 1           # LOAD_CONST
+CALL_COST = 20              # call a builtin function, without its body
+ATTRIBUTE_COST = 8
+SUBSCRIPT_COST = 10
+OPERATOR_COST = 10          # binary operator, comparison, etc.
+ITERATION_COST = 15         # one iteration of a loop
+NODE_COST = 2               # other statements and expressions
+
+# Number of iterations of a loop when it is unknown
+DEFAULT_ITERATIONS = 10
+
+# Estimated cost of the specialized code in memory in nanoseconds per call,
+# per AST node: a specialized function keeps two code objects (not measured)
+MEMORY_COST = 0.05
+
+_OPERATOR_NODES = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+                   ast.AugAssign)
+_COMPREHENSION_NODES = (ast.ListComp, ast.SetComp, ast.DictComp,
+                        ast.GeneratorExp)
+_NAMESPACE_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef,
+                    ast.Lambda)
+
+
+def get_iterations(node):
+    """Estimate the number of iterations of a loop on the iterable node."""
+    if isinstance(node, ast.Constant):
+        try:
+            return len(node.value)
+        except TypeError:
+            return DEFAULT_ITERATIONS
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return len(node.elts)
+    if (isinstance(node, ast.Call)
+       and isinstance(node.func, ast.Name) and node.func.id == 'range'
+       and not node.keywords
+       and 1 <= len(node.args) <= 3
+       and all(isinstance(arg, ast.Constant) and type(arg.value) is int
+               for arg in node.args)):
+        try:
+            return len(range(*[arg.value for arg in node.args]))
+        except (ValueError, OverflowError):
+            pass
+    return DEFAULT_ITERATIONS
+
+
+class _CostEstimator:
+    def __init__(self, local_variables):
+        self.local_variables = local_variables
+        # stack of (node, weight)
+        self.stack = []
+
+    def push(self, nodes, weight):
+        for node in nodes:
+            if isinstance(node, list):
+                self.push(node, weight)
+            elif node is not None:
+                self.stack.append((node, weight))
+
+    def node_cost(self, node):
+        if isinstance(node, ast.Name):
+            if (isinstance(node.ctx, ast.Load)
+               and node.id not in self.local_variables):
+                return GLOBAL_NAME_COST
+            return LOCAL_NAME_COST
+        if isinstance(node, ast.Constant):
+            return CONSTANT_COST
+        if isinstance(node, ast.Call):
+            return CALL_COST
+        if isinstance(node, ast.Attribute):
+            return ATTRIBUTE_COST
+        if isinstance(node, ast.Subscript):
+            return SUBSCRIPT_COST
+        if isinstance(node, _OPERATOR_NODES):
+            return OPERATOR_COST
+        if isinstance(node, (ast.stmt, ast.expr)):
+            return NODE_COST
+        return 0
+
+    def visit(self, node, weight):
+        cost = self.node_cost(node) * weight
+        if isinstance(node, _NAMESPACE_NODES):
+            # the body is not executed
+            return cost
+
+        if isinstance(node, (ast.For, ast.AsyncFor)):
+            loop_weight = weight * get_iterations(node.iter)
+            cost += ITERATION_COST * loop_weight
+            self.push((node.iter, node.orelse), weight)
+            self.push((node.target, node.body), loop_weight)
+        elif isinstance(node, ast.While):
+            loop_weight = weight * DEFAULT_ITERATIONS
+            cost += ITERATION_COST * loop_weight
+            self.push((node.orelse,), weight)
+            self.push((node.test, node.body), loop_weight)
+        elif isinstance(node, _COMPREHENSION_NODES):
+            for generator in node.generators:
+                self.push((generator.iter,), weight)
+                weight *= get_iterations(generator.iter)
+                cost += ITERATION_COST * weight
+                self.push((generator.target, generator.ifs), weight)
+            if isinstance(node, ast.DictComp):
+                self.push((node.key, node.value), weight)
+            else:
+                self.push((node.elt,), weight)
+        else:
+            self.push(ast.iter_child_nodes(node), weight)
+        return cost
+
+    def estimate(self, nodes):
+        cost = 0
+        self.push(nodes, 1)
+        stack = self.stack
+        while stack:
+            node, weight = stack.pop()
+            cost += self.visit(node, weight)
+        return cost
+
+
+def estimate_cost(body, local_variables=()):
+    """Estimate the cost in nanoseconds of one execution of the body,
+    a list of statements.
+
+    Names of local_variables are loaded with LOAD_FAST, other names with
+    LOAD_GLOBAL.
+    """
+    return _CostEstimator(local_variables).estimate(body)
+
+
+def count_names(guards):
+    """Count the names watched by a list of guards."""
+    return sum(len(guard.names) for guard in guards)
+
+
+def get_guard_cost(config, nname):
+    """Estimate the cost in nanoseconds of guards watching nname names,
+    checked at each call of a specialized function."""
+    cost, name_cost = config.guard_cost
+    return cost + name_cost * nname
+
+
+def get_memory_cost(tree):
+    """Estimate the memory cost of the specialized code of a tree."""
+    return MEMORY_COST * sum(1 for node in ast.walk(tree))
+
+
+def _bench(func, number, repeat):
+    timer = timeit.Timer('func()', globals={'func': func})
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def calibrate(number=100000, repeat=5):
+    """Measure the cost of guards of the fat module, or of
+    fatoptimizer.runtime if the fat module is missing.
+
+    Return a (cost, name_cost) tuple for the guard_cost option: the cost of
+    the check of guards and the cost per watched name, in nanoseconds.
+    """
+    try:
+        import fat
+    except ImportError:
+        from . import runtime as fat
+
+    names = ('len', 'abs', 'int', 'str', 'chr', 'ord', 'min', 'max')
+    source = textwrap.dedent('''
+        def func():
+            pass
+
+        def func1():
+            pass
+
+        def func8():
+            pass
+    ''')
+    ns = {}
+    exec(source, ns, ns)
+    fat.specialize(ns['func1'], ns['func'], [fat.GuardBuiltins(*names[:1])])
+    fat.specialize(ns['func8'], ns['func'], [fat.GuardBuiltins(*names)])
+
+    base = _bench(ns['func'], number, repeat)
+    cost1 = _bench(ns['func1'], number, repeat) - base
+    cost8 = _bench(ns['func8'], number, repeat) - base
+    name_cost = max((cost8 - cost1) / (len(names) - 1), 0.0)
+    cost = max(cost1 - name_cost, 0.0)
+    return (round(cost, 1), round(name_cost, 1))
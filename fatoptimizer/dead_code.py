@@ -73,6 +73,8 @@ def remove_dead_code(optimizer, node_list):
 
 
 class RemoveDeadCode(OptimizerStep):
+    config_option = 'remove_dead_code'
+
     def log_node_removal(self, message, node_list):
         log_node_removal(self, message, node_list)
 
@@ -121,7 +123,7 @@ class RemoveDeadCode(OptimizerStep):
             self.log_node_removal("Remove dead code (empty else block of if)",
                                   node.orelse)
             new_node = copy_node(node)
-            del new_node.orelse[:]
+            new_node.orelse = []
             node = new_node
 
         if is_empty_body(node.body) and not is_empty_body(node.orelse):
@@ -146,7 +148,7 @@ class RemoveDeadCode(OptimizerStep):
                                   "(empty else block of while)",
                                   node.orelse)
             new_node = copy_node(node)
-            del new_node.orelse[:]
+            new_node.orelse = []
             return new_node
 
     def _try_empty_body(self, node):
@@ -201,7 +203,7 @@ class RemoveDeadCode(OptimizerStep):
                                   node.orelse)
 
             node = copy_node(node)
-            node.orelse.clear()
+            node.orelse = []
 
         if is_empty_body(node.body):
             new_node = self._try_empty_body(node)
@@ -233,5 +235,5 @@ class RemoveDeadCode(OptimizerStep):
             self.log_node_removal("Remove dead code (empty else block of for)",
                                   node.orelse)
             new_node = copy_node(node)
-            del new_node.orelse[:]
+            new_node.orelse = []
             return new_node
@@ -0,0 +1,153 @@
+"""
+Import hook optimizing modules when they are imported, for Python without
+the PEP 511 API (sys.set_code_transformers()).
+"""
+
+import ast
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import threading
+import warnings
+
+from . import precompile
+from .precompile import get_optim_tag
+
+
+class _State(threading.local):
+    # True while the current thread optimizes a module: modules imported
+    # by the optimizer itself are not optimized
+    optimizing = False
+
+
+_state = _State()
+
+
+class FATLoader(importlib.machinery.SourceFileLoader):
+    """Loader optimizing the source of a module before compiling it.
+
+    The optimized bytecode is written next to the regular bytecode, with
+    the optimization tag in its filename.
+    """
+
+    def __init__(self, fullname, path, config, optim_tag):
+        super().__init__(fullname, path)
+        self.config = config
+        self.optim_tag = optim_tag
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        from . import optimize
+
+        source = importlib.util.decode_source(data)
+        tree = ast.parse(source, path)
+        _state.optimizing = True
+        try:
+            tree = optimize(tree, path, self.config)
+        finally:
+            _state.optimizing = False
+        precompile.fix_locations(tree)
+        with warnings.catch_warnings():
+            # calls to str constants replaced at runtime by replace_consts()
+            warnings.filterwarnings('ignore', "'str' object is not callable",
+                                    SyntaxWarning)
+            return compile(tree, path, 'exec', dont_inherit=True,
+                           optimize=_optimize)
+
+    def get_code(self, fullname):
+        filename = self.get_filename(fullname)
+        bytecode_filename = precompile.get_bytecode_filename(filename,
+                                                             self.optim_tag)
+        st = os.stat(filename)
+        code = precompile.read_bytecode(bytecode_filename, st)
+        if code is not None:
+            return code
+
+        code = self.source_to_code(self.get_data(filename), filename)
+        if not sys.dont_write_bytecode:
+            try:
+                precompile.write_bytecode(code, bytecode_filename, st)
+            except OSError:
+                # read-only directory: the module is optimized again by
+                # the next import
+                pass
+        return code
+
+
+class FATFinder:
+    """Meta path finder loading source modules with FATLoader.
+
+    Modules are searched by importlib.machinery.PathFinder. If paths is not
+    None, only modules in these directories are optimized.
+    """
+
+    def __init__(self, config, optim_tag=None, paths=None):
+        self.config = config
+        if optim_tag is None:
+            optim_tag = get_optim_tag(config)
+        self.optim_tag = optim_tag
+        if paths is not None:
+            paths = tuple(os.path.join(os.path.abspath(path), '')
+                          for path in paths)
+        self.paths = paths
+
+    def _optimize_module(self, fullname, filename):
+        if fullname == 'fatoptimizer' or fullname.startswith('fatoptimizer.'):
+            return False
+        if self.paths is None:
+            return True
+        return os.path.abspath(filename).startswith(self.paths)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if _state.optimizing:
+            return None
+
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
+        if (spec is None
+           or type(spec.loader) is not importlib.machinery.SourceFileLoader
+           or not self._optimize_module(fullname, spec.origin)):
+            return spec
+
+        spec.loader = FATLoader(fullname, spec.origin,
+                                self.config, self.optim_tag)
+        spec.cached = precompile.get_bytecode_filename(spec.origin,
+                                                       self.optim_tag)
+        return spec
+
+
+def install(config=None, optim_tag=None, paths=None):
+    """Install an import hook optimizing modules with config.
+
+    Use a configuration with all optimizations enabled if config is None.
+    The hook is installed before importlib.machinery.PathFinder in
+    sys.meta_path. If the lazy_specialization or background_specialization
+    option is set, config is also used to optimize functions after the
+    import. Return the FATFinder.
+    """
+    from .config import Config
+
+    if config is None:
+        config = Config()
+        config.enable_all()
+    finder = FATFinder(config, optim_tag, paths)
+    if (config.lazy_specialization is not None
+       or config.background_specialization is not None):
+        # bytecode files can be compiled by another process: register
+        # the configuration to optimize their lazy functions
+        from . import lazy
+        lazy.register_config(config)
+
+    uninstall()
+    meta_path = sys.meta_path
+    try:
+        index = meta_path.index(importlib.machinery.PathFinder)
+    except ValueError:
+        index = len(meta_path)
+    meta_path.insert(index, finder)
+    return finder
+
+
+def uninstall():
+    """Remove import hooks installed by install()."""
+    sys.meta_path[:] = [finder for finder in sys.meta_path
+                        if not isinstance(finder, FATFinder)]
@@ -51,6 +51,8 @@ class Expansion:
     '''Information about a callsite that's a candidate for inlining, giving
     the funcdef, and the actual positional arguments (having
     resolved any keyword arguments.'''
+    __slots__ = ('funcdef', 'actual_pos_args')
+
     def __init__(self, funcdef, actual_pos_args):
         self.funcdef = funcdef
         self.actual_pos_args = actual_pos_args
@@ -58,6 +60,7 @@ class Expansion:
 
 class InlineSubstitution(OptimizerStep):
     """Function call inlining."""
+    config_option = 'inlining'
 
     def build_positional_args(self, candidate, callsite):
         """Attempt to convert the positional and keyword args supplied at
@@ -92,10 +95,9 @@ class InlineSubstitution(OptimizerStep):
         # FIXME: don't do it for recursive functions
         if not isinstance(callsite.func, ast.Name):
             return None
-        from .namespace import _fndefs
-        if callsite.func.id not in _fndefs:
+        candidate = self.find_funcdef(callsite.func.id)
+        if candidate is None:
             return None
-        candidate = _fndefs[callsite.func.id]
 
         # For now, only support simple positional arguments
         # and keyword arguments
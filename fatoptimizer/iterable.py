@@ -8,6 +8,7 @@ from .specialized import BuiltinGuard
 
 class BaseSimplifyIterable(OptimizerStep):
     """Simplify iterable expressions."""
+    config_option = 'simplify_iterable'
 
     def optimize_iterable(self, node):
         raise NotImplementedError
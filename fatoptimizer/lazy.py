@@ -0,0 +1,413 @@
+"""
+Lazy specialization: optimize functions when they are called.
+
+When the lazy_specialization option is set, functions defined at the
+module level are not optimized when the module is compiled. lazy() replaces
+the code of the function with a trampoline, a code with the same parameters
+which counts calls. At the Nth call, the source of the module is parsed
+again, the function is optimized and its specialized code is installed with
+fat.specialize(), or with fatoptimizer.runtime if the fat module is
+missing.
+
+When the background_specialization option is set, background() queues
+functions instead: they are optimized by background threads while the
+application runs their original code.
+
+Functions are optimized with the configuration used to compile their
+module, identified by its fingerprint: see register_config().
+"""
+
+import __future__
+import ast
+import linecache
+import queue
+import threading
+import time
+import types
+import warnings
+import weakref
+import zlib
+
+from . import runtime
+
+
+# Compiler flags of __future__ imports
+_FUTURE_FLAGS = 0
+for _name in __future__.all_feature_names:
+    _FUTURE_FLAGS |= getattr(__future__, _name).compiler_flag
+del _name
+
+# mapping: config fingerprint => Config, see register_config()
+_configs = {}
+
+# Lock to optimize one function at the same time. Reentrant: a module
+# imported by the optimizer can call its lazy functions.
+_lock = threading.RLock()
+
+# mapping: function => _LazyFunction
+_lazy = weakref.WeakKeyDictionary()
+
+# mapping: (filename, config fingerprint) => (source lines, ModuleOptimizer,
+# funcdefs) of modules with lazy functions, or None if the module cannot be
+# optimized. funcdefs is a mapping: (name, line number) => FunctionDef node.
+_modules = {}
+
+# mapping: (filename, config fingerprint) => number of lazy functions not
+# optimized yet
+_pending = {}
+
+# mapping: signature => code of the trampoline
+_trampolines = {}
+
+# Nodes which can contain statements of the module namespace,
+# ast.match_case was added to Python 3.10
+_BLOCK_NODES = (ast.stmt, ast.excepthandler)
+if hasattr(ast, 'match_case'):
+    _BLOCK_NODES += (ast.match_case,)
+
+# Queue of functions optimized by background threads, see background()
+_queue = None
+
+# Background threads wait until no function was passed to background()
+# during BACKGROUND_DELAY seconds: optimizing functions while modules are
+# imported would slow down the imports, threads share the GIL
+BACKGROUND_DELAY = 0.1
+_last_queued = 0.0
+
+
+def get_checksum(node):
+    """Get the checksum of a FunctionDef node.
+
+    It is used to check that the source of the module was not modified
+    since the module was compiled.
+    """
+    return zlib.crc32(ast.dump(node).encode('utf-8', 'surrogatepass'))
+
+
+def _register_config(config, fingerprint):
+    if fingerprint not in _configs:
+        # copy the configuration: the caller can modify it
+        _configs[fingerprint] = config.replace({})
+
+
+def register_config(config):
+    """Register a configuration used to compile modules.
+
+    Lazy functions of a module are only optimized if the configuration used
+    to compile the module was registered in the process. The optimizer
+    registers it, but modules loaded from bytecode files can be compiled by
+    another process.
+    """
+    _register_config(config, config.fingerprint())
+
+
+def _get_trampoline(code):
+    # Generated code for a function 'def func(x, *, y)':
+    #
+    #   def func(x, *, y):
+    #       _fat_call, = "__fat_state__"
+    #       return _fat_call(x, y=y)
+    #
+    # "__fat_state__" is replaced with the state of the function.
+    signature = runtime._get_signature(code)
+    try:
+        return _trampolines[signature]
+    except KeyError:
+        pass
+
+    if any(name.startswith('_fat_')
+           for name in runtime._get_params(signature)):
+        # a parameter shadows a variable of the trampoline
+        trampoline = None
+    else:
+        params, call_args = runtime._format_signature(signature)
+        source = ('def _fat_trampoline(%s):\n'
+                  '    _fat_call, = "__fat_state__"\n'
+                  '    return _fat_call(%s)\n'
+                  % (params, call_args))
+        trampoline = runtime._compile_function(source, __file__)
+    _trampolines[signature] = trampoline
+    return trampoline
+
+
+def _iter_funcdefs(node):
+    # Iterate on FunctionDef nodes of the module namespace
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, ast.FunctionDef):
+            yield child
+        elif isinstance(child, _BLOCK_NODES):
+            if not isinstance(child, (ast.AsyncFunctionDef, ast.ClassDef)):
+                yield from _iter_funcdefs(child)
+
+
+def _analyze_module(filename, lines, config):
+    from . import _create_optimizer
+
+    try:
+        tree = ast.parse(''.join(lines), filename)
+    except SyntaxError:
+        return None
+    optimizer = _create_optimizer(config, filename)
+    tree = optimizer.analyze(tree)
+    if tree is None:
+        return None
+    funcdefs = {(node.name, node.lineno): node
+                for node in _iter_funcdefs(tree)}
+    return (lines, optimizer, funcdefs)
+
+
+def _get_module(filename, module_globals, fingerprint):
+    lines = linecache.getlines(filename, module_globals)
+    if not lines:
+        return None
+    key = (filename, fingerprint)
+    module = _modules.get(key)
+    if module is None or module[0] != lines:
+        module = _analyze_module(filename, lines, _configs[fingerprint])
+        _modules[key] = module
+    return module
+
+
+def _compile(tree, filename, flags):
+    from .precompile import fix_locations
+
+    fix_locations(tree)
+    with warnings.catch_warnings():
+        # calls to str constants replaced at runtime by replace_consts()
+        warnings.filterwarnings('ignore', "'str' object is not callable",
+                                SyntaxWarning)
+        return compile(tree, filename, 'exec', flags, dont_inherit=True)
+
+
+def _compile_funcdef(node, filename, flags):
+    # Compile a FunctionDef node: return the code of the function
+    tree = ast.Module(body=[node], type_ignores=[])
+    code = _compile(tree, filename, flags)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType) and const.co_name == node.name:
+            return const
+    raise ValueError("no function in the code")
+
+
+def _get_fat():
+    try:
+        import fat
+    except ImportError:
+        fat = runtime
+    return fat
+
+
+def _optimize_function(func, checksum, fingerprint):
+    code = func.__code__
+    filename = code.co_filename
+    module = _get_module(filename, func.__globals__, fingerprint)
+    if module is None:
+        return
+    lines, optimizer, funcdefs = module
+    node = funcdefs.get((func.__name__, code.co_firstlineno))
+    if node is None or get_checksum(node) != checksum:
+        # the source was modified
+        return
+
+    new_node = optimizer.optimize_function(node)
+    if new_node is node:
+        return
+    if not isinstance(new_node, list):
+        new_node = [new_node]
+
+    # Replace the code with the code optimized by the stage 1
+    flags = code.co_flags & _FUTURE_FLAGS
+    func.__code__ = _compile_funcdef(new_node[0], filename, flags)
+    if len(new_node) == 1:
+        return
+
+    # Run the statements specializing the function in a copy of the module
+    # namespace where the name of the function is bound to the function
+    tree = ast.Module(body=new_node[1:], type_ignores=[])
+    code = _compile(tree, filename, flags)
+    namespace = dict(func.__globals__)
+    namespace[func.__name__] = func
+    namespace[optimizer.get_fat_module_name()] = _get_fat()
+    exec(code, namespace)
+
+
+class _LazyFunction:
+    def __init__(self, func, checksum, fingerprint):
+        # weak reference: the function owns its _LazyFunction
+        self.func = weakref.ref(func)
+        self.checksum = checksum
+        self.fingerprint = fingerprint
+        self.orig_code = func.__code__
+        # code of the function until it is optimized
+        self.code = self.orig_code
+        self.pending = True
+
+    def is_pending(self, func):
+        return self.pending and func.__code__ is self.code
+
+    def get_key(self):
+        return (self.orig_code.co_filename, self.fingerprint)
+
+    def _done(self):
+        self.pending = False
+        key = self.get_key()
+        _pending[key] -= 1
+        if not _pending[key]:
+            # all lazy functions of the module are optimized
+            del _pending[key]
+            _modules.pop(key, None)
+
+    def optimize(self, func):
+        # Must be called with _lock held
+        from .importer import _state
+
+        func.__code__ = self.orig_code
+        # modules imported by the optimizer are not optimized
+        optimizing = _state.optimizing
+        _state.optimizing = True
+        try:
+            _optimize_function(func, self.checksum, self.fingerprint)
+        except Exception as exc:
+            func.__code__ = self.orig_code
+            warnings.warn("fatoptimizer: failed to optimize %s: %s"
+                          % (func.__qualname__, exc), RuntimeWarning)
+        finally:
+            _state.optimizing = optimizing
+            self._done()
+
+
+class _Trampoline(_LazyFunction):
+    def __init__(self, func, ncalls, checksum, fingerprint, trampoline):
+        super().__init__(func, checksum, fingerprint)
+        self.ncalls = ncalls
+        if ncalls > 1:
+            # function called before the function is optimized
+            self.orig_func = runtime._copy_func(func, self.orig_code)
+        else:
+            self.orig_func = None
+        code = runtime.replace_consts(trampoline,
+                                      {"__fat_state__": (self.call,)})
+        self.code = runtime._rename_code(code, self.orig_code)
+
+    def call(self, *args, **kwargs):
+        self.ncalls -= 1
+        if self.ncalls > 0:
+            return self.orig_func(*args, **kwargs)
+
+        func = self.func()
+        with _lock:
+            if self.is_pending(func):
+                self.optimize(func)
+        return func(*args, **kwargs)
+
+
+def _check_func(func, fingerprint):
+    if not isinstance(func, types.FunctionType):
+        raise TypeError("func must be a function, not %s"
+                        % type(func).__name__)
+    # the function cannot be optimized if the configuration used to
+    # compile its module is unknown
+    return (func.__closure__ is None and func not in _lazy
+            and fingerprint in _configs)
+
+
+def _register(func, lazy_func):
+    # Must be called with _lock held
+    key = lazy_func.get_key()
+    _pending[key] = _pending.get(key, 0) + 1
+    _lazy[func] = lazy_func
+
+
+def lazy(func, ncalls, checksum, fingerprint):
+    """Optimize the function func at its ncalls-th call.
+
+    checksum is the checksum of the FunctionDef node of the function
+    computed by get_checksum() and fingerprint is the fingerprint of the
+    configuration when the module was compiled.
+    """
+    if ncalls < 1:
+        raise ValueError("ncalls must be at least 1")
+    if not _check_func(func, fingerprint):
+        return
+    if func.__code__.co_flags & runtime._GENERATOR_FLAGS:
+        # the trampoline is not a generator or a coroutine
+        return
+    trampoline = _get_trampoline(func.__code__)
+    if trampoline is None:
+        return
+
+    lazy_func = _Trampoline(func, ncalls, checksum, fingerprint, trampoline)
+    with _lock:
+        _register(func, lazy_func)
+        func.__code__ = lazy_func.code
+
+
+def _worker():
+    while True:
+        lazy_func = _queue.get()
+        while True:
+            delay = _last_queued + BACKGROUND_DELAY - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+
+        func = lazy_func.func()
+        try:
+            with _lock:
+                if func is not None and lazy_func.is_pending(func):
+                    lazy_func.optimize(func)
+                elif lazy_func.pending:
+                    # the function was destroyed or its code was replaced
+                    lazy_func._done()
+        finally:
+            _queue.task_done()
+        # don't keep the function alive while waiting for the next one
+        func = lazy_func = None
+
+
+def _start_workers(config):
+    global _queue
+
+    _queue = queue.Queue()
+    nworker = config.background_specialization or 1
+    for index in range(nworker):
+        # daemon threads: exiting Python doesn't wait for optimizations
+        thread = threading.Thread(target=_worker,
+                                  name='fatoptimizer-%s' % index,
+                                  daemon=True)
+        thread.start()
+
+
+def background(func, checksum, fingerprint):
+    """Optimize the function func in a background thread.
+
+    checksum is the checksum of the FunctionDef node of the function
+    computed by get_checksum() and fingerprint is the fingerprint of the
+    configuration when the module was compiled. The function runs its
+    original code until it is optimized.
+    """
+    if not _check_func(func, fingerprint):
+        return
+
+    global _last_queued
+
+    lazy_func = _LazyFunction(func, checksum, fingerprint)
+    _last_queued = time.monotonic()
+    with _lock:
+        _register(func, lazy_func)
+        if _queue is None:
+            # the number of threads is set by the first configuration
+            _start_workers(_configs[fingerprint])
+    _queue.put(lazy_func)
+
+
+def join():
+    """Wait until functions passed to background() are optimized."""
+    if _queue is not None:
+        _queue.join()
+
+
+def is_lazy(func):
+    """Check if the function func is waiting to be optimized."""
+    lazy_func = _lazy.get(func)
+    return lazy_func is not None and lazy_func.is_pending(func)
@@ -1,4 +1,5 @@
 import codecs
+import types
 
 from .pure import PureFunction
 
@@ -33,13 +34,20 @@ def check_byte_or_int(*args):
                for arg in args)
 
 
-def add_pure_methods(config):
+# Read-only mapping: type => mapping name => PureFunction,
+# created by get_pure_methods()
+_PURE_METHODS = None
+
+
+def _create_pure_methods():
+    pure_methods = {}
+
     def add(obj_type, name, *args, **kw):
-        if obj_type not in config._pure_methods:
-            config._pure_methods[obj_type] = {}
+        if obj_type not in pure_methods:
+            pure_methods[obj_type] = {}
         func = getattr(obj_type, name)
         pure = PureFunction(func, name, *args, **kw)
-        config._pure_methods[obj_type][name] = pure
+        pure_methods[obj_type][name] = pure
 
     add(bytes, 'decode', (0, 2), str, str,
         check_args=check_encoding,
@@ -149,3 +157,34 @@ def add_pure_methods(config):
     add(str, 'zfill', 1, int)
 
     # FIXME: tuple: count, index
+
+    return types.MappingProxyType({
+        obj_type: types.MappingProxyType(methods)
+        for obj_type, methods in pure_methods.items()})
+
+
+def get_pure_methods():
+    """Get the read-only mapping type => mapping name => PureFunction of
+    pure methods of builtin types.
+
+    The mapping is created once and shared by all configurations.
+    """
+    global _PURE_METHODS
+    if _PURE_METHODS is None:
+        _PURE_METHODS = _create_pure_methods()
+    return _PURE_METHODS
+
+
+def add_pure_methods(config):
+    pure_methods = get_pure_methods()
+    if config._pure_methods and config._pure_methods is not pure_methods:
+        # copy the table of the configuration, don't modify it
+        table = dict(config._pure_methods)
+        for obj_type, methods in pure_methods.items():
+            if obj_type in table:
+                merged = dict(table[obj_type])
+                merged.update(methods)
+                methods = merged
+            table[obj_type] = methods
+        pure_methods = table
+    config._pure_methods = pure_methods
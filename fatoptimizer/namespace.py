@@ -1,8 +1,9 @@
 import ast
 import contextlib
 
+from .convert_const import ConvertConstant
 from .tools import (UNSET, get_constant, compact_dump,
-    OptimizerError, NodeVisitor, RestrictToFunctionDefMixin, OptimizerStep)
+    OptimizerError, OptimizerStep)
 
 
 class ComplexAssignment(OptimizerError):
@@ -78,76 +79,147 @@ def _get_assign_names(targets, load_names, store_names):
                             % ast.dump(target))
 
 
-class GlobalVisitor(NodeVisitor, RestrictToFunctionDefMixin):
-    """Search for 'global var' statements."""
+class Scope:
+    """Facts about a namespace collected by ScopeAnalysis.
 
-    def __init__(self, filename):
-        super().__init__(filename)
-        self.global_variables = set()
-
-    def visit_Global(self, node):
-        self.global_variables |= set(node.names)
-
-
-class NonlocalVisitor(NodeVisitor):
-    """Search for 'nonlocal var' statements."""
+    A namespace is a module, a class, a function, a lambda, a generator
+    expression or a comprehension.
+    """
 
-    def __init__(self, filename):
-        super().__init__(filename)
+    def __init__(self):
+        # variable names
+        self.global_variables = set()
+        self.local_variables = set()
         self.nonlocal_variables = set()
+        # names stored by assignments: global and nonlocal variables are
+        # removed from them when the analysis of the namespace completes
+        self._store_names = set()
+        # str constants of the namespace, excluding nested namespaces
+        self.str_constants = set()
+        # mapping: function name => FunctionDef node, only for functions
+        # bound once by a def statement of the namespace body
+        self.funcdefs = {}
+        # mapping: name => number of statements binding the name
+        self._bindings = {}
+        # True if the namespace uses 'from module import *'
+        self._star_import = False
+        # number of AST nodes, including the namespace node and nested
+        # namespaces
+        self.node_count = 1
+        # ComplexAssignment exception, or None
+        self.error = None
+
+    def _complete(self):
+        # Global and non local variables cannot be local variables
+        store_names = self._store_names
+        store_names -= (self.global_variables | self.nonlocal_variables)
+        self.local_variables |= store_names
+        self._store_names = set()
 
-    def visit_Nonlocal(self, node):
-        self.nonlocal_variables |= set(node.names)
+    def _bind(self, names):
+        bindings = self._bindings
+        for name in names:
+            bindings[name] = bindings.get(name, 0) + 1
 
 
-class VariableVisitor(NodeVisitor, RestrictToFunctionDefMixin):
-    """Find local and global variables.
+class ScopeAnalysis(ConvertConstant):
+    """Convert constants and collect facts on all namespaces of a tree.
 
-    Find local and global variables of a function, but exclude variables of
-    nested functions (functions, list comprehensions, generator expressions,
-    etc.).
+    The tree is only walked once. The scopes attribute is a mapping:
+    AST node of the namespace => Scope. The node is the one of the
+    converted tree returned by analyze().
     """
+
     def __init__(self, filename):
         super().__init__(filename)
-        # variable names
-        self.global_variables = set()
-        self.local_variables = set()
-        self.nonlocal_variables = set()
-
-    @classmethod
-    def from_node_list(cls, filename, node_list):
-        visitor = cls(filename)
-        for node in node_list:
-            visitor.find_variables(node)
-        return visitor
-
-    def find_variables(self, node):
-        # search for "global var"
-        visitor = GlobalVisitor(self.filename)
-        visitor.generic_visit(node)
-        self.global_variables |= visitor.global_variables
+        self.scopes = {}
+        self._scope = None
+        # names declared global in a namespace
+        self._global_names = set()
+
+    def analyze(self, tree):
+        """Analyze tree: return the converted tree."""
+        scope, new_tree = self._visit_scope(tree)
+        # 'global name' allows nested namespaces to rebind a function
+        for scope in self.scopes.values():
+            for name in self._global_names & scope.funcdefs.keys():
+                del scope.funcdefs[name]
+        return new_tree
+
+    def _visit_scope(self, node):
+        parent = self._scope
+        scope = Scope()
+        self._scope = scope
+        try:
+            new_node = self.generic_visit(node)
+        finally:
+            self._scope = parent
+        scope._complete()
+        self._index_funcdefs(scope, new_node)
+        if parent is not None:
+            # the 'nonlocal var' statements of nested namespaces
+            # also apply to the parent namespace
+            parent.nonlocal_variables |= scope.nonlocal_variables
+            # visit() already counted the namespace node in the parent
+            parent.node_count += scope.node_count - 1
+        self.scopes[new_node] = scope
+        return scope, new_node
+
+    def _index_funcdefs(self, scope, node):
+        if scope._star_import:
+            return
+        body = getattr(node, 'body', None)
+        if not isinstance(body, list):
+            # lambda
+            return
+        # ignore conditional definitions and names bound more than once,
+        # like 'try: from _mod import func' + 'except ImportError: def func'
+        for stmt in body:
+            if (isinstance(stmt, ast.FunctionDef)
+               and scope._bindings[stmt.name] == 1
+               and stmt.name not in scope.global_variables
+               and stmt.name not in scope.nonlocal_variables):
+                scope.funcdefs[stmt.name] = stmt
+
+    def _enter_node(self, node):
+        self._scope.node_count += 1
+
+    def convert(self, node, value):
+        if isinstance(value, str):
+            self._scope.str_constants.add(value)
+        return super().convert(node, value)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            self._scope.str_constants.add(node.value)
 
-        # search for "nonlocal var"
-        visitor = NonlocalVisitor(self.filename)
-        visitor.generic_visit(node)
-        self.nonlocal_variables |= visitor.nonlocal_variables
+    def visit_Global(self, node):
+        self._scope.global_variables |= set(node.names)
+        self._global_names |= set(node.names)
 
-        # visit all nodes
-        self.generic_visit(node)
+    def visit_Nonlocal(self, node):
+        self._scope.nonlocal_variables |= set(node.names)
 
     def visit_arg(self, node):
-        self.local_variables.add(node.arg)
+        self._scope.local_variables.add(node.arg)
 
     def _assign(self, targets):
+        scope = self._scope
+        if scope.error is not None:
+            return
         # get variables
         load_names = set()
         store_names = set()
-        _get_assign_names(targets, load_names, store_names)
-
-        # Global and non local variables cannot be local variables
-        store_names -= (self.global_variables | self.nonlocal_variables)
-        self.local_variables |= store_names
-        self.global_variables |= load_names
+        try:
+            _get_assign_names(targets, load_names, store_names)
+        except ComplexAssignment as exc:
+            # globals() is used to store a variable: the namespace
+            # cannot be optimized
+            scope.error = exc
+            return
+        scope._store_names |= store_names
+        scope.global_variables |= load_names
+        scope._bind(store_names)
 
     def visit_For(self, node):
         self._assign([node.target])
@@ -160,21 +232,63 @@ class VariableVisitor(NodeVisitor, RestrictToFunctionDefMixin):
         # detect local variables
         self._assign([node.target])
 
-    def fullvisit_FunctionDef(self, node):
-        self.local_variables.add(node.name)
-
-    def fullvisit_AsyncFunctionDef(self, node):
-        self.local_variables.add(node.name)
-
-    def fullvisit_ClassDef(self, node):
-        self.local_variables.add(node.name)
+    def visit_Delete(self, node):
+        names = set()
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                names.add(target.id)
+        self._scope._bind(names)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self._scope._bind((node.name,))
+
+    def visit_MatchAs(self, node):
+        if node.name:
+            self._scope._bind((node.name,))
+
+    def visit_MatchStar(self, node):
+        if node.name:
+            self._scope._bind((node.name,))
+
+    def visit_MatchMapping(self, node):
+        if node.rest:
+            self._scope._bind((node.rest,))
+
+    def visit_NamedExpr(self, node):
+        # the target can be bound in a parent namespace
+        self._global_names.add(node.target.id)
+
+    def _fullvisit_def(self, node):
+        self._scope.local_variables.add(node.name)
+        self._scope._bind((node.name,))
+        scope, new_node = self._visit_scope(node)
+        return new_node
+
+    fullvisit_FunctionDef = _fullvisit_def
+    fullvisit_AsyncFunctionDef = _fullvisit_def
+    fullvisit_ClassDef = _fullvisit_def
+
+    def _fullvisit_namespace(self, node):
+        scope, new_node = self._visit_scope(node)
+        return new_node
+
+    fullvisit_Lambda = _fullvisit_namespace
+    fullvisit_GeneratorExp = _fullvisit_namespace
+    fullvisit_ListComp = _fullvisit_namespace
+    fullvisit_SetComp = _fullvisit_namespace
+    fullvisit_DictComp = _fullvisit_namespace
 
     def _visit_import_names(self, names):
         for name in names:
-            if name.asname:
-                self.local_variables.add(name.asname)
+            if name.name == '*':
+                self._scope._star_import = True
+            elif name.asname:
+                self._scope.local_variables.add(name.asname)
+                self._scope._bind((name.asname,))
             else:
-                self.local_variables.add(name.name)
+                self._scope.local_variables.add(name.name)
+                self._scope._bind((name.name,))
 
     def visit_Import(self, node):
         self._visit_import_names(node.names)
@@ -187,7 +301,42 @@ class VariableVisitor(NodeVisitor, RestrictToFunctionDefMixin):
             self._assign([node.optional_vars])
 
 
+class VariableVisitor:
+    """Find local and global variables.
+
+    Find local and global variables of a function, but exclude variables of
+    nested functions (functions, list comprehensions, generator expressions,
+    etc.).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # variable names
+        self.global_variables = set()
+        self.local_variables = set()
+        self.nonlocal_variables = set()
+
+    @classmethod
+    def from_node_list(cls, filename, node_list):
+        visitor = cls(filename)
+        for node in node_list:
+            visitor.find_variables(node)
+        return visitor
+
+    def find_variables(self, node):
+        analysis = ScopeAnalysis(self.filename)
+        new_node = analysis.analyze(node)
+        scope = analysis.scopes[new_node]
+        if scope.error is not None:
+            raise scope.error
+
+        self.global_variables |= scope.global_variables
+        self.nonlocal_variables |= scope.nonlocal_variables
+        self.local_variables |= scope.local_variables
+
+
 class Namespace:
+    __slots__ = ('_unknown_state', '_variables', '_inside_cond')
+
     def __init__(self):
         # True if we are unable to follow the namespace, False otherwise
         self._unknown_state = False
@@ -245,19 +394,9 @@ class Namespace:
             return UNSET
         return self._variables.get(name, UNSET)
 
-# HACK!
-# Nasty global state.  Mapping from names to FunctionDef nodes.
-# I attempted to wire up discovery of this mapping into NamespaceStep,
-# but for some reason if I store it in self.namespace, the inliner
-# instance doesn't see it (perhaps is seeing a different Namespace
-# instance, or the order in which the visit hooks is run is wrong
-_fndefs = {}
-
 class NamespaceStep(OptimizerStep):
     def fullvisit_FunctionDef(self, node):
         self.namespace.set(node.name, UNSET)
-        global _fndefs
-        _fndefs[node.name] = node
 
     def fullvisit_AsyncFunctionDef(self, node):
         self.namespace.set(node.name, UNSET)
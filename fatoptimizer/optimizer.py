@@ -1,29 +1,171 @@
 import ast
 import linecache
+import threading
+import time
 
-from .namespace import (VariableVisitor, ComplexAssignment,
-    NamespaceStep)
+from .namespace import ScopeAnalysis, NamespaceStep, get_ast_names
 from .tools import (copy_lineno, _new_constant, pretty_dump,
-    ReplaceVariable, FindStrVisitor, get_literal,
-    RestrictToFunctionDefMixin, UNSET)
+    ReplaceVariable, get_literal, Call,
+    RestrictToFunctionDefMixin, UNSET, get_kinds_mask, scan_node_kinds)
 from .specialized import BuiltinGuard, SpecializedFunction
 from .base_optimizer import BaseOptimizer
+from .cache import CacheEntry, dump_function
+from .cost import estimate_cost, count_names, get_guard_cost, get_memory_cost
 from .const_propagate import ConstantPropagation
 from .const_fold import ConstantFolding
 from .call_pure import CallPureBuiltin
-from .unroll import UnrollStep, UnrollListComp
+from .unroll import UnrollStep, UnrollListComp, UnrollBudget
 from .copy_bltin_to_const import CopyBuiltinToConstantStep
 from .bltin_const import ReplaceBuiltinConstant
-from .convert_const import ConvertConstant
 from .dead_code import RemoveDeadCode, remove_dead_code
 from .iterable import SimplifyIterable, SimplifyIterableSpecialize
 from .call_method import CallPureMethods
 from .inline import InlineSubstitution
+from .plugin import STAGE1, SPECIALIZE, compose_optimizer
+from .sandbox import Sandbox
+from .lazy import get_checksum, _register_config
 
-def add_import(tree, name, asname):
-    # import fat as __fat__
-    import_node = ast.Import(names=[ast.alias(name=name, asname=asname)],
-                      lineno=1, col_offset=1)
+# Node kinds of statements used by remove_dead_code()
+_DEAD_CODE_KINDS = get_kinds_mask(('Return', 'Raise'))
+
+# Lock to not mix log lines of modules optimized in parallel
+_logger_lock = threading.Lock()
+
+# Nodes defining a name, and nodes assigning names, see _get_stmt_names()
+_DEF_TYPES = frozenset((ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+_ASSIGN_TYPES = frozenset((ast.Assign, ast.Delete, ast.AugAssign, ast.For,
+                           ast.withitem))
+
+# Names creating the __class__ cell in a method
+_CLASS_CELL_NAMES = frozenset(('super', '__class__'))
+
+
+def _uses_class_cell(tree):
+    return any(isinstance(node, ast.Name) and node.id in _CLASS_CELL_NAMES
+               for node in ast.walk(tree))
+
+
+def _get_stmt_names(node):
+    """Get the names used or assigned by a statement.
+
+    Return None if an assignment is not supported by NamespaceStep: the
+    namespace enters an unknown state.
+    """
+    names = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is ast.Name:
+            names.add(node.id)
+            continue
+        if node_type in _DEF_TYPES:
+            names.add(node.name)
+        elif node_type is ast.alias:
+            name = node.asname or node.name
+            names.add(name.split('.', 1)[0])
+            continue
+        elif node_type in _ASSIGN_TYPES:
+            if node_type is ast.Assign or node_type is ast.Delete:
+                targets = node.targets
+            elif node_type is ast.withitem:
+                targets = (node.optional_vars,)
+            else:
+                targets = (node.target,)
+            for target in targets:
+                if target is not None and get_ast_names(target) is None:
+                    return None
+
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                stack.extend(item for item in value
+                             if isinstance(item, ast.AST))
+            elif isinstance(value, ast.AST):
+                stack.append(value)
+    return names
+
+
+def _get_skip_nodes(body, visited, old_body, stmt_names):
+    """Get the statements of body which a stage doesn't have to optimize
+    again.
+
+    visited is the set of statements that the stage left unchanged,
+    old_body is the body produced by the stage. Statements using a name of
+    a statement modified or removed since are optimized again. stmt_names
+    is a cache, mapping: statement => result of _get_stmt_names().
+    """
+    def get_names(node):
+        try:
+            return stmt_names[node]
+        except KeyError:
+            names = _get_stmt_names(node)
+            stmt_names[node] = names
+            return names
+
+    names = set()
+    statements = set(body)
+    for node in old_body:
+        if node in statements:
+            continue
+        node_names = get_names(node)
+        if node_names is None:
+            return None
+        names |= node_names
+
+    skip_nodes = set()
+    for node in body:
+        node_names = get_names(node)
+        if node_names is None:
+            # optimize the following statements again
+            break
+        if node in visited and names.isdisjoint(node_names):
+            skip_nodes.add(node)
+        else:
+            names |= node_names
+    return skip_nodes
+
+
+def add_fat_import(tree, asname):
+    # try:
+    #     import fat as __fat__
+    # except ImportError:
+    #     import fatoptimizer.runtime as __fat__
+    #
+    # Use the pure-Python implementation if the fat module is missing
+    import_fat = ast.Import(names=[ast.alias(name='fat', asname=asname)],
+                            lineno=1, col_offset=1)
+    import_runtime = ast.Import(names=[ast.alias(name='fatoptimizer.runtime',
+                                                 asname=asname)],
+                                lineno=1, col_offset=1)
+    exc_type = ast.Name(id='ImportError', ctx=ast.Load(),
+                        lineno=1, col_offset=1)
+    handler = ast.ExceptHandler(type=exc_type, name=None,
+                                body=[import_runtime],
+                                lineno=1, col_offset=1)
+    try_node = ast.Try(body=[import_fat], handlers=[handler],
+                       orelse=[], finalbody=[],
+                       lineno=1, col_offset=1)
+    _insert_import(tree, try_node)
+
+
+def add_lazy_import(tree, asname):
+    # import fatoptimizer.lazy as __fat_lazy__
+    import_node = ast.Import(names=[ast.alias(name='fatoptimizer.lazy',
+                                              asname=asname)],
+                             lineno=1, col_offset=1)
+    _insert_import(tree, import_node)
+
+
+def add_runtime_import(tree, asname):
+    # import fatoptimizer.runtime as __fat_runtime__
+    import_node = ast.Import(names=[ast.alias(name='fatoptimizer.runtime',
+                                              asname=asname)],
+                             lineno=1, col_offset=1)
+    _insert_import(tree, import_node)
+
+
+def _insert_import(tree, import_node):
     for index, node in enumerate(tree.body):
         if (index == 0 and isinstance(node, ast.Expr)
            and isinstance(node.value, ast.Constant)
@@ -43,25 +185,51 @@ def add_import(tree, name, asname):
 class NakedOptimizer(BaseOptimizer):
     """Optimizer without any optimization."""
 
+    # Stage of the optimizer steps registered by fatoptimizer.plugin
+    # composed with the optimizer, or None
+    _stage = None
+
     def __init__(self, config, filename, parent=None):
         BaseOptimizer.__init__(self, filename)
         self.config = config
+        self._use_config(config)
+        self.max_revisits = config.max_passes
+        self._profiler = config.profiler
         if parent is not None:
             self.parent = parent
             # module is a ModuleOptimizer instance
             self.module = parent.module
             self.funcdef_depth = parent.funcdef_depth
+            self._node_kinds = self.module._node_kinds
+            self._deadline = parent._deadline
+            self.unroll_budget = parent.unroll_budget
         else:
             self.parent = None
             self.module = self
             self.funcdef_depth = 0
+            # mapping: AST node of a namespace => Scope,
+            # filled by ModuleOptimizer.optimize()
+            self._scopes = {}
+            # Sandbox used to evaluate pure functions of the module
+            self._sandbox = Sandbox()
+            # Code size budget of loop unrolling in the module namespace
+            self.unroll_budget = UnrollBudget()
         # attributes set in optimize()
         self.root = None
         self._global_variables = set()
         self.nonlocal_variables = set()
         self.local_variables = set()
-        # used by FunctionOptimizer.new_str_constant()
-        self._new_str_constants = set()
+
+    def _cutoff(self, node, message, *args):
+        """Record that a budget stopped the optimization."""
+        self.module.cutoffs += 1
+        self.log(node, message, *args)
+
+    def _use_config(self, config):
+        super()._use_config(config)
+        if config.remove_dead_code:
+            # optimize_node_list() removes code after return and raise
+            self._kinds_mask |= _DEAD_CODE_KINDS
 
     def optimize_node_list(self, node_list):
         if not self.config.remove_dead_code:
@@ -70,8 +238,22 @@ class NakedOptimizer(BaseOptimizer):
 
     @classmethod
     def from_parent(cls, parent):
+        cls = compose_optimizer(cls)
         return cls(parent.config, parent.filename, parent=parent)
 
+    def evaluate(self, node, func, args, exceptions=None):
+        """Evaluate func(*args) in the sandbox of the module.
+
+        Return UNSET if the call exceeds a budget, if it raises one of
+        exceptions, or if it failed before.
+        """
+        result, cutoff = self.module._sandbox.call(self.config, func, args,
+                                                   exceptions)
+        if cutoff is not None:
+            self._cutoff(node, "skip evaluation of %s: %s",
+                         getattr(func, '__qualname__', func), cutoff)
+        return result
+
     def new_constant(self, node, value):
         if not self.config.check_result(value):
             return
@@ -82,17 +264,18 @@ class NakedOptimizer(BaseOptimizer):
         if not logger:
             return
         message = message % args
-        message = "%s: fatoptimizer: %s" % (self.error_where(node), message)
-        print(message, file=logger)
+        message = "%s: fatoptimizer: %s\n" % (self.error_where(node), message)
 
         if add_line:
             line = linecache.getline(self.filename, node.lineno)
             if line:
                 line = line.strip()
             if line:
-                print("  %s" % line, file=logger)
+                message += "  %s\n" % line
 
-        logger.flush()
+        with _logger_lock:
+            logger.write(message)
+            logger.flush()
 
     def _is_global_variable(self, name):
         if name in self._global_variables:
@@ -129,6 +312,32 @@ class NakedOptimizer(BaseOptimizer):
         # the expected builtin function
         return True
 
+    def find_funcdef(self, name):
+        """Find the definition of the function called name.
+
+        Use the function definitions indexed by the analysis of the module.
+        Return a FunctionDef node, or None if name is not a function defined
+        in the module.
+        """
+        module = self.module
+        optimizer = self
+        while optimizer is not None:
+            root = optimizer.root
+            # class attributes are not visible in nested namespaces
+            if optimizer is self or not isinstance(root, ast.ClassDef):
+                scope = self.get_scope(root)
+                if name in scope.funcdefs:
+                    return scope.funcdefs[name]
+                if (name in scope.local_variables
+                   or name in scope.nonlocal_variables):
+                    # the variable is not a function
+                    return None
+                if name in scope.global_variables and optimizer is not module:
+                    optimizer = module
+                    continue
+            optimizer = optimizer.parent
+        return None
+
     def new_local_variable(self, name):
         if name in self.local_variables:
             index = 2
@@ -142,16 +351,32 @@ class NakedOptimizer(BaseOptimizer):
 
     def _run_new_optimizer(self, node):
         optimizer = Optimizer.from_parent(self)
-        return optimizer.optimize(node)
+        return self._run_sub_optimizer(optimizer, node)
+
+    def get_scope(self, tree):
+        """Get the Scope of a namespace.
+
+        The scope is computed if the namespace was not seen by the analysis
+        of the module, for example if the optimizer created it.
+        """
+        scopes = self.module._scopes
+        try:
+            return scopes[tree]
+        except KeyError:
+            pass
+
+        analysis = ScopeAnalysis(self.filename)
+        new_tree = analysis.analyze(tree)
+        scope = analysis.scopes[new_tree]
+        scopes[tree] = scope
+        return scope
 
     def _run_sub_optimizer(self, optimizer, node):
         new_node = optimizer.optimize(node)
-        if isinstance(new_node, list):
-            # The function was optimized
-
-            # find new local variables
-            visitor = VariableVisitor.from_node_list(self.filename, new_node)
-            self.local_variables |= visitor.local_variables
+        if (optimizer.deadline_exceeded
+           and optimizer._deadline == self._deadline):
+            # the deadline is shared with the sub-optimizer
+            self.deadline_exceeded = True
         return new_node
 
     def fullvisit_FunctionDef(self, node):
@@ -173,21 +398,25 @@ class NakedOptimizer(BaseOptimizer):
     def _optimize(self, tree):
         return self.generic_visit(tree)
 
-    def optimize(self, tree):
+    def _enter_scope(self, tree):
         self.root = tree
 
-        # Find variables
-        visitor = VariableVisitor(self.filename)
-        try:
-            visitor.find_variables(tree)
-        except ComplexAssignment as exc:
+        # Get variables
+        scope = self.get_scope(tree)
+        if scope.error is not None:
             # globals() is used to store a variable:
             # give up, don't optimize the function
+            exc = scope.error
             self.log(exc.node, "skip optimisation: %s", exc)
+            return False
+        self._global_variables |= scope.global_variables
+        self.nonlocal_variables |= scope.nonlocal_variables
+        self.local_variables |= scope.local_variables
+        return True
+
+    def optimize(self, tree):
+        if not self._enter_scope(tree):
             return tree
-        self._global_variables |= visitor.global_variables
-        self.nonlocal_variables |= visitor.nonlocal_variables
-        self.local_variables |= visitor.local_variables
 
         # Optimize nodes
         return self._optimize(tree)
@@ -204,10 +433,32 @@ class Optimizer(NakedOptimizer,
                 RemoveDeadCode):
     """Optimizer for AST nodes other than Module and FunctionDef."""
 
+    _stage = STAGE1
+
 
 class FunctionOptimizerStage1(RestrictToFunctionDefMixin, Optimizer):
     """Stage 1 optimizer for ast.FunctionDef nodes."""
 
+    def _skip_node(self, node):
+        # the statement is not optimized again, but its assignments are
+        # still needed by the constant propagation
+        NamespaceReplay(self).visit(node)
+
+
+class NamespaceReplay(RestrictToFunctionDefMixin, NamespaceStep,
+                      BaseOptimizer):
+    """Update the namespace of an optimizer with the assignments of nodes,
+    without optimizing them."""
+
+    def __init__(self, optimizer):
+        super().__init__(optimizer.filename)
+        self.optimizer = optimizer
+        self.namespace = optimizer.namespace
+        # don't visit subtrees without assignment
+        self._node_kinds = optimizer._node_kinds
+
+    def log(self, node, message, *args, **kw):
+        self.optimizer.log(node, message, *args, **kw)
 
 
 class ComprehensionOptimizer(RestrictToFunctionDefMixin,
@@ -235,15 +486,23 @@ class FunctionOptimizer(NakedOptimizer,
     create a specialized function.
     """
 
+    _stage = SPECIALIZE
+
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
         if self.parent is None:
             raise ValueError("parent is not set")
         self.funcdef_depth += 1
+        # loops of the function share a code size budget
+        self.unroll_budget = UnrollBudget()
         self._guards = []
         # FIXME: move this to the optimizer step?
         # global name => CopyBuiltinToConstant
         self.copy_builtin_to_constants = {}
+        # list of (value, unique value) of new_str_constant() calls
+        self._new_str_constants = []
+        # (name, unique name) of the variable created in the parent namespace
+        self._tmp_name = None
 
     def add_guard(self, new_guard):
         if not isinstance(new_guard, BuiltinGuard):
@@ -254,31 +513,39 @@ class FunctionOptimizer(NakedOptimizer,
         else:
             self._guards.append(new_guard)
 
-    def new_str_constant(self, value):
-        str_constants = self._new_str_constants
-        str_constants |= self.parent._new_str_constants
-
+    def _str_constant_scopes(self):
         # FIXME: self.root is an old version of the tree, the new tree can
         # contain new strings
-        visitor = FindStrVisitor.from_node(self.filename, self.root)
-        str_constants |= visitor.str_constants
+        return (self.get_scope(self.root), self.get_scope(self.parent.root))
 
-        visitor = FindStrVisitor.from_node(self.filename, self.parent.root)
-        str_constants |= visitor.str_constants
+    def _unique_str_constant(self, value, scopes, new_values=()):
+        def is_used(value):
+            return (value in new_values
+                    or any(value in scope.str_constants for scope in scopes))
 
-        if value in str_constants:
+        if is_used(value):
             index = 2
             while True:
                 new_value = "%s#%s" % (value, index)
-                if new_value not in str_constants:
+                if not is_used(new_value):
                     break
                 index += 1
             value = new_value
-
-        self._new_str_constants.add(value)
-        self.parent._new_str_constants.add(value)
         return value
 
+    def new_str_constant(self, value):
+        """Create a new str constant unique in the function and its parent.
+
+        Str constants of the namespaces were indexed by the analysis of the
+        module, the new constant is added to the index.
+        """
+        scopes = self._str_constant_scopes()
+        new_value = self._unique_str_constant(value, scopes)
+        for scope in scopes:
+            scope.str_constants.add(new_value)
+        self._new_str_constants.append((value, new_value))
+        return new_value
+
     def _patch_constants(self, node):
         copy_builtin_to_constants = self.copy_builtin_to_constants.values()
         patch_constants = {}
@@ -294,32 +561,185 @@ class FunctionOptimizer(NakedOptimizer,
         new_node = replace.replace_func_def(node)
         return (new_node, patch_constants)
 
+    def _is_worth_specializing(self, func_node, new_node):
+        # Cost model: compare the estimated gain per call with the cost of
+        # the guards and the cost of the specialized code in memory
+        min_gain = self.config.min_specialize_gain
+        if min_gain is None:
+            return True
+
+        local_variables = self.local_variables
+        gain = (estimate_cost(func_node.body, local_variables)
+                - estimate_cost(new_node.body, local_variables))
+        guard_cost = get_guard_cost(self.config, count_names(self._guards))
+        memory_cost = get_memory_cost(new_node)
+        if gain - guard_cost - memory_cost >= min_gain:
+            return True
+        self.log(func_node, "don't specialize function %s: estimated gain "
+                 "%.1f ns, guard cost %.1f ns, memory cost %.1f ns",
+                 func_node.name, gain, guard_cost, memory_cost)
+        return False
+
+    def _use_table(self):
+        # Emit the specialization in the table of the module?
+        return (self.parent is self.module
+                and self.module._specializations is not None)
+
     def _specialize(self, func_node, new_node):
         if self.copy_builtin_to_constants:
             new_node, patch_constants = self._patch_constants(new_node)
         else:
             patch_constants = None
 
+        if not self._is_worth_specializing(func_node, new_node):
+            return func_node
+
         self.log(func_node, "specialize function %s, guards: %s",
                  func_node.name, self._guards)
 
         new_body = [func_node]
 
+        if self._use_table() and not _uses_class_cell(new_node):
+            # the module moves the specialization to its table
+            func = SpecializedFunction(new_node.body, self._guards,
+                                       patch_constants)
+            self.module.get_fat_module_name()
+            self.module.specialized += 1
+            new_body.extend(func.to_table_ast(func_node))
+            return new_body
+
         tmp_name = self.parent.new_local_variable('_ast_optimized')
+        self._tmp_name = ('_ast_optimized', tmp_name)
         func = SpecializedFunction(new_node.body, self._guards, patch_constants)
 
         modname = self.module.get_fat_module_name()
+        self.module.specialized += 1
         for node in func.to_ast(modname, func_node, tmp_name):
             copy_lineno(func_node, node)
             new_body.append(node)
 
         return new_body
 
-    def _stage1(self, tree):
+    def _copy_scope(self, tree, new_tree):
+        # Optimizations don't create new variables in the function:
+        # reuse the scope of the original function
+        if new_tree is not tree:
+            self.module._scopes[new_tree] = self.get_scope(tree)
+
+    def _release_scope(self, tree, func_node):
+        # Forget the scope of an intermediate tree of the function to
+        # release the tree as soon as the next version is created
+        if tree is not func_node:
+            self.module._scopes.pop(tree, None)
+
+    def _stage1(self, tree, skip_nodes=None):
         optimizer = FunctionOptimizerStage1.from_parent(self)
-        return optimizer.optimize(tree)
+        optimizer._skip_nodes = skip_nodes
+        new_tree = self._run_sub_optimizer(optimizer, tree)
+        self._copy_scope(tree, new_tree)
+        return new_tree
+
+    def _get_cache_facts(self, func_node, names):
+        # Facts of the enclosing namespaces used by the optimizer for each
+        # name of the function: is it a builtin? which function is inlined?
+        # Local variables of the function are not set yet, but the
+        # function is already indexed by the analysis of the module.
+        self.root = func_node
+        facts = []
+        for name in sorted(names):
+            funcdef = None
+            if self.config.inlining:
+                funcdef = self.find_funcdef(name)
+                if funcdef is not None:
+                    funcdef = ast.dump(funcdef)
+            facts.append((name, self.is_builtin_variable(name), funcdef))
+        if self._use_table():
+            # the entry is only valid in the module namespace
+            facts.append(None)
+        return facts
+
+    def _use_cache_entry(self, entry, func_node):
+        # Check that names created in the parent namespace are the same
+        scopes = self._str_constant_scopes()
+        new_values = set()
+        for value, new_value in entry.str_constants:
+            if self._unique_str_constant(value, scopes,
+                                         new_values) != new_value:
+                return None
+            new_values.add(new_value)
+        if entry.tmp_name is not None:
+            name, tmp_name = entry.tmp_name
+            if self.parent.new_local_variable(name) != tmp_name:
+                return None
+        if isinstance(entry.tree, list):
+            # the function was specialized
+            self.module.get_fat_module_name()
+            self.module.specialized += 1
+
+        for scope in scopes:
+            scope.str_constants |= new_values
+        return entry.get_tree(func_node)
+
+    def _optimize_cached(self, cache, func_node):
+        data, names = dump_function(func_node)
+        facts = self._get_cache_facts(func_node, names)
+        key = cache.get_key(data, self.module.get_config_fingerprint(),
+                            facts)
+        entry = cache.load(key)
+        if entry is not None:
+            new_node = self._use_cache_entry(entry, func_node)
+            if new_node is not None:
+                cache.add_lookup(True)
+                self.log(func_node, "reuse cached optimization of function %s",
+                         func_node.name)
+                return new_node
+
+        cache.add_lookup(False)
+        new_node = self._optimize_function(func_node)
+        if self.deadline_exceeded:
+            # don't store a partially optimized function
+            return new_node
+        tree = new_node if new_node is not func_node else None
+        entry = CacheEntry(func_node.lineno, tree,
+                           self._new_str_constants, self._tmp_name)
+        try:
+            cache.store(key, entry)
+        except OSError as exc:
+            self.log(func_node, "failed to store function %s in the cache: %s",
+                     func_node.name, exc)
+        return new_node
 
     def optimize(self, func_node):
+        max_nodes = self.config.max_function_nodes
+        if max_nodes is not None:
+            node_count = self.get_scope(func_node).node_count
+            if node_count > max_nodes:
+                self._cutoff(func_node,
+                             "skip optimisation of function %s: "
+                             "%s nodes > max_function_nodes (%s)",
+                             func_node.name, node_count, max_nodes)
+                return func_node
+
+        max_time = self.config.max_function_time
+        if max_time is not None:
+            deadline = time.perf_counter() + max_time
+            if self._deadline is None or deadline < self._deadline:
+                self._deadline = deadline
+
+        cache = self.config.function_cache
+        if cache is not None and self.funcdef_depth == 1:
+            new_node = self._optimize_cached(cache, func_node)
+        else:
+            new_node = self._optimize_function(func_node)
+
+        if self.deadline_exceeded:
+            self._cutoff(func_node,
+                         "stop optimisation of function %s: "
+                         "time budget exceeded", func_node.name)
+        return new_node
+
+    def _optimize_function(self, func_node):
+        body = func_node.body
         func_node = self._stage1(func_node)
 
         if func_node.decorator_list:
@@ -334,12 +754,43 @@ class FunctionOptimizer(NakedOptimizer,
                      "on nested function")
             return func_node
 
-        new_node = super().optimize(func_node)
-
-        if self._guards:
-            # calling pure functions, replacing range(n) with a tuple, etc.
-            # can allow new optimizations with the stage 1
-            new_node = self._stage1(new_node)
+        # Optimize again the function while it is modified. Each stage
+        # only optimizes again the statements of the body modified since
+        # its previous run, and the statements using their names.
+        new_node = func_node
+        # (statements left unchanged, body) of the previous run of a stage
+        stage1 = (set(body).intersection(new_node.body), new_node.body)
+        stage2 = None
+        stmt_names = {}
+        passes = 1
+        while True:
+            if stage2 is not None:
+                self._skip_nodes = _get_skip_nodes(new_node.body, *stage2,
+                                                   stmt_names)
+            try:
+                tree = super().optimize(new_node)
+            finally:
+                self._skip_nodes = None
+            if tree is new_node:
+                # fixed point reached
+                break
+            stage2 = (set(new_node.body).intersection(tree.body), tree.body)
+            self._copy_scope(new_node, tree)
+            self._release_scope(new_node, func_node)
+            new_node = tree
+            if passes >= self.config.max_passes or self.deadline_exceeded:
+                break
+            passes += 1
+
+            # calling pure functions, replacing range(n) with a tuple,
+            # inlining, etc. can allow new optimizations with the stage 1
+            skip_nodes = _get_skip_nodes(new_node.body, *stage1, stmt_names)
+            tree = self._stage1(new_node, skip_nodes)
+            if tree is new_node:
+                break
+            stage1 = (set(new_node.body).intersection(tree.body), tree.body)
+            self._release_scope(new_node, func_node)
+            new_node = tree
 
         if self.copy_builtin_to_constants or self._guards:
             new_node = self._specialize(func_node, new_node)
@@ -353,6 +804,22 @@ class ModuleOptimizer(Optimizer):
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
         self._fat_module = None
+        self._config_fingerprint = None
+        # number of specialized functions
+        self.specialized = 0
+        # name of the fatoptimizer.lazy module if a function is optimized
+        # lazily, or None
+        self._lazy_module = None
+        # list of (FunctionDef, specialized FunctionDef, entry) of the table
+        # of specialized functions, or None if the table is not used
+        self._specializations = None
+        # number of optimizations stopped by a budget
+        self.cutoffs = 0
+
+    def get_config_fingerprint(self):
+        if self._config_fingerprint is None:
+            self._config_fingerprint = self.config.fingerprint()
+        return self._config_fingerprint
 
     def get_fat_module_name(self):
         if not self._fat_module:
@@ -369,6 +836,9 @@ class ModuleOptimizer(Optimizer):
         # Replace the configuration
         # Note: unknown configuration options are ignored
         self.config = self.config.replace(config)
+        self._use_config(self.config)
+        self.max_revisits = self.config.max_passes
+        self._config_fingerprint = None
 
     def _find_config(self, body):
         # FIXME: only search in the N first statements?
@@ -381,20 +851,210 @@ class ModuleOptimizer(Optimizer):
                 self._replace_config(node.value)
 
     def optimize(self, tree):
-        orig_tree = tree
+        profiler = self._profiler
+        if profiler is None:
+            return self._optimize_module(tree)
 
-        tree = ConvertConstant(self.filename).visit(tree)
+        start = time.perf_counter()
+        try:
+            return self._optimize_module(tree)
+        finally:
+            profiler.add_module(time.perf_counter() - start)
+
+    def _analyze(self, tree):
+        # Convert constants and analyze all namespaces in a single pass.
+        # Return the converted tree, or None if the module is not optimized.
+        analysis = ScopeAnalysis(self.filename)
+        tree = analysis.analyze(tree)
+        self._scopes = analysis.scopes
 
         if isinstance(tree, ast.Module):
             self._find_config(tree.body)
             if not self.config.enabled:
                 self.log(tree,
                          "skip optimisation: disabled in __fatoptimizer__")
-                return orig_tree
+                return None
+
+        max_nodes = self.config.max_module_nodes
+        if max_nodes is not None:
+            node_count = self._scopes[tree].node_count
+            if node_count > max_nodes:
+                self._cutoff(tree,
+                             "skip optimisation: %s nodes > "
+                             "max_module_nodes (%s)", node_count, max_nodes)
+                return None
+        return tree
+
+    def analyze(self, tree):
+        """Analyze a module to optimize its functions later using
+        optimize_function().
+
+        Return the converted tree, or None if the module is not optimized.
+        """
+        tree = self._analyze(tree)
+        if tree is None or not self._enter_scope(tree):
+            return None
+        self._node_kinds = scan_node_kinds(tree)
+        return tree
+
+    def optimize_function(self, func_node):
+        """Optimize a function defined at the module level of the tree
+        returned by analyze().
+
+        Return a FunctionDef node, or a list of statements if the function
+        is specialized.
+        """
+        return super().fullvisit_FunctionDef(func_node)
+
+    def fullvisit_FunctionDef(self, node):
+        config = self.config
+        lazy = (config.lazy_specialization is not None
+                or config.background_specialization is not None)
+        if not lazy or node.decorator_list:
+            new_node = super().fullvisit_FunctionDef(node)
+            # [func, specialized func, entry] list of a table entry,
+            # the other specializations start with an assignment
+            if (self._specializations is not None
+               and isinstance(new_node, list)
+               and isinstance(new_node[1], ast.FunctionDef)):
+                new_node = self._add_specialization(*new_node)
+            return new_node
+
+        # def func(...): ...
+        # __fat_lazy__.lazy(func, ncalls, checksum, fingerprint)
+        #
+        # or "__fat_lazy__.background(func, checksum, fingerprint)": the
+        # function is optimized by fatoptimizer.lazy when it is called, or by
+        # a background thread, with the configuration identified by
+        # fingerprint
+        fingerprint = self.get_config_fingerprint()
+        if self._lazy_module is None:
+            self._lazy_module = self.new_local_variable('__fat_lazy__')
+            _register_config(config, fingerprint)
+        args = [ast.Name(id=node.name, ctx=ast.Load())]
+        if config.background_specialization is not None:
+            attr = 'background'
+        else:
+            attr = 'lazy'
+            args.append(_new_constant(node, config.lazy_specialization))
+        args.append(_new_constant(node, get_checksum(node)))
+        args.append(_new_constant(node, fingerprint))
+        func = ast.Attribute(value=ast.Name(id=self._lazy_module,
+                                            ctx=ast.Load()),
+                             attr=attr, ctx=ast.Load())
+        call = ast.Expr(value=Call(func=func, args=args, keywords=[]))
+        copy_lineno(node, call)
+        return [node, call]
+
+    def _add_specialization(self, func_node, func2, entry):
+        # Move the specialized function func2 to the table
+        self._specializations.append((func_node, func2, entry.value.value))
+        return func_node
+
+    def _add_specialization_table(self, tree):
+        # def __fat_table__():
+        #     class ___:
+        #         def func(...): ...
+        #         def func2(...): ...
+        # __fat_runtime__.specialize_table(__fat__, __fat_table__, entries)
+        # del __fat_table__
+        #
+        # __fat_table__() is never called: specialize_table() gets the code
+        # of specialized functions from its constants. Functions are
+        # defined in a class body to keep their name without creating
+        # closures. Statements are inserted after the last specialized
+        # function.
+        funcdefs = set()
+        keys = set()
+        entries = []
+        table_body = []
+        for func_node, func2, entry in self._specializations:
+            funcdefs.add(id(func_node))
+            key = (func_node.name, func_node.lineno)
+            if key in keys:
+                # function duplicated by loop unrolling
+                continue
+            keys.add(key)
+            entries.append(entry)
+            table_body.append(func2)
+        node = self._specializations[-1][0]
+
+        body = tree.body
+        index = len(body)
+        while index > 0:
+            nodes = ast.walk(body[index - 1])
+            if any(id(child) in funcdefs for child in nodes):
+                break
+            index -= 1
+        else:
+            index = len(body)
+
+        # no name mangling in a class made of underscores
+        names = {child.id for func2 in table_body
+                 for child in ast.walk(func2) if isinstance(child, ast.Name)}
+        class_name = '___'
+        while class_name in names:
+            class_name += '_'
+        class_def = ast.ClassDef(name=class_name, bases=[], keywords=[],
+                                 body=table_body, decorator_list=[])
+
+        name = self.new_local_variable('__fat_table__')
+        args = ast.arguments(posonlyargs=[], args=[], vararg=None,
+                             kwonlyargs=[], kw_defaults=[], kwarg=None,
+                             defaults=[])
+        table = ast.FunctionDef(name=name, args=args, body=[class_def],
+                                decorator_list=[], returns=None)
+
+        runtime_name = self.new_local_variable('__fat_runtime__')
+        func = ast.Attribute(value=ast.Name(id=runtime_name, ctx=ast.Load()),
+                             attr='specialize_table', ctx=ast.Load())
+        args = [ast.Name(id=self.get_fat_module_name(), ctx=ast.Load()),
+                ast.Name(id=name, ctx=ast.Load()),
+                ast.Constant(value=tuple(entries))]
+        call = ast.Expr(value=Call(func=func, args=args, keywords=[]))
+        delete = ast.Delete(targets=[ast.Name(id=name, ctx=ast.Del())])
+
+        new_nodes = [table, call, delete]
+        for new_node in new_nodes:
+            copy_lineno(node, new_node)
+        copy_lineno(node, class_def)
+        body[index:index] = new_nodes
+        add_runtime_import(tree, runtime_name)
+
+    def _optimize_module(self, tree):
+        orig_tree = tree
+        start = time.perf_counter()
+
+        tree = self._analyze(tree)
+        if tree is None:
+            return orig_tree
+
+        max_time = self.config.max_module_time
+        if max_time is not None:
+            self._deadline = start + max_time
+
+        # Tag subtrees with their node kinds to skip subtrees without any
+        # node that optimizers can modify
+        self._node_kinds = scan_node_kinds(tree)
+
+        if self.config.specialization_table and isinstance(tree, ast.Module):
+            self._specializations = []
 
         tree = super().optimize(tree)
+        if self.deadline_exceeded:
+            self._cutoff(tree, "stop optimisation: time budget exceeded")
+
+        # Release the analysis and the node kinds which keep the trees
+        # before optimization alive while the new tree is compiled
+        self._scopes = {}
+        self._node_kinds = None
 
+        if self._specializations:
+            self._add_specialization_table(tree)
+        self._specializations = None
         if self._fat_module:
-            add_import(tree, 'fat', self._fat_module)
+            add_fat_import(tree, self._fat_module)
+        if self._lazy_module:
+            add_lazy_import(tree, self._lazy_module)
 
         return tree
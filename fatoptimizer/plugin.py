@@ -0,0 +1,212 @@
+"""
+Registration of optimizer steps of third-party packages.
+"""
+
+import threading
+
+from .tools import OptimizerStep
+
+
+# Stages of the optimizer:
+# - STAGE1: optimizations of all namespaces, run before the specialization
+# - SPECIALIZE: optimizations of functions which may create a specialized
+#   function with guards
+STAGE1 = 'stage1'
+SPECIALIZE = 'specialize'
+_STAGES = (STAGE1, SPECIALIZE)
+
+
+class StepRegistration:
+    def __init__(self, step, stage, before, after, options):
+        self.step = step
+        self.stage = stage
+        # names of the steps which must run after and before the step
+        self.before = before
+        self.after = after
+        # mapping: Config option name => default value
+        self.options = options
+
+
+# Registries are replaced, not modified, so they can be read without lock
+_lock = threading.Lock()
+# list of StepRegistration in the registration order
+_registrations = []
+# mapping: option name => default value of the options of registered steps
+_options = {}
+# mapping: optimizer class => class composed with the registered steps
+_composed = {}
+
+
+def _get_step_name(step):
+    if isinstance(step, str):
+        return step
+    return step.__name__
+
+
+def _get_optimizer_class(stage):
+    from .optimizer import Optimizer, FunctionOptimizer
+
+    if stage == STAGE1:
+        return Optimizer
+    else:
+        return FunctionOptimizer
+
+
+def _get_step_names(cls):
+    # mapping: class name => step of the optimizer class cls. Subclasses of
+    # steps are accepted, ex: SimplifyIterable for BaseSimplifyIterable.
+    names = {}
+    for base in cls.__mro__:
+        for step in cls._steps:
+            if issubclass(base, step):
+                names[base.__name__] = step
+                break
+    return names
+
+
+def _order_steps(cls, registrations):
+    """Get the steps of the optimizer class cls and of registrations in the
+    order of the visitors.
+
+    Built-in steps keep their order. A step without ordering constraints
+    runs after built-in steps. Raise a ValueError if a step is unknown or if
+    constraints are inconsistent.
+    """
+    builtin_steps = cls._steps
+    steps = list(builtin_steps) + [reg.step for reg in registrations]
+    names = _get_step_names(cls)
+    names.update((reg.step.__name__, reg.step) for reg in registrations)
+
+    def get_step(name):
+        try:
+            return names[name]
+        except KeyError:
+            raise ValueError("unknown optimizer step: %r" % name) from None
+
+    # mapping: step => steps which must run before
+    previous = {step: set() for step in steps}
+    for step, next_step in zip(builtin_steps, builtin_steps[1:]):
+        previous[next_step].add(step)
+    for reg in registrations:
+        for name in reg.after:
+            previous[reg.step].add(get_step(name))
+        for name in reg.before:
+            previous[get_step(name)].add(reg.step)
+
+    order = []
+    while steps:
+        for step in steps:
+            if previous[step].issubset(order):
+                break
+        else:
+            raise ValueError("inconsistent ordering constraints "
+                             "between optimizer steps: %s"
+                             % ', '.join(step.__name__ for step in steps))
+        order.append(step)
+        steps.remove(step)
+    return order
+
+
+def register_step(step, stage=STAGE1, *, before=(), after=(), options=None):
+    """Register an optimizer step.
+
+    step is a direct subclass of OptimizerStep. stage is STAGE1 or
+    SPECIALIZE. before and after are steps (classes or class names) which
+    must run after and before the step. options is a mapping of the Config
+    options used by the step: option name => default value.
+    """
+    from .config import Config
+
+    if not isinstance(step, type) or OptimizerStep not in step.__bases__:
+        raise TypeError("step must be a direct subclass of OptimizerStep")
+    if stage not in _STAGES:
+        raise ValueError("unknown stage: %r" % (stage,))
+    options = dict(options) if options else {}
+    before = tuple(_get_step_name(name) for name in before)
+    after = tuple(_get_step_name(name) for name in after)
+
+    with _lock:
+        for name in options:
+            if not name.isidentifier() or name.startswith('_'):
+                raise ValueError("invalid option name: %r" % (name,))
+            if name in Config._attributes or name in _options:
+                raise ValueError("option %r already exists" % name)
+        option = step.config_option
+        if (option is not None and option not in options
+           and option not in Config._attributes and option not in _options):
+            raise ValueError("unknown config option %r of the step %s"
+                             % (option, step.__name__))
+
+        cls = _get_optimizer_class(stage)
+        for reg in _registrations:
+            if reg.step is step:
+                raise ValueError("step %s is already registered"
+                                 % step.__name__)
+        names = set(_get_step_names(cls))
+        names.update(reg.step.__name__ for reg in _registrations)
+        if step.__name__ in names:
+            raise ValueError("a step called %s already exists"
+                             % step.__name__)
+
+        registration = StepRegistration(step, stage, before, after, options)
+        registrations = _registrations + [registration]
+        # check the ordering constraints
+        _order_steps(cls, [reg for reg in registrations if reg.stage == stage])
+        _update(registrations)
+
+
+def unregister_step(step):
+    """Unregister an optimizer step registered by register_step()."""
+    with _lock:
+        registrations = [reg for reg in _registrations if reg.step is not step]
+        if len(registrations) == len(_registrations):
+            raise ValueError("step %s is not registered" % step.__name__)
+        _update(registrations)
+
+
+def _update(registrations):
+    global _registrations, _options, _composed
+
+    options = {}
+    for reg in registrations:
+        options.update(reg.options)
+    _registrations = registrations
+    _options = options
+    _composed = {}
+
+
+def get_registrations():
+    """Get the list of registered steps: list of StepRegistration."""
+    return list(_registrations)
+
+
+def get_options():
+    """Get the options of registered steps: mapping name => default value."""
+    return _options
+
+
+def compose_optimizer(cls):
+    """Get the optimizer class cls composed with the steps registered for
+    its stage.
+
+    Return cls if no step is registered for its stage.
+    """
+    composed = _composed
+    try:
+        return composed[cls]
+    except KeyError:
+        pass
+
+    registrations = [reg for reg in _registrations if reg.stage == cls._stage]
+    if not registrations or '_step_order' in cls.__dict__:
+        new_cls = cls
+    else:
+        steps = _order_steps(cls, registrations)
+        namespace = {'__module__': cls.__module__,
+                     '__qualname__': cls.__qualname__,
+                     '__doc__': cls.__doc__,
+                     '_step_order': tuple(steps)}
+        bases = (cls,) + tuple(reg.step for reg in registrations)
+        new_cls = type(cls)(cls.__name__, bases, namespace)
+    # another thread may have composed the class in the meanwhile
+    return composed.setdefault(cls, new_cls)
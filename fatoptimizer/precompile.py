@@ -0,0 +1,236 @@
+"""
+Optimize Python modules and write optimized bytecode files, in parallel.
+"""
+
+import ast
+import concurrent.futures
+import importlib
+import importlib.util
+import marshal
+import os
+import sys
+import tempfile
+import time
+import tokenize
+import traceback
+import warnings
+
+from .optimizer import ModuleOptimizer
+from .plugin import compose_optimizer
+
+
+class CompileResult:
+    def __init__(self, filename, bytecode_filename):
+        self.filename = filename
+        self.bytecode_filename = bytecode_filename
+        # time in seconds to optimize and compile the module
+        self.time = 0.0
+        # number of specialized functions
+        self.specialized = 0
+        # number of optimizations stopped by a budget
+        self.cutoffs = 0
+        # True if the bytecode file was already up to date
+        self.skipped = False
+        # error message if the module failed to be compiled, or None
+        self.error = None
+
+
+def find_sources(paths):
+    """Find Python modules: yield filenames of .py files.
+
+    Directories are walked recursively, except of __pycache__.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if name != '__pycache__')
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    yield os.path.join(root, name)
+
+
+def get_optim_tag(config):
+    """Get the optimization tag of bytecode files of modules optimized
+    with config.
+
+    The tag depends on the version of fatoptimizer, the configuration
+    and the -O command line option:
+    'mod.py' => '__pycache__/mod.cpython-36.opt-fat03a1b2c3d4e5f6a7b8.pyc'.
+    """
+    from . import __version__
+
+    tag = 'fat%s%s' % (__version__.replace('.', ''),
+                       config.fingerprint()[:16])
+    if sys.flags.optimize:
+        # assertions and docstrings removed by the -O option
+        tag += 'o%s' % sys.flags.optimize
+    return tag
+
+
+def get_bytecode_filename(filename, optim_tag):
+    return importlib.util.cache_from_source(filename, optimization=optim_tag)
+
+
+def _get_header(st):
+    # PEP 552 header of a timestamp-based bytecode file
+    mtime = int(st.st_mtime) & 0xFFFFFFFF
+    size = st.st_size & 0xFFFFFFFF
+    return (importlib.util.MAGIC_NUMBER
+            + (0).to_bytes(4, 'little')
+            + mtime.to_bytes(4, 'little')
+            + size.to_bytes(4, 'little'))
+
+
+def is_up_to_date(filename, bytecode_filename):
+    try:
+        st = os.stat(filename)
+        with open(bytecode_filename, 'rb') as fp:
+            header = fp.read(16)
+    except OSError:
+        return False
+    return header == _get_header(st)
+
+
+def read_bytecode(bytecode_filename, st):
+    """Read the code of a bytecode file.
+
+    st is the result of os.stat() on the source file. Return None if the
+    bytecode file doesn't exist or is not up to date.
+    """
+    try:
+        with open(bytecode_filename, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return None
+    if data[:16] != _get_header(st):
+        return None
+    try:
+        return marshal.loads(data[16:])
+    except (EOFError, ValueError, TypeError):
+        # truncated or corrupted file
+        return None
+
+
+def write_bytecode(code, bytecode_filename, st):
+    data = _get_header(st) + marshal.dumps(code)
+
+    directory = os.path.dirname(bytecode_filename)
+    os.makedirs(directory, exist_ok=True)
+
+    # Write into a temporary file and then rename it to not expose
+    # an incomplete file to importers
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='tmp',
+                                        suffix='.tmp')
+    try:
+        with open(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_filename, bytecode_filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def fix_locations(tree):
+    # Nodes created by the optimizer don't have end positions, or get
+    # end positions before their start position from copy_lineno()
+    ast.fix_missing_locations(tree)
+    for node in ast.walk(tree):
+        if 'end_lineno' not in node._attributes:
+            continue
+        if node.end_lineno is None or node.end_col_offset is None:
+            continue
+        if (node.end_lineno, node.end_col_offset) < (node.lineno,
+                                                     node.col_offset):
+            node.end_lineno = None
+            node.end_col_offset = None
+
+
+def compile_file(filename, config, optim_tag=None, force=False):
+    """Optimize a module and write its optimized bytecode file.
+
+    Use get_optim_tag(config) if optim_tag is None. Return a CompileResult.
+    Errors are reported in the error attribute of the result.
+    """
+    if optim_tag is None:
+        optim_tag = get_optim_tag(config)
+    bytecode_filename = get_bytecode_filename(filename, optim_tag)
+    result = CompileResult(filename, bytecode_filename)
+    if not force and is_up_to_date(filename, bytecode_filename):
+        result.skipped = True
+        return result
+
+    try:
+        st = os.stat(filename)
+        with tokenize.open(filename) as fp:
+            source = fp.read()
+
+        start = time.perf_counter()
+        with warnings.catch_warnings():
+            # ignore warnings like invalid escape sequences
+            warnings.simplefilter('ignore')
+            tree = ast.parse(source, filename)
+
+            optimizer = compose_optimizer(ModuleOptimizer)(config, filename)
+            tree = optimizer.optimize(tree)
+            fix_locations(tree)
+            code = compile(tree, filename, 'exec', dont_inherit=True)
+        result.time = time.perf_counter() - start
+        result.specialized = optimizer.specialized
+        result.cutoffs = optimizer.cutoffs
+
+        write_bytecode(code, bytecode_filename, st)
+    except (SyntaxError, UnicodeDecodeError) as exc:
+        result.error = '%s: %s' % (type(exc).__name__, exc)
+    except Exception:
+        result.error = traceback.format_exc().rstrip()
+    return result
+
+
+# Configuration of worker processes, set by _init_worker()
+_worker_config = None
+
+
+def _init_worker(config, plugins):
+    global _worker_config
+    # import modules registering optimizer steps
+    for name in plugins:
+        importlib.import_module(name)
+    _worker_config = config
+
+
+def _compile_file_worker(filename, optim_tag, force):
+    return compile_file(filename, _worker_config, optim_tag, force)
+
+
+def compile_files(filenames, config, workers=None, optim_tag=None,
+                  force=False, plugins=()):
+    """Optimize and compile modules in a pool of worker processes.
+
+    Yield CompileResult objects in the order of filenames. workers is the
+    number of worker processes: use the number of CPUs if workers is None.
+    Run in the current process if workers is 1. plugins is a list of names
+    of modules registering optimizer steps, imported by worker processes.
+    Use get_optim_tag(config) if optim_tag is None.
+    """
+    if optim_tag is None:
+        optim_tag = get_optim_tag(config)
+    if workers == 1:
+        for filename in filenames:
+            yield compile_file(filename, config, optim_tag, force)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(config, tuple(plugins))) as executor:
+        futures = [executor.submit(_compile_file_worker,
+                                   filename, optim_tag, force)
+                   for filename in filenames]
+        for future in futures:
+            yield future.result()
@@ -0,0 +1,120 @@
+"""
+Profiler of the optimizer steps.
+"""
+
+import threading
+import time
+
+
+class VisitorStats:
+    def __init__(self):
+        # number of calls
+        self.calls = 0
+        # number of calls which replaced the visited node
+        self.replacements = 0
+        # total time in seconds, including nested calls
+        self.time = 0.0
+        # time in seconds, excluding nested visitor calls
+        self.self_time = 0.0
+
+    def add(self, stats):
+        self.calls += stats.calls
+        self.replacements += stats.replacements
+        self.time += stats.time
+        self.self_time += stats.self_time
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'replacements': self.replacements,
+                'time': self.time,
+                'self_time': self.self_time}
+
+
+class Profiler:
+    """Record the wall time, the number of calls and the number of node
+    replacements of each visitor method.
+
+    Statistics are aggregated across modules: set the same Profiler to the
+    profiler attribute of all configurations. Modules can be optimized in
+    parallel by multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # number of optimized modules
+        self.modules = 0
+        # total time in seconds spent to optimize modules
+        self.time = 0.0
+        # mapping: visitor qualified name => VisitorStats
+        self._visitors = {}
+        # per thread: stack of the time spent in nested visitor calls
+        self._local = threading.local()
+
+    def add_module(self, dt):
+        with self._lock:
+            self.modules += 1
+            self.time += dt
+
+    def call_visitor(self, visitor, optimizer, node):
+        try:
+            nested_time = self._local.nested_time
+        except AttributeError:
+            nested_time = self._local.nested_time = []
+        nested_time.append(0.0)
+        new_node = None
+        start = time.perf_counter()
+        try:
+            new_node = visitor(optimizer, node)
+        finally:
+            dt = time.perf_counter() - start
+            child_dt = nested_time.pop()
+            if nested_time:
+                nested_time[-1] += dt
+
+            name = visitor.__qualname__
+            with self._lock:
+                try:
+                    stats = self._visitors[name]
+                except KeyError:
+                    stats = self._visitors[name] = VisitorStats()
+                stats.calls += 1
+                stats.time += dt
+                stats.self_time += dt - child_dt
+                if new_node is not None and new_node is not node:
+                    stats.replacements += 1
+        return new_node
+
+    def get_steps(self):
+        """Get statistics per optimizer step.
+
+        Return a mapping: step name => VisitorStats.
+        """
+        steps = {}
+        with self._lock:
+            visitors = list(self._visitors.items())
+        for name, stats in visitors:
+            step = name.split('.', 1)[0]
+            try:
+                step_stats = steps[step]
+            except KeyError:
+                step_stats = steps[step] = VisitorStats()
+            step_stats.add(stats)
+        return steps
+
+    def as_dict(self):
+        steps = self.get_steps()
+        with self._lock:
+            visitors = {name: stats.as_dict()
+                        for name, stats in self._visitors.items()}
+            return {'modules': self.modules,
+                    'time': self.time,
+                    'steps': {name: stats.as_dict()
+                              for name, stats in steps.items()},
+                    'visitors': visitors}
+
+    def to_json(self, indent=2):
+        import json
+        return json.dumps(self.as_dict(), indent=indent, sort_keys=True)
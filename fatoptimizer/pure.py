@@ -2,7 +2,11 @@ from .tools import UNSET, get_literal, get_keywords
 
 
 class PureFunction:
-    def __init__(self, func, name, narg, *arg_types, check_args=None, exceptions=None):
+    __slots__ = ('func', 'name', 'min_narg', 'max_narg', 'arg_types',
+                 '_check_args_cb', '_check_config_cb', 'exceptions')
+
+    def __init__(self, func, name, narg, *arg_types, check_args=None,
+                 check_config=None, exceptions=None):
         self.func = func
         self.name = name
         if isinstance(narg, tuple):
@@ -21,6 +25,8 @@ class PureFunction:
         if self.max_narg is not None and len(self.arg_types) > self.max_narg:
             raise ValueError("too many argument types")
         self._check_args_cb = check_args
+        # callback(config, args) for checks depending on the configuration
+        self._check_config_cb = check_config
         self.exceptions = exceptions
 
     def check_nargs(self, nargs):
@@ -30,12 +36,15 @@ class PureFunction:
             return False
         return True
 
-    def _check_args(self, args):
+    def _check_args(self, args, config):
         if not self.check_nargs(len(args)):
             return False
         if self._check_args_cb is not None:
             if not self._check_args_cb(args):
                 return False
+        if self._check_config_cb is not None:
+            if not self._check_config_cb(config, args):
+                return False
         return True
 
     def get_args(self, node):
@@ -58,30 +67,20 @@ class PureFunction:
             values.append(value)
         return values
 
-    def _call(self, obj, node):
+    def get_call_args(self, obj, node, config):
+        """Get the arguments to call the function.
+
+        obj is the object of a method call, passed as the first argument,
+        or UNSET for a function call. Return a list of constants, or None
+        if the call cannot be evaluated.
+        """
         args = self.get_args(node)
         if args is None:
-            return UNSET
-
-        if not self._check_args(args):
-            return UNSET
-
-        try:
-            if obj is not UNSET:
-                result = self.func(obj, *args)
-            else:
-                result = self.func(*args)
-        except Exception as exc:
-            if (self.exceptions is not None
-               and isinstance(exc, self.exceptions)):
-                result = UNSET
-            else:
-                raise
-
-        return result
+            return None
 
-    def call_func(self, node):
-        return self._call(UNSET, node)
+        if not self._check_args(args, config):
+            return None
 
-    def call_method(self, obj, node):
-        return self._call(obj, node)
+        if obj is not UNSET:
+            args.insert(0, obj)
+        return args
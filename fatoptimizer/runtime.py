@@ -0,0 +1,337 @@
+"""
+Pure-Python implementation of the fat module API used by optimized code.
+
+Optimized modules use it if the fat module is missing, for example on
+Python without PEP 509 and PEP 510. Only the guards emitted by fatoptimizer
+are implemented.
+
+Python functions cannot have specialized codes: specialize() replaces the
+code of the function with a dispatcher, a code with the same parameters
+which checks the guards and then calls the specialized function. When a
+guard fails, the original code of the function is restored.
+"""
+
+import builtins
+import types
+import weakref
+
+
+# Copy of the builtins dict when the module was imported
+_BUILTINS = builtins.__dict__.copy()
+
+# Flags of code objects of generators and coroutines: calling the function
+# must not run the dispatcher
+_GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200
+
+# mapping: function => (code, guards) of its specialized code
+_specialized = weakref.WeakKeyDictionary()
+
+
+def replace_consts(code, mapping):
+    """Create a copy of the code object with replaced constants."""
+    consts = tuple(mapping.get(const, const) for const in code.co_consts)
+    return code.replace(co_consts=consts)
+
+
+class GuardBuiltins:
+    """Watch for builtins and global variables called names.
+
+    The guard fails if a global variable called name is created, or if the
+    builtin called name is replaced.
+    """
+
+    def __init__(self, *names):
+        for name in names:
+            if not isinstance(name, str):
+                raise TypeError("name must be a str, not %s"
+                                % type(name).__name__)
+        self.names = names
+
+    def __repr__(self):
+        return '<%s names=%r>' % (self.__class__.__name__, self.names)
+
+
+# Flags of code objects with *args and **kwargs parameters
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+# mapping: (signature, names) => code of the dispatcher
+_dispatchers = {}
+
+
+def _get_signature(code):
+    # Get the parameters of a code object: (positional-only, positional,
+    # *args or None, keyword-only, **kwargs or None)
+    names = code.co_varnames
+    nposonly = code.co_posonlyargcount
+    nargs = code.co_argcount
+    nkwonly = code.co_kwonlyargcount
+    index = nargs + nkwonly
+    varargs = varkw = None
+    if code.co_flags & _CO_VARARGS:
+        varargs = names[index]
+        index += 1
+    if code.co_flags & _CO_VARKEYWORDS:
+        varkw = names[index]
+    return (names[:nposonly], names[nposonly:nargs], varargs,
+            names[nargs:nargs + nkwonly], varkw)
+
+
+def _format_signature(signature):
+    # Format the parameters of a signature and the arguments to pass them
+    # to a function with the same signature: ('x, *, y', 'x, y=y')
+    posonly, args, varargs, kwonly, varkw = signature
+    params = list(posonly)
+    if posonly:
+        params.append('/')
+    params.extend(args)
+    if varargs:
+        params.append('*' + varargs)
+    elif kwonly:
+        params.append('*')
+    params.extend(kwonly)
+    if varkw:
+        params.append('**' + varkw)
+
+    call_args = list(posonly) + list(args)
+    if varargs:
+        call_args.append('*' + varargs)
+    call_args.extend('%s=%s' % (name, name) for name in kwonly)
+    if varkw:
+        call_args.append('**' + varkw)
+    return (', '.join(params), ', '.join(call_args))
+
+
+def _compile_function(source, filename):
+    # Compile the source of a function: return the code of the function
+    code = compile(source, filename, 'exec', dont_inherit=True)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            return const
+    raise ValueError("no function in the code")
+
+
+def _create_dispatcher(signature, names):
+    # Generated code for a function 'def func(x, *, y)' and a guard on len:
+    #
+    #   def func(x, *, y):
+    #       _fat_specialized, _fat_fallback, _fat_value0, = "__fat_state__"
+    #       if len is _fat_value0:
+    #           return _fat_specialized(x, y=y)
+    #       return _fat_fallback(x, y=y)
+    #
+    # "__fat_state__" is replaced with the state of the function. Loading
+    # the builtins checks that they are not replaced or shadowed by global
+    # variables: LOAD_GLOBAL is fast thanks to the cache of the interpreter.
+    params, call_args = _format_signature(signature)
+    state = ['_fat_specialized', '_fat_fallback']
+    state.extend('_fat_value%s' % index for index in range(len(names)))
+    check = ' and '.join('%s is _fat_value%s' % (name, index)
+                         for index, name in enumerate(names))
+    source = ('def _fat_dispatcher(%s):\n'
+              '    %s, = "__fat_state__"\n'
+              '    if %s:\n'
+              '        return _fat_specialized(%s)\n'
+              '    return _fat_fallback(%s)\n'
+              % (params, ', '.join(state), check, call_args, call_args))
+    return _compile_function(source, __file__)
+
+
+def _get_params(signature):
+    # Get the set of the parameter names of a signature
+    posonly, args, varargs, kwonly, varkw = signature
+    params = set(posonly + args + kwonly)
+    params.update(name for name in (varargs, varkw) if name)
+    return params
+
+
+def _get_dispatcher(code, names):
+    signature = _get_signature(code)
+    key = (signature, names)
+    try:
+        return _dispatchers[key]
+    except KeyError:
+        pass
+
+    params = _get_params(signature)
+    if (params.intersection(names)
+       or any(name.startswith('_fat_') for name in params.union(names))):
+        # a parameter shadows a builtin or a variable of the dispatcher
+        dispatcher = None
+    else:
+        try:
+            dispatcher = _create_dispatcher(signature, names)
+        except SyntaxError:
+            # invalid builtin name like __debug__
+            dispatcher = None
+    _dispatchers[key] = dispatcher
+    return dispatcher
+
+
+def _rename_code(code, orig_code):
+    # Copy the name of orig_code to code, co_qualname was added to Python
+    # 3.11
+    if hasattr(orig_code, 'co_qualname'):
+        return code.replace(co_name=orig_code.co_name,
+                            co_qualname=orig_code.co_qualname)
+    return code.replace(co_name=orig_code.co_name)
+
+
+def _copy_func(func, code):
+    new_func = types.FunctionType(code, func.__globals__, func.__name__,
+                                  func.__defaults__, func.__closure__)
+    new_func.__kwdefaults__ = func.__kwdefaults__
+    new_func.__qualname__ = func.__qualname__
+    return new_func
+
+
+class _Specialization:
+    def __init__(self, func, code, guards):
+        self.func = func
+        self.code = code
+        self.guards = guards
+        self.orig_code = func.__code__
+
+    def fallback(self, *args, **kwargs):
+        # The guards failed: the builtins or the global variables were
+        # modified. Remove the specialization.
+        func = self.func
+        if func.__code__ is self.dispatcher_code:
+            func.__code__ = self.orig_code
+        _specialized.pop(func, None)
+        return func(*args, **kwargs)
+
+    def install(self):
+        func = self.func
+        names = []
+        for guard in self.guards:
+            for name in guard.names:
+                if name not in names:
+                    names.append(name)
+        names = tuple(names)
+
+        builtins_dict = func.__builtins__
+        globals_dict = func.__globals__
+        values = []
+        for name in names:
+            if name in globals_dict:
+                return
+            try:
+                value = builtins_dict[name]
+            except KeyError:
+                return
+            if value is not _BUILTINS.get(name):
+                # the builtin was replaced before the specialization
+                return
+            values.append(value)
+
+        dispatcher = _get_dispatcher(self.orig_code, names)
+        if dispatcher is None:
+            return
+        specialized = _copy_func(func, self.code)
+        state = (specialized, self.fallback) + tuple(values)
+        code = replace_consts(dispatcher, {"__fat_state__": state})
+        self.dispatcher_code = _rename_code(code, self.orig_code)
+
+        func.__code__ = self.dispatcher_code
+        _specialized[func] = (self.code, list(self.guards))
+
+
+def specialize(func, code, guards):
+    """Specialize a Python function: add a specialized code with guards.
+
+    The function is not specialized if a guard already fails.
+    """
+    if not isinstance(func, types.FunctionType):
+        raise TypeError("func must be a function, not %s"
+                        % type(func).__name__)
+    if isinstance(code, types.FunctionType):
+        code = code.__code__
+    if not isinstance(code, types.CodeType):
+        raise TypeError("code must be a code object or a function, not %s"
+                        % type(code).__name__)
+    if not guards:
+        raise ValueError("need at least one guard")
+    for guard in guards:
+        if not isinstance(guard, GuardBuiltins):
+            raise TypeError("unsupported guard: %r" % (guard,))
+
+    if (func.__closure__ is not None or code.co_freevars
+       or func.__code__.co_flags & _GENERATOR_FLAGS
+       or func in _specialized):
+        # the code of the function cannot be replaced with the dispatcher
+        return
+    _Specialization(func, code, guards).install()
+
+
+def get_specialized(func):
+    """Get the list of specialized codes with guards: list of (code, guards)
+    tuples."""
+    if not isinstance(func, types.FunctionType):
+        raise TypeError("func must be a function, not %s"
+                        % type(func).__name__)
+    try:
+        return [_specialized[func]]
+    except KeyError:
+        return []
+
+
+def specialize_table(fat, table, entries):
+    """Specialize functions of a module using a table.
+
+    table is a function defining specialized functions in a class body. It
+    is not called: the code of specialized functions is read from its
+    constants. entries is a tuple of (guards, patch_constants) tuples, one
+    per specialized function: guards is a tuple of tuples of builtin names,
+    patch_constants a tuple of (constant, builtin name) tuples for
+    replace_consts(). fat is the module used to specialize functions: the
+    fat module or fatoptimizer.runtime.
+
+    A function of the namespace of table is only specialized if it is
+    defined at the first line of its specialized code: it was not replaced
+    after its definition.
+    """
+    for const in table.__code__.co_consts:
+        if isinstance(const, types.CodeType):
+            class_code = const
+            break
+    else:
+        raise ValueError("no class in the table")
+    codes = [const for const in class_code.co_consts
+             if isinstance(const, types.CodeType)]
+    if len(codes) != len(entries):
+        raise ValueError("the table has %s functions, but %s entries"
+                         % (len(codes), len(entries)))
+
+    namespace = table.__globals__
+    builtins_dict = table.__builtins__
+    guard_type = fat.GuardBuiltins
+    # mapping: patch_constants => mapping of replace_consts(),
+    # or None if a builtin is missing
+    mappings = {}
+    for code, (guards, patch_constants) in zip(codes, entries):
+        func = namespace.get(code.co_name)
+        if (not isinstance(func, types.FunctionType)
+           or func.__code__.co_firstlineno != code.co_firstlineno):
+            continue
+        if patch_constants:
+            try:
+                mapping = mappings[patch_constants]
+            except KeyError:
+                mapping = {}
+                for const, builtin_name in patch_constants:
+                    if builtin_name not in builtins_dict:
+                        mapping = None
+                        break
+                    mapping[const] = builtins_dict[builtin_name]
+                mappings[patch_constants] = mapping
+            if mapping is None:
+                # a guard fails
+                continue
+            code = fat.replace_consts(code, mapping)
+        if len(guards) == 1:
+            # fast-path: the optimizer merges guards on builtins
+            guards = [guard_type(*guards[0])]
+        else:
+            guards = [guard_type(*names) for names in guards]
+        fat.specialize(func, code, guards)
@@ -0,0 +1,181 @@
+"""
+Evaluation of pure functions during the compilation, with budgets.
+"""
+
+import builtins
+import operator
+import time
+
+from .tools import UNSET
+
+
+def estimate_size(obj):
+    """Estimate the size of a constant: number of characters of strings,
+    number of items of containers, number of 64-bit words of integers.
+    """
+    if isinstance(obj, int):
+        return obj.bit_length() // 64 + 1
+    if isinstance(obj, (str, bytes)):
+        return len(obj) + 1
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        return sum(estimate_size(item) for item in obj) + 1
+    if isinstance(obj, dict):
+        return sum(estimate_size(key) + estimate_size(value)
+                   for key, value in obj.items()) + 1
+    return 1
+
+
+def _estimate_default(*args):
+    # linear in the size of arguments
+    return sum(estimate_size(arg) for arg in args)
+
+
+def _estimate_mul(left, right):
+    if isinstance(left, int) and not isinstance(right, int):
+        left, right = right, left
+    if isinstance(right, int) and isinstance(left, (str, bytes, tuple, list)):
+        # seq * n
+        return estimate_size(left) * max(right, 1)
+    return estimate_size(left) * estimate_size(right)
+
+
+def _estimate_div(left, right):
+    return estimate_size(left) * estimate_size(right)
+
+
+def _estimate_pow(num, exp, mod=None):
+    if not isinstance(num, int) or not isinstance(exp, int) or exp <= 0:
+        return _estimate_default(num, exp, mod)
+    if mod is not None:
+        return estimate_size(mod) ** 2 * exp.bit_length()
+    # the result has log2(num) * exp bits
+    words = num.bit_length() * exp // 64 + 1
+    return words * words
+
+
+def _estimate_lshift(value, shift):
+    if isinstance(shift, int) and shift > 0:
+        return estimate_size(value) + shift // 64
+    return _estimate_default(value, shift)
+
+
+def _estimate_sum(iterable, start=0):
+    if isinstance(start, (str, bytes, tuple, list)):
+        # each addition copies the sum of sequences
+        return estimate_size(iterable) * len(iterable)
+    return _estimate_default(iterable, start)
+
+
+def _estimate_justify(string, width, *args):
+    # str.center(), str.ljust(), str.rjust(), str.zfill()
+    return estimate_size(string) + max(width, 0)
+
+
+def _estimate_expandtabs(string, tabsize=8):
+    return estimate_size(string) * max(tabsize, 1)
+
+
+def _estimate_replace(string, old, new, count=-1):
+    return estimate_size(string) * max(len(new), 1)
+
+
+def _create_estimators():
+    estimators = {
+        operator.mul: _estimate_mul,
+        operator.truediv: _estimate_div,
+        operator.floordiv: _estimate_div,
+        operator.mod: _estimate_div,
+        builtins.divmod: _estimate_div,
+        operator.pow: _estimate_pow,
+        builtins.pow: _estimate_pow,
+        operator.lshift: _estimate_lshift,
+        builtins.sum: _estimate_sum,
+    }
+    for obj_type in (str, bytes):
+        for name in ('center', 'ljust', 'rjust', 'zfill'):
+            estimators[getattr(obj_type, name)] = _estimate_justify
+        estimators[obj_type.expandtabs] = _estimate_expandtabs
+        estimators[obj_type.replace] = _estimate_replace
+    return estimators
+
+
+# mapping: function => estimator(*args) of the cost of the function
+_ESTIMATORS = _create_estimators()
+
+
+def estimate_cost(func, args):
+    """Estimate the cost of func(*args) in number of elementary operations.
+
+    The cost also bounds the size of the result.
+    """
+    estimator = _ESTIMATORS.get(func, _estimate_default)
+    try:
+        return estimator(*args)
+    except Exception:
+        # unexpected arguments: the call will likely fail
+        return _estimate_default(*args)
+
+
+def _get_call_key(func, args):
+    # int and float constants are equal: keep the type of arguments
+    key = (func, tuple((type(arg), arg) for arg in args))
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable argument like a list or a slice
+        return None
+    return key
+
+
+class Sandbox:
+    """Evaluate pure functions with an operation and a time budget.
+
+    The cost of a call is estimated before the call using the
+    max_eval_ops option. The time of the call is checked after the call
+    using the max_eval_time option: the result is ignored if the call took
+    too long. Calls exceeding a budget or raising an expected exception are
+    remembered and never retried.
+    """
+
+    def __init__(self):
+        # set of keys of calls which failed
+        self._failed = set()
+
+    def call(self, config, func, args, exceptions=None):
+        """Call func(*args).
+
+        Return (result, cutoff). result is UNSET if the call failed, cutoff
+        is a message if a budget was exceeded, or None.
+        """
+        key = _get_call_key(func, args)
+        if key is not None and key in self._failed:
+            return (UNSET, None)
+
+        max_ops = config.max_eval_ops
+        if max_ops is not None:
+            cost = estimate_cost(func, args)
+            if cost > max_ops:
+                self._add_failed(key)
+                return (UNSET, "estimated cost %s > max_eval_ops (%s)"
+                               % (cost, max_ops))
+
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception as exc:
+            if exceptions is not None and isinstance(exc, exceptions):
+                self._add_failed(key)
+                return (UNSET, None)
+            raise
+        dt = time.perf_counter() - start
+
+        max_time = config.max_eval_time
+        if max_time is not None and dt > max_time:
+            self._add_failed(key)
+            return (UNSET, "evaluation took %.1f ms > max_eval_time"
+                           % (dt * 1e3))
+        return (result, None)
+
+    def _add_failed(self, key):
+        if key is not None:
+            self._failed.add(key)
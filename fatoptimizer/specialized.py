@@ -4,6 +4,8 @@ from .tools import copy_lineno, _new_constant, Call
 
 
 class BuiltinGuard:
+    __slots__ = ('names', 'reason')
+
     def __init__(self, name, reason=None):
         self.names = {name}
         self.reason = reason
@@ -36,19 +38,22 @@ class SpecializedFunction:
         self.guards = guards
         self.patch_constants = patch_constants
 
+    def _create_func(self, func, args):
+        for node in self.body:
+            copy_lineno(func, node)
+        return ast.FunctionDef(name=func.name, args=args, body=self.body,
+                               # explicitly drops decorator for the
+                               # specialized function
+                               decorator_list=[],
+                               returns=None)
+
     def to_ast(self, modname, func, tmp_name):
         # tmp_name = func
         yield ast.Assign(targets=[ast.Name(id=tmp_name, ctx=ast.Store())],
                          value=ast.Name(id=func.name, ctx=ast.Load()))
 
         # def func2(...): ...
-        for node in self.body:
-            copy_lineno(func, node)
-        func2 = ast.FunctionDef(name=func.name, args=func.args, body=self.body,
-                                # explicitly drops decorator for the
-                                # specialized function
-                                decorator_list=[],
-                                returns=None)
+        func2 = self._create_func(func, func.args)
         yield func2
 
         if self.patch_constants:
@@ -98,3 +103,43 @@ class SpecializedFunction:
 
         # del tmp_name
         yield ast.Delete(targets=[ast.Name(id=tmp_name, ctx=ast.Del())])
+
+    def to_table_ast(self, func):
+        """Emit the specialization for the table of the module.
+
+        Yield the specialized function and an expression statement with
+        the constant (guards, patch_constants): guards is a tuple of tuples
+        of builtin names, patch_constants a tuple of (constant, builtin
+        name) tuples.
+        """
+        # Only the code of the specialized function is used: drop default
+        # values and annotations
+        args = func.args
+        args = ast.arguments(
+            posonlyargs=[_copy_arg(arg) for arg in args.posonlyargs],
+            args=[_copy_arg(arg) for arg in args.args],
+            vararg=_copy_arg(args.vararg),
+            kwonlyargs=[_copy_arg(arg) for arg in args.kwonlyargs],
+            kw_defaults=[None] * len(args.kwonlyargs),
+            kwarg=_copy_arg(args.kwarg),
+            defaults=[])
+        func2 = self._create_func(func, args)
+        copy_lineno(func, func2)
+        yield func2
+
+        guards = tuple(tuple(sorted(guard.names)) for guard in self.guards)
+        patch_constants = ()
+        if self.patch_constants:
+            patch_constants = tuple((key, value.id) for key, value
+                                    in self.patch_constants.items())
+        entry = ast.Constant(value=(guards, patch_constants))
+        copy_lineno(func, entry)
+        yield ast.Expr(value=entry)
+
+
+def _copy_arg(arg):
+    if arg is None:
+        return None
+    new_arg = ast.arg(arg=arg.arg, annotation=None)
+    copy_lineno(arg, new_arg)
+    return new_arg
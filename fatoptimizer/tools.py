@@ -2,6 +2,7 @@ import ast
 import collections
 import marshal
 import sys
+import time
 
 
 FLOAT_TYPES = (int, float)
@@ -27,7 +28,9 @@ class OptimizerError(Exception):
 
 
 class OptimizerStep:
-    pass
+    # Name of the Config attribute enabling the step, or None if the step
+    # is always enabled. Visitors of disabled steps are not called.
+    config_option = None
 
 
 def compact_ascii(value, maxlen=30):
@@ -67,6 +70,16 @@ def ast_contains(tree, obj_type):
         return any(isinstance(node, obj_type) for node in _iter_all_ast(tree))
 
 
+def count_nodes(tree, limit=None):
+    """Count the AST nodes of tree: stop counting at limit nodes."""
+    count = 0
+    for node in ast.walk(tree):
+        count += 1
+        if count == limit:
+            break
+    return count
+
+
 def copy_node(node):
     new_node = type(node)()
     for field, value in ast.iter_fields(node):
@@ -282,16 +295,75 @@ def pretty_dump(node, annotate_fields=True, include_attributes=False,
     return _format(node)
 
 
+# Bit of each AST node type in masks of node kinds
+_NODE_KIND_BITS = {}
+for _index, _name in enumerate(sorted(dir(ast))):
+    _obj = getattr(ast, _name)
+    if isinstance(_obj, type) and issubclass(_obj, ast.AST):
+        _NODE_KIND_BITS[_obj] = 1 << _index
+del _index, _name, _obj
+# Bit of names which are not AST node types
+_UNKNOWN_KIND_BIT = 1 << len(dir(ast))
+
+
+def get_kinds_mask(names):
+    """Get the mask of node kinds of AST node type names."""
+    mask = 0
+    for name in names:
+        node_type = getattr(ast, name, None)
+        mask |= _NODE_KIND_BITS.get(node_type, _UNKNOWN_KIND_BIT)
+    return mask
+
+
+def scan_node_kinds(tree):
+    """Compute the node kinds of each subtree of tree.
+
+    Return a mapping: node => mask of the node types used in the node and
+    its children (-1 for unknown types).
+    """
+    nodes = []
+    parents = []
+    stack = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        stack.append((item, index))
+            elif isinstance(value, ast.AST):
+                stack.append((value, index))
+
+    # parents are before their children in nodes
+    bits = _NODE_KIND_BITS
+    masks = [bits.get(type(node), -1) for node in nodes]
+    for index in range(len(nodes) - 1, 0, -1):
+        masks[parents[index]] |= masks[index]
+    return dict(zip(nodes, masks))
+
+
 class NodeVisitorMeta(type):
     def __new__(mcls, name, bases, namespace):
         self_class = super().__new__(mcls, name, bases, namespace)
 
-        steps = [cls for cls in self_class.__mro__
-                 if OptimizerStep in cls.__bases__]
+        # Optimizer steps in the order of their visitors: the MRO order,
+        # or the _step_order attribute of classes composed with registered
+        # steps (see fatoptimizer.plugin)
+        steps = namespace.get('_step_order')
+        if steps is None:
+            steps = [cls for cls in self_class.__mro__
+                     if OptimizerStep in cls.__bases__]
+        self_class._steps = tuple(steps)
 
         # AST object name (ex: 'Name') => list of visitors
         self_class._fullvisitors = collections.defaultdict(list)
         self_class._visitors = collections.defaultdict(list)
+        # visitor => name of the Config attribute enabling the visitor
+        self_class._visitor_options = {}
         for step in steps:
             for name in dir(step):
                 if name.startswith('fullvisit_'):
@@ -302,6 +374,10 @@ class NodeVisitorMeta(type):
                     key = name[6:]
                     func = getattr(step, name)
                     self_class._visitors[key].append(func)
+                else:
+                    continue
+                if step.config_option is not None:
+                    self_class._visitor_options[func] = step.config_option
 
         for name in dir(self_class):
             if name.startswith('fullvisit_'):
@@ -317,13 +393,62 @@ class NodeVisitorMeta(type):
                 if func not in visitors:
                     visitors.append(func)
 
+        self_class._config_options = tuple(sorted(
+            set(self_class._visitor_options.values())))
+        # mask of node kinds having a visitor
+        self_class._kinds_mask = get_kinds_mask(
+            self_class._fullvisitors.keys() | self_class._visitors.keys())
+        # mapping: enabled options => (fullvisitors, visitors, kinds_mask)
+        self_class._dispatch_cache = {}
+
         return self_class
 
+    def _prune_visitors(cls, visitors, enabled):
+        pruned = {}
+        for key, funcs in visitors.items():
+            funcs = [func for func in funcs
+                     if cls._visitor_options.get(func, None) in enabled]
+            if funcs:
+                pruned[key] = funcs
+        return pruned
+
+    def get_dispatch(cls, config):
+        """Get visitors of the steps enabled by config.
+
+        Return a tuple (fullvisitors, visitors, kinds_mask): fullvisitors
+        and visitors are mappings AST object name => list of visitors,
+        kinds_mask is the mask of node kinds having a visitor.
+        """
+        enabled = tuple(option for option in cls._config_options
+                        if getattr(config, option))
+        try:
+            return cls._dispatch_cache[enabled]
+        except KeyError:
+            pass
+
+        enabled_set = set(enabled)
+        # visitors which are not part of a step are always enabled
+        enabled_set.add(None)
+        fullvisitors = cls._prune_visitors(cls._fullvisitors, enabled_set)
+        visitors = cls._prune_visitors(cls._visitors, enabled_set)
+        kinds_mask = get_kinds_mask(fullvisitors.keys() | visitors.keys())
+        dispatch = (fullvisitors, visitors, kinds_mask)
+        # another thread may have computed the dispatch in the meanwhile
+        return cls._dispatch_cache.setdefault(enabled, dispatch)
+
 
 class BaseNodeVisitor(metaclass=NodeVisitorMeta):
+    # Profiler instance, or None
+    _profiler = None
+
     def __init__(self, filename):
         self.filename = filename
 
+    def _use_config(self, config):
+        """Only call visitors of the steps enabled by config."""
+        (self._fullvisitors, self._visitors,
+         self._kinds_mask) = type(self).get_dispatch(config)
+
     def error_what(self, node):
         return compact_dump(node, COMPACT_DUMP_MAXLEN)
 
@@ -340,6 +465,8 @@ class BaseNodeVisitor(metaclass=NodeVisitorMeta):
         OptimizerError exceptions are not catched.
         """
         try:
+            if self._profiler is not None:
+                return self._profiler.call_visitor(visitor, self, node)
             return visitor(self, node)
         except (OptimizerError, RecursionError):
             raise
@@ -398,104 +525,286 @@ class NodeTransformer(BaseNodeVisitor):
     basically, return [original_tree, specialized_tree].
     """
 
+    # Optional method called with each node visited by visit(), or None
+    _enter_node = None
+
+    # Maximum number of nested visits of nodes passed to revisit()
+    max_revisits = 4
+
+    # Node passed to revisit() by the current visitor
+    _revisit = None
+
+    # Mapping: node => mask of node kinds of the subtree computed by
+    # scan_node_kinds(), or None. Subtrees without any node kind having
+    # a visitor (_kinds_mask) are not visited.
+    _node_kinds = None
+
+    # time.perf_counter() deadline of the visit, or None. Once the deadline
+    # is exceeded, nodes are no more visited: the visit completes with the
+    # nodes optimized so far.
+    _deadline = None
+
+    # Set to True when the deadline is exceeded
+    deadline_exceeded = False
+
+    # Set of nodes which are not visited: they are left unchanged and
+    # passed to _skip_node(), or None
+    _skip_nodes = None
+
     def optimize_node_list(self, node_list):
         return node_list
 
-    def _visit_attr(self, parent_node, attr_name, node):
-        return self.visit(node)
+    def _attr_context(self, parent_node, attr_name):
+        """Get the context used to visit the attribute of a node.
 
-    def generic_visit(self, node, ignore_fields=None):
-        fields = {}
-        modified = False
+        Return a context manager, or None.
+        """
+        return None
 
-        if ignore_fields:
-            if isinstance(ignore_fields, str):
-                ignore_fields = {ignore_fields}
-            else:
-                ignore_fields = set(ignore_fields)
+    def _call_visitors(self, visitors, node):
+        for visitor in visitors:
+            new_node = self._call_visitor_method(visitor, node)
+            if new_node is not None:
+                assert new_node is not UNSET
+                if type(new_node) != type(node):
+                    # AST node type changed
+                    return new_node, False
+                else:
+                    node = new_node
+        return node, True
+
+    def _full_visit(self, node, key):
+        node, same_type = self._call_visitors(self._fullvisitors[key], node)
+        if same_type and key in self._visitors:
+            node = self._call_visitors(self._visitors[key], node)[0]
+        return node
+
+    def _skip_node(self, node):
+        """Called with a node of _skip_nodes instead of visiting it."""
+        pass
+
+    def _iter_visit(self, node, ignore_fields):
+        """Visit attributes of node.
+
+        Generator yielding child nodes to visit: the result of the visit
+        must be sent back. Return the new node.
+        """
+        # list of (field, value) of modified fields, only allocated
+        # when the first field is modified
+        new_fields = None
+
+        for field in node._fields:
+            value = getattr(node, field, UNSET)
+            if value is UNSET:
+                continue
 
-        for field, value in ast.iter_fields(node):
             if ignore_fields is not None and field in ignore_fields:
-                fields[field] = value
                 continue
 
             if isinstance(value, list):
                 values = value
-                new_values = []
+                # copy of values, only created when an item is modified
+                new_values = None
                 all_ast = True
-                for value in values:
-                    if isinstance(value, ast.AST):
-                        new_value = self._visit_attr(node, field, value)
-                        modified |= (new_value != value)
-                        if isinstance(new_value, list):
-                            new_values.extend(new_value)
+                context = self._attr_context(node, field)
+                if context is not None:
+                    context.__enter__()
+                try:
+                    for index, value in enumerate(values):
+                        if isinstance(value, ast.AST):
+                            new_value = yield value
+                            if new_values is None:
+                                if new_value is value:
+                                    continue
+                                new_values = values[:index]
+                            if isinstance(new_value, list):
+                                new_values.extend(new_value)
+                            else:
+                                new_values.append(new_value)
                         else:
-                            new_values.append(new_value)
-                    else:
-                        # arguments.kw_defaults contains AST nodes
-                        # (ex: Constant) and non-AST nodes (ex: None)
-                        all_ast = False
-                        new_values.append(value)
+                            # arguments.kw_defaults contains AST nodes
+                            # (ex: Constant) and non-AST nodes (ex: None)
+                            all_ast = False
+                            if new_values is not None:
+                                new_values.append(value)
+                finally:
+                    if context is not None:
+                        context.__exit__(None, None, None)
+                if new_values is None:
+                    new_values = values
                 if all_ast:
-                    value = new_values
                     new_values = self.optimize_node_list(new_values)
-                    modified |= (new_values is not value)
+                if new_values is values:
+                    continue
                 value = new_values
 
             elif isinstance(value, ast.AST):
                 old_value = value
-                value = self._visit_attr(node, field, value)
-                modified |= (value != old_value)
-
-            # Create a dictionary of fields used if any field is modified
-            # to create a new AST node
-            fields[field] = value
-
-        if modified:
-            # create a new AST node with the new fields
-            new_node = type(node)()
-            if 'lineno' in node._attributes:
-                copy_lineno(node, new_node)
-            for field, value in fields.items():
+                context = self._attr_context(node, field)
+                if context is None:
+                    value = yield value
+                else:
+                    with context:
+                        value = yield value
+                if value is old_value:
+                    continue
+
+            else:
+                continue
+
+            if new_fields is None:
+                new_fields = []
+            new_fields.append((field, value))
+
+        if new_fields is None:
+            return node
+
+        # create a new AST node: unmodified fields are shared with node,
+        # so lists of the new node must not be modified in-place
+        new_node = type(node)()
+        if 'lineno' in node._attributes:
+            copy_lineno(node, new_node)
+        for field in node._fields:
+            value = getattr(node, field, UNSET)
+            if value is not UNSET:
                 setattr(new_node, field, value)
-            return new_node
+        for field, value in new_fields:
+            setattr(new_node, field, value)
+        return new_node
 
-        return node
+    def _iter_nodes(self, node):
+        """Visit a node or a list of nodes.
 
-    def visit(self, node):
-        key = node.__class__.__name__
+        Generator yielding nodes to visit: the result of the visit must be
+        sent back. Return the new node or the new list of nodes.
+        """
+        if not isinstance(node, list):
+            return (yield node)
+
+        new_nodes = []
+        for item in node:
+            new_item = yield item
+            if isinstance(new_item, list):
+                new_nodes.extend(new_item)
+            else:
+                new_nodes.append(new_item)
+        return new_nodes
 
-        # "full" visitor calling generic_visit() internally?
-        if key in self._fullvisitors:
-            visitors = self._fullvisitors[key]
-            for visitor in visitors:
-                new_node = self._call_visitor_method(visitor, node)
-                if new_node is not None:
-                    assert new_node is not UNSET
-                    if type(new_node) != type(node):
-                        # AST node type changed
-                        return new_node
-                    else:
-                        node = new_node
-        else:
-            new_node = self.generic_visit(node)
-            assert new_node is not UNSET
-            if new_node is not None:
-                node = new_node
+    def revisit(self, node):
+        """Visit again node once the current visitor returns it.
 
-        if key in self._visitors:
-            visitors = self._visitors[key]
-            for visitor in visitors:
-                new_node = self._call_visitor_method(visitor, node)
-                if new_node is not None:
-                    assert new_node is not UNSET
-                    if type(new_node) != type(node):
-                        # AST node type changed
-                        return new_node
+        node is a new node or a new list of nodes created by the visitor
+        which can be optimized again. Return node.
+        """
+        self._revisit = node
+        return node
+
+    def _visit_tree(self, gen):
+        # Visit nodes using an explicit stack of generators rather than
+        # recursive calls to visit() to support deeply nested trees.
+        # Only "full" visitors are called recursively.
+        fullvisitors = self._fullvisitors
+        visitors = self._visitors
+        enter_node = self._enter_node
+        max_revisits = self.max_revisits
+        node_kinds = self._node_kinds
+        if enter_node is not None:
+            node_kinds = None
+        kinds_mask = self._kinds_mask
+        skip_nodes = self._skip_nodes
+        deadline = self._deadline
+        perf_counter = time.perf_counter
+
+        # stack of (generator, call visitors of the node?, revisit?)
+        stack = []
+        visit = False
+        revisit = False
+        # number of nested revisits
+        revisits = 0
+        result = None
+        try:
+            while True:
+                try:
+                    child = gen.send(result)
+                except StopIteration as exc:
+                    node = exc.value
+                    if revisit:
+                        revisits -= 1
+                    was_visit = visit
+                    if visit:
+                        key = node.__class__.__name__
+                        if key in visitors:
+                            node = self._call_visitors(visitors[key], node)[0]
+                    if not stack:
+                        return node
+                    gen, visit, revisit = stack.pop()
+                    result = node
+                    if not was_visit:
+                        continue
+                else:
+                    if enter_node is not None:
+                        enter_node(child)
+                    key = child.__class__.__name__
+                    if deadline is not None and (self.deadline_exceeded
+                                                 or perf_counter() > deadline):
+                        # time budget exceeded: leave the node unchanged
+                        self.deadline_exceeded = True
+                        result = child
+                    elif skip_nodes is not None and child in skip_nodes:
+                        self._skip_node(child)
+                        result = child
+                    elif key in fullvisitors:
+                        result = self._full_visit(child, key)
+                    elif (node_kinds is not None
+                          and not (node_kinds.get(child, -1) & kinds_mask)):
+                        # no visitor for any node of the subtree
+                        result = child
+                    elif child._fields:
+                        stack.append((gen, visit, revisit))
+                        gen = self._iter_visit(child, None)
+                        visit = True
+                        revisit = False
+                        result = None
+                        continue
                     else:
-                        node = new_node
+                        # node without attribute, like ast.Load
+                        result = child
+                        if key in visitors:
+                            result = self._call_visitors(visitors[key],
+                                                         child)[0]
+
+                # result is the new node of a visited node:
+                # did a visitor ask to visit it again?
+                node = self._revisit
+                if node is not None:
+                    self._revisit = None
+                    if node is result and revisits < max_revisits:
+                        stack.append((gen, visit, revisit))
+                        gen = self._iter_nodes(node)
+                        visit = False
+                        revisit = True
+                        revisits += 1
+                        result = None
+        except BaseException:
+            self._revisit = None
+            # exit the contexts of attributes being visited
+            gen.close()
+            for gen, visit, revisit in reversed(stack):
+                gen.close()
+            raise
 
-        return node
+    def generic_visit(self, node, ignore_fields=None):
+        if ignore_fields:
+            if isinstance(ignore_fields, str):
+                ignore_fields = {ignore_fields}
+            else:
+                ignore_fields = set(ignore_fields)
+        else:
+            ignore_fields = None
+        return self._visit_tree(self._iter_visit(node, ignore_fields))
+
+    def visit(self, node):
+        return self._visit_tree(self._iter_nodes(node))
 
     def visit_node_list(self, node_list):
         assert isinstance(node_list, list)
@@ -530,25 +839,6 @@ class RestrictToFunctionDefMixin:
         return node
 
 
-class FindStrVisitor(NodeVisitor, RestrictToFunctionDefMixin):
-    """Find Str nodes.
-
-    Find all Str nodes to compute constants.
-    """
-    def __init__(self, filename):
-        super().__init__(filename)
-        self.str_constants = set()
-
-    @classmethod
-    def from_node(cls, filename, node):
-        visitor = cls(filename)
-        visitor.visit(node)
-        return visitor
-
-    def visit_Str(self, node):
-        self.str_constants.add(node.s)
-
-
 # FIXME: add optional RestrictToFunctionDefMixin, see UnrollStep, unroll.py
 class FindNodes:
     """Find AST nodes."""
@@ -1,14 +1,64 @@
 import ast
 
 from .tools import (OptimizerStep, ReplaceVariable, FindNodes,
-                    compact_dump, copy_lineno,
+                    compact_dump, copy_lineno, count_nodes,
                     ITERABLE_TYPES)
 
 
 CANNOT_UNROLL = (ast.Break, ast.Continue, ast.Raise)
 
+# Number of AST nodes of the 'i = value' assignment of an unrolled iteration
+_ASSIGN_NODES = 4
+
+
+class UnrollBudget:
+    """Number of AST nodes added by loop unrolling in a namespace.
+
+    Loops of a function, including nested loops, share the budget of the
+    function.
+    """
+    __slots__ = ('growth',)
+
+    def __init__(self):
+        self.growth = 0
+
+
+def check_unroll_budget(optimizer, node, size):
+    """Check the code size budget to replace the loop node with size AST
+    nodes.
+
+    Return False if the budget is exceeded. Otherwise, add the growth to the
+    budget of the namespace and return True.
+    """
+    config = optimizer.config
+    max_nodes = config.max_unroll_nodes
+    if max_nodes is not None and size > max_nodes:
+        optimizer._cutoff(node, "skip loop unrolling: %s nodes > "
+                          "max_unroll_nodes (%s)", size, max_nodes)
+        return False
+
+    growth = size - count_nodes(node)
+    if growth <= 0:
+        return True
+    budget = optimizer.unroll_budget
+    max_growth = config.max_unroll_growth
+    if max_growth is not None and budget.growth + growth > max_growth:
+        optimizer._cutoff(node, "skip loop unrolling: growth of %s nodes "
+                          "exceeds max_unroll_growth (%s), %s nodes already "
+                          "added", growth, max_growth, budget.growth)
+        return False
+    budget.growth += growth
+    return True
+
+
+def _has_unroll_budget(config):
+    return (config.max_unroll_nodes is not None
+            or config.max_unroll_growth is not None)
+
 
 class UnrollStep(OptimizerStep):
+    config_option = 'unroll_loops'
+
     def _visit_For(self, node):
         if not isinstance(node.target, ast.Name):
             return
@@ -64,6 +114,13 @@ class UnrollStep(OptimizerStep):
         if node.orelse:
             new_node.extend(node.orelse)
 
+        if _has_unroll_budget(self.config):
+            body_nodes = sum(count_nodes(stmt) for stmt in body)
+            size = len(iter_value) * (body_nodes + _ASSIGN_NODES)
+            size += sum(count_nodes(stmt) for stmt in node.orelse)
+            if not check_unroll_budget(self, node, size):
+                return
+
         self.log(node, "unroll loop (%s iterations)", len(node.iter.value))
 
         return new_node
@@ -76,8 +133,8 @@ class UnrollStep(OptimizerStep):
         if new_node is None:
             return
 
-        # loop was unrolled: run again the optimize on the new nodes
-        return self.visit_node_list(new_node)
+        # loop was unrolled: optimize again the new nodes
+        return self.revisit(new_node)
 
 
 class UnrollListComp:
@@ -142,6 +199,10 @@ class UnrollListComp:
                 assert isinstance(node, ast.ListComp)
                 new_node = ast.List(elts=items, ctx=ast.Load())
 
+        if _has_unroll_budget(self.config):
+            if not check_unroll_budget(self, node, count_nodes(new_node)):
+                return
+
         copy_lineno(node, new_node)
         return new_node
 
@@ -2,16 +2,40 @@
 __fatoptimizer__ = {'enabled': False}
 
 import ast
+import builtins
+import concurrent.futures
+import contextlib
+import importlib
+import fatoptimizer.builtins
+import fatoptimizer.const_fold
 import fatoptimizer.convert_const
+import fatoptimizer.cost
+import fatoptimizer.importer
+import fatoptimizer.lazy
+import fatoptimizer.methods
 import fatoptimizer.namespace
 import fatoptimizer.optimizer
+import fatoptimizer.precompile
+import fatoptimizer.pure
+import fatoptimizer.runtime
+import fatoptimizer.sandbox
 import fatoptimizer.tools
 import io
+import itertools
+import linecache
+import marshal
+import operator
+import os
 import re
+import subprocess
 import sys
+import tempfile
+import threading
+import types
 from fatoptimizer.tools import UNSET
 import textwrap
 import unittest
+import warnings
 from unittest import mock
 
 
@@ -348,6 +372,77 @@ class VariableVisitorTests(unittest.TestCase):
                         get_node=lambda tree: tree.body[0].body[0])
 
 
+class ScopeAnalysisTests(unittest.TestCase):
+    def analyze(self, code):
+        tree = compile_ast(code)
+        analysis = fatoptimizer.namespace.ScopeAnalysis("<string>")
+        tree = analysis.analyze(tree)
+        return tree, analysis.scopes
+
+    def test_scopes(self):
+        tree, scopes = self.analyze("""
+            x = 'module'
+            def func(arg):
+                y = 'func'
+                return [z for z in arg]
+            class MyClass:
+                attr = 1
+        """)
+        self.assertEqual(len(scopes), 4)
+
+        module = scopes[tree]
+        self.assertEqual(module.local_variables, {'x', 'func', 'MyClass'})
+        self.assertEqual(module.str_constants, {'module'})
+        self.assertEqual(module.funcdefs, {'func': tree.body[1]})
+
+        func = scopes[tree.body[1]]
+        self.assertEqual(func.local_variables, {'arg', 'y'})
+        self.assertEqual(func.str_constants, {'func'})
+
+        listcomp = scopes[tree.body[1].body[1].value]
+        self.assertEqual(listcomp.local_variables, set())
+
+        cls = scopes[tree.body[2]]
+        self.assertEqual(cls.local_variables, {'attr'})
+
+    def test_nonlocal(self):
+        # 'nonlocal' of nested functions also apply to the parent function
+        tree, scopes = self.analyze("""
+            def func():
+                x = 1
+                def nested():
+                    nonlocal x
+                    x = 2
+        """)
+        func = scopes[tree.body[0]]
+        self.assertEqual(func.local_variables, {'nested'})
+        self.assertEqual(func.nonlocal_variables, {'x'})
+
+    def test_complex_assignment(self):
+        # the error only applies to the namespace of the assignment
+        tree, scopes = self.analyze("""
+            def set_global(key, arg):
+                globals()[key] = arg
+        """)
+        self.assertIsNone(scopes[tree].error)
+        self.assertIsInstance(scopes[tree.body[0]].error,
+                              fatoptimizer.namespace.ComplexAssignment)
+
+    def test_node_count(self):
+        tree, scopes = self.analyze("""
+            def func():
+                return 1
+        """)
+        # Module, FunctionDef, arguments, Return, Constant
+        self.assertEqual(scopes[tree].node_count, 5)
+        self.assertEqual(scopes[tree.body[0]].node_count, 4)
+
+    def test_convert_constant(self):
+        tree, scopes = self.analyze("x = (1, 2)")
+        self.assertIsInstance(tree.body[0].value, ast.Constant)
+        self.assertIn(tree, scopes)
+
+
 class BaseAstTests(unittest.TestCase):
     maxDiff = 15000
 
@@ -427,7 +522,10 @@ class BaseAstTests(unittest.TestCase):
         code1 = before
 
         code2 = textwrap.dedent("""
-            import fat as __fat__
+            try:
+                import fat as __fat__
+            except ImportError:
+                import fatoptimizer.runtime as __fat__
 
             {before}
 
@@ -768,7 +866,11 @@ class CallPureBuiltinTests(BaseAstTests):
             'return str(123)',
             'return "123"')
 
-        self.config._pure_builtins['str'].arg_types = (str,)
+        # tables are shared: replace them with a modified copy
+        pure_builtins = dict(self.config._pure_builtins)
+        pure_builtins['str'] = fatoptimizer.pure.PureFunction(str, 'str',
+                                                              1, str)
+        self.config._pure_builtins = pure_builtins
         self.check_dont_optimize("""
             def func():
                 return str(123)
@@ -795,7 +897,9 @@ class CallPureBuiltinTests(BaseAstTests):
             'return str(123)',
             'return "123"')
 
-        del self.config._pure_builtins['str']
+        pure_builtins = dict(self.config._pure_builtins)
+        del pure_builtins['str']
+        self.config._pure_builtins = pure_builtins
         self.check_dont_optimize("""
             def func():
                 return str(123)
@@ -823,6 +927,58 @@ class ConfigTests(BaseAstTests):
         """)
 
 
+    def test_shared_tables(self):
+        import pickle
+
+        config = fatoptimizer.Config()
+        config2 = fatoptimizer.Config()
+        config2.enable_all()
+        self.assertIs(config2._pure_builtins, config._pure_builtins)
+        self.assertIs(config2._pure_methods, config._pure_methods)
+        with self.assertRaises(TypeError):
+            config._pure_builtins['len'] = None
+
+        # Config.replace() also shares tables
+        config3 = config.replace({'constant_folding': False})
+        self.assertIs(config3._pure_builtins, config._pure_builtins)
+        self.assertIs(config3._copy_builtin_to_constant,
+                      config._copy_builtin_to_constant)
+
+        # shared tables are pickled by reference
+        config4 = pickle.loads(pickle.dumps(config))
+        self.assertIs(config4._pure_builtins, config._pure_builtins)
+        self.assertIs(config4._pure_methods, config._pure_methods)
+
+        config.disable_all()
+        fatoptimizer.builtins.add_pure_builtins(config)
+        self.assertIs(config._pure_builtins, config2._pure_builtins)
+        config5 = pickle.loads(pickle.dumps(config))
+        self.assertEqual(config5._pure_methods, {})
+        self.assertEqual(config5.fingerprint(), config.fingerprint())
+
+    def test_fingerprint_pure_functions(self):
+        from fatoptimizer.pure import PureFunction
+
+        config = fatoptimizer.Config()
+        config.enable_all()
+        fingerprint = config.fingerprint()
+
+        # replace a pure function with a function having the same name
+        pure_builtins = dict(config._pure_builtins)
+        pure_builtins['str'] = PureFunction(str, 'str', 1, str)
+        config._pure_builtins = pure_builtins
+        fingerprint2 = config.fingerprint()
+        self.assertNotEqual(fingerprint2, fingerprint)
+
+        pure_methods = {obj_type: dict(methods)
+                        for obj_type, methods in config._pure_methods.items()}
+        # the check of arguments is removed
+        pure_methods[str]['encode'] = PureFunction(
+            str.encode, 'encode', (0, 2), str, str,
+            exceptions=UnicodeEncodeError)
+        config._pure_methods = pure_methods
+        self.assertNotEqual(config.fingerprint(), fingerprint2)
+
     def test_config_max_bytes_len(self):
         self.config.max_bytes_len = 3
         self.check_optimize("""
@@ -1138,6 +1294,18 @@ class CopyBuiltinToConstantTests(BaseAstTests):
         self.guards,
         replace_consts="{'LOAD_GLOBAL max': max}")
 
+    def test_str_constant_conflict(self):
+        # the unique constant must not be an existing string of the function
+        self.check_func_specialize("""
+            x = 'LOAD_GLOBAL max'
+            return max(x, y)
+        """, """
+            x = 'LOAD_GLOBAL max'
+            return 'LOAD_GLOBAL max#2'(x, y)
+        """,
+        self.guards,
+        replace_consts="{'LOAD_GLOBAL max#2': max}")
+
     def test_disabled(self):
         self.config.copy_builtin_to_constant = False
         self.check_dont_optimize("""
@@ -1419,6 +1587,92 @@ class UnrollLoopTests(BaseAstTests):
         """)
 
 
+    def test_budget(self):
+        source = """
+            def func():
+                for i in (1, 2, 3):
+                    print(i)
+        """
+        self.config.max_unroll_nodes = 20
+        self.check_dont_optimize(source)
+        self.config.max_unroll_nodes = 30
+        self.check_optimize(source, """
+            def func():
+                i = 1
+                print(i)
+
+                i = 2
+                print(i)
+
+                i = 3
+                print(i)
+        """)
+
+        # loops of a function share the growth budget
+        self.config.max_unroll_nodes = None
+        self.config.max_unroll_growth = 10
+        self.check_optimize("""
+            def func():
+                for i in (1, 2):
+                    print(i)
+                for j in (1, 2):
+                    print(j)
+        """, """
+            def func():
+                i = 1
+                print(i)
+
+                i = 2
+                print(i)
+
+                for j in (1, 2):
+                    print(j)
+        """)
+
+        # nested loops
+        self.config.max_unroll_growth = 15
+        self.check_optimize("""
+            def func():
+                for i in (1, 2):
+                    for j in (3, 4):
+                        print(i, j)
+        """, """
+            def func():
+                for i in (1, 2):
+                    j = 3
+                    print(i, j)
+
+                    j = 4
+                    print(i, j)
+        """)
+
+        # each function has its own budget
+        self.config.max_unroll_growth = 10
+        self.check_optimize("""
+            def func():
+                for i in (1, 2):
+                    print(i)
+
+            def func2():
+                for i in (1, 2):
+                    print(i)
+        """, """
+            def func():
+                i = 1
+                print(i)
+
+                i = 2
+                print(i)
+
+            def func2():
+                i = 1
+                print(i)
+
+                i = 2
+                print(i)
+        """)
+
+
 class UnrollComprehensionTests(BaseAstTests):
     def setUp(self):
         super().setUp()
@@ -1453,6 +1707,11 @@ class UnrollComprehensionTests(BaseAstTests):
         self.check_optimize('{i:i*2 for i in (1, 2, 3)}',
                             '{1: 2, 2: 4, 3: 6}')
 
+    def test_budget(self):
+        self.config.max_unroll_nodes = 10
+        self.check_optimize('[i for i in (1, 2, 3)]', '[1, 2, 3]')
+        self.check_dont_optimize('[(i, i, i) for i in (1, 2, 3)]')
+
 
 class NodeVisitorTests(BaseAstTests):
     def check_call_visitor(self, visitor):
@@ -1530,6 +1789,153 @@ class NodeVisitorTests(BaseAstTests):
         visitor = BuggyTransformer("<string>")
         self.check_pass_optimizer_error(visitor)
 
+    def test_deep_tree(self):
+        # the tree is deeper than the Python recursion limit
+        depth = sys.getrecursionlimit() * 2
+        expr = ast.Constant(value=1, lineno=1, col_offset=0)
+        for index in range(depth):
+            right = ast.Constant(value=1, lineno=1, col_offset=0)
+            expr = ast.BinOp(left=expr, op=ast.Add(), right=right,
+                             lineno=1, col_offset=0)
+        tree = ast.Module(body=[ast.Expr(value=expr, lineno=1, col_offset=0)],
+                          type_ignores=[])
+
+        self.config.constant_folding = True
+        tree = fatoptimizer.optimize(tree, "<string>", self.config)
+        self.assertAstEqual(tree, compile_ast(str(depth + 1)))
+
+    def test_transformer_attr_context(self):
+        class Transformer(fatoptimizer.tools.NodeTransformer):
+            def __init__(self):
+                super().__init__("<string>")
+                self.test = False
+
+            @contextlib.contextmanager
+            def _test_context(self):
+                self.test = True
+                try:
+                    yield
+                finally:
+                    self.test = False
+
+            def _attr_context(self, parent_node, attr_name):
+                if attr_name == 'test':
+                    return self._test_context()
+
+            def visit_Name(self, node):
+                if self.test:
+                    return ast.Name(id='test', ctx=node.ctx)
+
+        tree = ast.parse("if x: y")
+        tree = Transformer().visit(tree)
+        self.assertAstEqual(tree, compile_ast("if test: y"))
+
+    def test_revisit(self):
+        class Transformer(fatoptimizer.tools.NodeTransformer):
+            def visit_Name(self, node):
+                # a => b => c => d
+                if node.id in 'abc':
+                    new_id = chr(ord(node.id) + 1)
+                    new_node = ast.Name(id=new_id, ctx=node.ctx)
+                    if node.id != 'c':
+                        self.revisit(new_node)
+                    return new_node
+
+        transformer = Transformer("<string>")
+        tree = transformer.visit(ast.parse("a"))
+        self.assertAstEqual(tree, compile_ast("d"))
+
+        # limit the number of nested revisits
+        transformer.max_revisits = 1
+        tree = transformer.visit(ast.parse("a"))
+        self.assertAstEqual(tree, compile_ast("c"))
+
+    def test_config_dispatch(self):
+        Optimizer = fatoptimizer.optimizer.ModuleOptimizer
+        visit_const_fold = fatoptimizer.const_fold.ConstantFolding.visit_BinOp
+        visit_namespace = fatoptimizer.namespace.NamespaceStep.visit_Assign
+
+        self.config.constant_folding = True
+        optimizer = Optimizer(self.config, "<string>")
+        self.assertIn(visit_const_fold, optimizer._visitors['BinOp'])
+        self.assertIn(visit_namespace, optimizer._visitors['Assign'])
+
+        # visitors of disabled steps are skipped,
+        # but the namespace step is always enabled
+        self.config.constant_folding = False
+        optimizer = Optimizer(self.config, "<string>")
+        self.assertNotIn('BinOp', optimizer._visitors)
+        self.assertIn(visit_namespace, optimizer._visitors['Assign'])
+
+        # the dispatch is computed once per set of enabled steps
+        optimizer2 = Optimizer(self.config, "<string>")
+        self.assertIs(optimizer2._visitors, optimizer._visitors)
+
+    def test_skip_subtree(self):
+        class Transformer(fatoptimizer.tools.NodeTransformer):
+            def visit_BinOp(self, node):
+                return ast.Constant(value=3)
+
+        tree = compile_ast('x = [1, (2, 3)]; y = f(1 + 2)')
+        kinds = fatoptimizer.tools.scan_node_kinds(tree)
+        self.assertTrue(kinds[tree.body[1]]
+                        & fatoptimizer.tools.get_kinds_mask(['BinOp']))
+        self.assertFalse(kinds[tree.body[0]]
+                         & fatoptimizer.tools.get_kinds_mask(['BinOp']))
+
+        visited = []
+        iter_visit = fatoptimizer.tools.NodeTransformer._iter_visit
+        def record_iter_visit(self, node, ignore_fields):
+            visited.append(type(node).__name__)
+            return iter_visit(self, node, ignore_fields)
+
+        transformer = Transformer("<string>")
+        transformer._node_kinds = kinds
+        with mock.patch.object(fatoptimizer.tools.NodeTransformer,
+                               '_iter_visit', record_iter_visit):
+            new_tree = transformer.visit(tree)
+        # the first statement has no BinOp: it is not visited
+        self.assertEqual(visited, ['Module', 'Assign', 'Call', 'BinOp'])
+        self.assertIs(new_tree.body[0], tree.body[0])
+        self.assertEqual(ast.unparse(new_tree), 'x = [1, (2, 3)]\ny = f(3)')
+
+    def test_copy_on_write(self):
+        class Transformer(fatoptimizer.tools.NodeTransformer):
+            def visit_BinOp(self, node):
+                return ast.Constant(value=3)
+
+        tree = compile_ast('x = [1, 2]; y = f(a, 1 + 2)')
+        dump = ast.dump(tree)
+        new_tree = Transformer("<string>").visit(tree)
+        self.assertEqual(ast.dump(tree), dump)
+        self.assertEqual(ast.unparse(new_tree), 'x = [1, 2]\ny = f(a, 3)')
+
+        # only nodes on the path of the modified node are copied
+        self.assertIsNot(new_tree, tree)
+        self.assertIs(new_tree.body[0], tree.body[0])
+        old_call = tree.body[1].value
+        new_call = new_tree.body[1].value
+        self.assertIsNot(new_call, old_call)
+        self.assertIs(new_call.func, old_call.func)
+        self.assertIs(new_call.args[0], old_call.args[0])
+        self.assertIs(new_call.keywords, old_call.keywords)
+
+    def test_specialize_keeps_input(self):
+        # the original function used by the specialization is not modified
+        self.config.enable_all()
+        tree = compile_ast('''
+            def func(x):
+                if x in [1, 2]:
+                    return len("abc")
+                for y in x:
+                    pass
+                else:
+                    pass
+        ''')
+        dump = ast.dump(tree)
+        fatoptimizer.optimize(tree, "<string>", self.config)
+        self.assertEqual(ast.dump(tree), dump)
+
 
 class NamespaceTests(BaseAstTests):
     def get_namespace(self, code):
@@ -2886,6 +3292,60 @@ class InliningTests(BaseAstTests):
                 return 42 + 3
         ''')
 
+    def test_constant_folding(self):
+        # the inlined function is optimized again by the stage 1
+        self.config.constant_folding = True
+        self.check_optimize('''
+            def g(x):
+                return x * 2
+            def f():
+                return g(3)
+        ''', '''
+            def g(x):
+                return x * 2
+            def f():
+                return 6
+        ''')
+
+        self.config.max_passes = 1
+        self.check_optimize('''
+            def g(x):
+                return x * 2
+            def f():
+                return g(3)
+        ''', '''
+            def g(x):
+                return x * 2
+            def f():
+                return 3 * 2
+        ''')
+
+    def test_modified_statements(self):
+        # later passes only optimize again modified statements and
+        # statements using their names
+        self.config.constant_folding = True
+        self.config.constant_propagation = True
+        stage1 = fatoptimizer.optimizer.FunctionOptimizerStage1
+        with mock.patch.object(stage1, '_skip_node', autospec=True,
+                               side_effect=stage1._skip_node) as skip_node:
+            self.check_optimize('''
+                def g(x):
+                    return x * 2
+                def f(seq):
+                    y = g(3)
+                    z = len(seq)
+                    return y + 1
+            ''', '''
+                def g(x):
+                    return x * 2
+                def f(seq):
+                    y = 6
+                    z = len(seq)
+                    return 7
+            ''')
+        skipped = [ast.unparse(call[0][1]) for call in skip_node.call_args_list]
+        self.assertEqual(skipped, ['z = len(seq)'])
+
     def test_nested_function(self):
         self.check_optimize('''
             def f(x):
@@ -2899,10 +3359,8 @@ class InliningTests(BaseAstTests):
                 return 100 + 3
         ''')
 
-    # It shouldn't matter if the caller is defined before the callee,
-    # but currently it does
-    @unittest.expectedFailure
     def test_out_of_order(self):
+        # It doesn't matter if the caller is defined before the callee
         self.check_optimize('''
             def f(x):
                 return g(x) + 3
@@ -2915,6 +3373,84 @@ class InliningTests(BaseAstTests):
                 return 42
         ''')
 
+    def test_other_module(self):
+        # functions of a module must not be inlined in another module
+        self.optimize('''
+            def g(x):
+                return 42
+        ''')
+        self.check_dont_optimize('''
+            def f(x):
+                return g(x) + 3
+        ''')
+
+    def test_method(self):
+        # methods are not visible from other methods as plain names
+        self.check_dont_optimize('''
+            class MyClass:
+                def g(self):
+                    return 42
+                def f(self):
+                    return g(self) + 3
+        ''')
+
+    def test_local_variable(self):
+        # g is a local variable of f, not the module function
+        self.check_dont_optimize('''
+            def g(x):
+                return 42
+            def f(x, g):
+                return g(x) + 3
+        ''')
+
+    def test_fallback(self):
+        # the pure Python fallback is not the function called at runtime
+        self.check_dont_optimize('''
+            def f(x):
+                return g(x) + 3
+            try:
+                from _accel import g
+            except ImportError:
+                def g(x):
+                    return 42
+        ''')
+
+    def test_rebound(self):
+        self.check_dont_optimize('''
+            def g(x):
+                return 42
+            def f(x):
+                return g(x) + 3
+            def g(x):
+                return 0
+        ''')
+
+        self.check_dont_optimize('''
+            def g(x):
+                return 42
+            def f(x):
+                return g(x) + 3
+            g = lambda x: 0
+        ''')
+
+        self.check_dont_optimize('''
+            from _accel import *
+            def g(x):
+                return 42
+            def f(x):
+                return g(x) + 3
+        ''')
+
+        self.check_dont_optimize('''
+            def g(x):
+                return 42
+            def f(x):
+                return g(x) + 3
+            def patch():
+                global g
+                g = None
+        ''')
+
     def test_simple(self):
         self.check_optimize('''
             def g(x):
@@ -3146,7 +3682,1171 @@ class CompleteTests(BaseAstTests):
         ''')
 
 
+class BaseBudgetTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.constant_folding = True
+
+    def check_budget(self, source, expected, cutoffs):
+        tree = compile_ast(source)
+        optimizer = fatoptimizer.optimizer.ModuleOptimizer(self.config,
+                                                           "<string>")
+        tree = optimizer.optimize(tree)
+        self.assertAstEqual(tree, compile_ast(expected))
+        self.assertEqual(optimizer.cutoffs, cutoffs)
+
+
+class BudgetTests(BaseBudgetTests):
+    def test_module_nodes(self):
+        self.config.max_module_nodes = 10
+        self.check_budget('x = 1 + 2', 'x = 3', 0)
+        self.check_budget('x = 1 + 2; y = 3', 'x = 1 + 2; y = 3', 1)
+
+    def test_function_nodes(self):
+        self.config.max_function_nodes = 10
+        self.check_budget("""
+            def small():
+                return 1 + 2
+
+            def large(x):
+                return x + (1 + 2)
+        """, """
+            def small():
+                return 3
+
+            def large(x):
+                return x + (1 + 2)
+        """, 1)
+
+    def test_time(self):
+        self.config.max_function_time = 0.0
+        self.check_budget("""
+            x = 1 + 2
+
+            def func():
+                return 1 + 2
+        """, """
+            x = 3
+
+            def func():
+                return 1 + 2
+        """, 1)
+
+        self.config.max_function_time = None
+        self.config.max_module_time = 0.0
+        self.check_budget('x = 1 + 2', 'x = 1 + 2', 1)
+
+    def test_keep_optimized_nodes(self):
+        class Transformer(fatoptimizer.tools.NodeTransformer):
+            def visit_BinOp(self, node):
+                # the budget is exceeded after the first optimization
+                self.deadline_exceeded = True
+                return ast.Constant(value=node.left.value + node.right.value)
+
+        transformer = Transformer("<string>")
+        transformer._deadline = float('inf')
+        tree = transformer.visit(compile_ast('x = 1 + 2; y = 3 + 4'))
+        self.assertEqual(ast.unparse(tree), 'x = 3\ny = 3 + 4')
+
+    def test_min_module_nodes(self):
+        # Module, Assign, Name, Store, BinOp, Constant, Add, Constant
+        self.config.min_module_nodes = 8
+        self.check_budget('x = 1 + 2', 'x = 3', 0)
+        self.config.min_module_nodes = 9
+        tree = compile_ast('x = 1 + 2')
+        self.assertIs(fatoptimizer.optimize(tree, "<string>", self.config),
+                      tree)
+
+    def test_cache(self):
+        # partially optimized functions are not stored in the cache
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.config.function_cache = fatoptimizer.FunctionCache(tmpdir.name)
+        self.config.max_function_time = 0.0
+        self.optimize('def func(): return 1 + 2')
+        self.assertEqual(os.listdir(tmpdir.name), [])
+
+
+class SandboxTests(BaseBudgetTests):
+    def test_eval_ops(self):
+        self.config.max_eval_ops = 1000
+        self.check_budget('x = 1 << 10', 'x = 1024', 0)
+        self.check_budget('x = 1 << 100000', 'x = 1 << 100000', 1)
+        self.config.max_int_bits = 10 ** 6
+        self.check_budget('x = 3 ** 100000', 'x = 3 ** 100000', 1)
+
+        self.config.max_eval_ops = None
+        self.check_budget('x = 1 << 100', 'x = %s' % (1 << 100), 0)
+
+    def test_eval_ops_methods(self):
+        fatoptimizer.methods.add_pure_methods(self.config)
+        self.config.max_eval_ops = 1000
+        self.check_budget('x = "a".center(3)', 'x = " a "', 0)
+        self.check_budget('x = "a".center(1000000000)',
+                          'x = "a".center(1000000000)', 1)
+        self.check_budget('x = "\t".expandtabs(1000000)',
+                          'x = "\t".expandtabs(1000000)', 1)
+
+    def test_eval_time(self):
+        self.config.max_eval_time = 0.5
+        # each call to perf_counter() takes 1 second
+        with mock.patch('fatoptimizer.sandbox.time.perf_counter',
+                        side_effect=itertools.count()):
+            self.check_budget('x = 1 + 2', 'x = 1 + 2', 1)
+
+    def test_exceptions(self):
+        # [1, 2][::0] raises a ValueError
+        self.check_budget('x = [1, 2][::0]', 'x = [1, 2][::0]', 0)
+
+    def test_negative_cache(self):
+        calls = []
+        def func(arg):
+            calls.append(arg)
+            raise ValueError
+
+        sandbox = fatoptimizer.sandbox.Sandbox()
+        for attempt in range(2):
+            self.assertEqual(sandbox.call(self.config, func, (1,), ValueError),
+                             (UNSET, None))
+        self.assertEqual(calls, [1])
+
+        # the type of arguments is part of the key
+        sandbox.call(self.config, func, (1.0,), ValueError)
+        self.assertEqual(calls, [1, 1.0])
+
+        # calls exceeding the budget are not retried
+        self.config.max_eval_ops = 10
+        result, cutoff = sandbox.call(self.config, operator.lshift, (1, 1000))
+        self.assertIn('max_eval_ops', cutoff)
+        self.config.max_eval_ops = None
+        self.assertEqual(sandbox.call(self.config, operator.lshift, (1, 1000)),
+                         (UNSET, None))
+
+
+class ProfilerTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.constant_folding = True
+        self.profiler = fatoptimizer.Profiler()
+        self.config.profiler = self.profiler
+
+    def test_visitors(self):
+        self.check_optimize('x = 1 + 2', 'x = 3')
+
+        stats = self.profiler.as_dict()
+        self.assertEqual(stats['modules'], 1)
+        binop = stats['visitors']['ConstantFolding.visit_BinOp']
+        self.assertEqual(binop['calls'], 1)
+        self.assertEqual(binop['replacements'], 1)
+        self.assertGreaterEqual(binop['time'], binop['self_time'])
+
+        step = stats['steps']['ConstantFolding']
+        self.assertGreaterEqual(step['calls'], 1)
+        self.assertEqual(step['replacements'], 1)
+
+    def test_aggregate_modules(self):
+        self.optimize('x = 1 + 2')
+        self.optimize('y = 3 + 4')
+
+        stats = self.profiler.as_dict()
+        self.assertEqual(stats['modules'], 2)
+        binop = stats['visitors']['ConstantFolding.visit_BinOp']
+        self.assertEqual(binop['calls'], 2)
+        self.assertEqual(binop['replacements'], 2)
+
+    def test_json(self):
+        import json
+
+        self.optimize('x = 1 + 2')
+        stats = json.loads(self.profiler.to_json())
+        self.assertEqual(stats, self.profiler.as_dict())
+
+        self.profiler.reset()
+        self.assertEqual(self.profiler.as_dict()['visitors'], {})
+
+    def test_threads(self):
+        def inner(optimizer, node):
+            pass
+
+        def outer(optimizer, node):
+            # visitor called by another thread is not a nested call
+            thread = threading.Thread(target=self.profiler.call_visitor,
+                                      args=(inner, None, node))
+            thread.start()
+            thread.join()
+
+        self.profiler.call_visitor(outer, None, None)
+        stats = self.profiler.as_dict()['visitors']
+        outer_stats = stats[outer.__qualname__]
+        self.assertEqual(outer_stats['self_time'], outer_stats['time'])
+        self.assertEqual(stats[inner.__qualname__]['calls'], 1)
+
+
+class FunctionCacheTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.copy_builtin_to_constant = True
+        self.config._copy_builtin_to_constant.add('len')
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def optimize_cached(self, source):
+        cache = fatoptimizer.FunctionCache(self.directory)
+        self.config.function_cache = cache
+        try:
+            tree = self.optimize(source)
+        finally:
+            self.config.function_cache = None
+        return cache, ast.dump(tree, include_attributes=True)
+
+    def check_cache(self, source, hits):
+        expected = ast.dump(self.optimize(source), include_attributes=True)
+        cache, result = self.optimize_cached(source)
+        self.assertEqual(cache.hits, hits)
+        self.assertEqual(result, expected)
+
+    def test_reuse(self):
+        source = """
+            def func(obj):
+                return len(obj)
+        """
+        self.check_cache(source, 0)
+        self.check_cache(source, 1)
+
+        # function moved in the file
+        self.check_cache("""
+            x = 1
+
+            def func(obj):
+                return len(obj)
+        """, 1)
+
+    def test_enclosing_scope(self):
+        self.check_cache("""
+            def func(obj):
+                return len(obj)
+        """, 0)
+
+        # len is no more a builtin function
+        self.check_cache("""
+            def len(obj):
+                return 0
+
+            def func(obj):
+                return len(obj)
+        """, 0)
+
+        # the name of the constant depends on the parent namespace
+        self.check_cache("""
+            x = 'LOAD_GLOBAL len'
+
+            def func(obj):
+                return len(obj)
+        """, 0)
+
+    def test_config(self):
+        source = """
+            def func(obj):
+                return len(obj)
+        """
+        self.check_cache(source, 0)
+
+        self.config.copy_builtin_to_constant = False
+        self.check_cache(source, 0)
+
+    def test_specialization_table(self):
+        self.config.specialization_table = True
+        source = """
+            def func(obj):
+                return len(obj)
+        """
+        self.check_cache(source, 0)
+        self.check_cache(source, 1)
+
+        # methods are not specialized by the table
+        self.check_cache("""
+            class A:
+                def func(obj):
+                    return len(obj)
+        """, 0)
+
+    def test_prune(self):
+        source = """
+            def func(obj):
+                return len(obj)
+        """
+        self.optimize_cached(source)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        cache = fatoptimizer.FunctionCache(self.directory, max_size=0)
+        cache.prune()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class CostTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.enable_all()
+        self.config.min_specialize_gain = 0
+
+    def estimate_cost(self, source, local_variables=()):
+        tree = compile_ast(source)
+        return fatoptimizer.cost.estimate_cost(tree.body, local_variables)
+
+    def count_specialized(self, source):
+        tree = compile_ast(source)
+        optimizer = fatoptimizer.optimizer.ModuleOptimizer(self.config,
+                                                           "<string>")
+        optimizer.optimize(tree)
+        return optimizer.specialized
+
+    def test_estimate_cost(self):
+        cost = self.estimate_cost("len(x)")
+        self.assertEqual(self.estimate_cost("len(x)", {'x'}),
+                         cost - fatoptimizer.cost.GLOBAL_NAME_COST
+                         + fatoptimizer.cost.LOCAL_NAME_COST)
+
+        # loop bodies are weighted by the number of iterations
+        loop = self.estimate_cost("for i in range(8): len(x)")
+        self.assertGreater(loop, cost * 8)
+        self.assertGreater(self.estimate_cost("for i in range(80): len(x)"),
+                           loop * 9)
+        self.assertGreater(self.estimate_cost("[len(x) for i in (1, 2, 3)]"),
+                           cost * 3)
+
+        # the body of nested functions is not executed
+        self.assertLess(self.estimate_cost("def f(): len(x)"), cost)
+
+    def test_get_iterations(self):
+        def get_iterations(source):
+            node = compile_ast_expr(source)
+            return fatoptimizer.cost.get_iterations(node)
+
+        self.assertEqual(get_iterations("range(3)"), 3)
+        self.assertEqual(get_iterations("range(0, 10, 2)"), 5)
+        self.assertEqual(get_iterations("'abcd'"), 4)
+        self.assertEqual(get_iterations("[x, y]"), 2)
+        self.assertEqual(get_iterations("seq"),
+                         fatoptimizer.cost.DEFAULT_ITERATIONS)
+
+    def test_specialize(self):
+        # the gain of a loop is worth the guards
+        self.assertEqual(self.count_specialized("""
+            def func(seq):
+                total = 0
+                for i in range(8):
+                    total += len(seq) * i
+                return total
+        """), 1)
+
+        # a single LOAD_GLOBAL on a cold path is not
+        source = """
+            def func(x):
+                if x:
+                    return x
+                return len(x)
+        """
+        self.assertEqual(self.count_specialized(source), 0)
+
+        # guards of the pure-Python runtime are more expensive
+        self.assertEqual(self.count_specialized("""
+            def func():
+                return len('abc')
+        """), 1)
+        self.config.guard_cost = (60.0, 5.0)
+        self.assertEqual(self.count_specialized("""
+            def func():
+                return len('abc')
+        """), 0)
+
+        self.config.min_specialize_gain = None
+        self.assertEqual(self.count_specialized(source), 1)
+
+    def test_calibrate(self):
+        cost, name_cost = fatoptimizer.cost.calibrate(number=100, repeat=1)
+        self.assertGreaterEqual(cost, 0.0)
+        self.assertGreaterEqual(name_cost, 0.0)
+
+
+class SpecializationTableTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        from fatoptimizer.builtins import add_pure_builtins
+        add_pure_builtins(self.config)
+        self.config.specialization_table = True
+
+    def test_table(self):
+        self.check_optimize("""
+            def func(x=1):
+                return len('abc') + x
+
+            def func2():
+                return chr(65)
+
+            class A:
+                def meth(self):
+                    return len('ab')
+
+            func()
+        """, """
+            try:
+                import fat as __fat__
+            except ImportError:
+                import fatoptimizer.runtime as __fat__
+            import fatoptimizer.runtime as __fat_runtime__
+
+            def func(x=1):
+                return len('abc') + x
+
+            def func2():
+                return chr(65)
+
+            def __fat_table__():
+                class ___:
+                    def func(x):
+                        return 3 + x
+
+                    def func2():
+                        return 'A'
+
+            __fat_runtime__.specialize_table(__fat__, __fat_table__,
+                                             (((('len',),), ()),
+                                              ((('chr',),), ())))
+            del __fat_table__
+
+            class A:
+                def meth(self):
+                    return len('ab')
+
+                _ast_optimized = meth
+
+                def meth(self):
+                    return 2
+
+                __fat__.specialize(_ast_optimized, meth.__code__,
+                                   [__fat__.GuardBuiltins('len')])
+                meth = _ast_optimized
+                del _ast_optimized
+
+            func()
+        """)
+
+    def test_runtime_name(self):
+        # the name of the runtime module doesn't override a variable
+        self.check_optimize("""
+            __fat_runtime__ = 1
+
+            def func():
+                return len('abc')
+        """, """
+            try:
+                import fat as __fat__
+            except ImportError:
+                import fatoptimizer.runtime as __fat__
+            import fatoptimizer.runtime as __fat_runtime__2
+            __fat_runtime__ = 1
+
+            def func():
+                return len('abc')
+
+            def __fat_table__():
+                class ___:
+                    def func():
+                        return 3
+
+            __fat_runtime__2.specialize_table(__fat__, __fat_table__,
+                                              (((('len',),), ()),))
+            del __fat_table__
+        """)
+
+    def test_runtime(self):
+        self.config.copy_builtin_to_constant = True
+        self.config._copy_builtin_to_constant = {'len'}
+        tree = self.optimize("""
+            import sys
+
+            def func(seq):
+                return len(seq) + len('abc')
+
+            if sys:
+                def func2():
+                    return len('a')
+            else:
+                def func2():
+                    return len('ab')
+
+            def func3():
+                return len('abc')
+
+            def func3():
+                return 'replaced'
+        """)
+        fatoptimizer.precompile.fix_locations(tree)
+        with warnings.catch_warnings():
+            # calls to constants replaced by replace_consts()
+            warnings.simplefilter('ignore', SyntaxWarning)
+            code = compile(tree, '<string>', 'exec')
+
+        ns = {}
+        with mock.patch.dict(sys.modules, {'fat': None}):
+            exec(code, ns, ns)
+        self.assertNotIn('__fat_table__', ns)
+        get_specialized = fatoptimizer.runtime.get_specialized
+        func = ns['func']
+        self.assertEqual(len(get_specialized(func)), 1)
+        self.assertEqual(func('ab'), 5)
+        # only the specialization of the defined func2() is used
+        func2 = ns['func2']
+        self.assertEqual(len(get_specialized(func2)), 1)
+        self.assertEqual(func2(), 1)
+        # func3() was replaced after its definition
+        self.assertEqual(get_specialized(ns['func3']), [])
+        self.assertEqual(ns['func3'](), 'replaced')
+
+
+class TreeCacheTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.constant_folding = True
+        self.transformer = fatoptimizer.FATOptimizer(self.config, 2)
+        self.cache = self.transformer.tree_cache
+
+    def transform(self, source, filename='<string>'):
+        context = types.SimpleNamespace(filename=filename)
+        tree = self.transformer.ast_transformer(compile_ast(source), context)
+        return ast.unparse(tree)
+
+    def test_reuse(self):
+        self.assertEqual(self.transform('x = 1 + 2'), 'x = 3')
+        self.assertEqual(self.transform('x = 1 + 2'), 'x = 3')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # trees loaded from the cache are new trees
+        context = types.SimpleNamespace(filename='<string>')
+        tree1 = self.transformer.ast_transformer(compile_ast('x = 1 + 2'),
+                                                 context)
+        tree2 = self.transformer.ast_transformer(compile_ast('x = 1 + 2'),
+                                                 context)
+        self.assertIsNot(tree1.body[0], tree2.body[0])
+
+    def test_key(self):
+        self.transform('x = 1 + 2')
+        # positions and filename are part of the key
+        self.transform('x  = 1 + 2')
+        self.transform('x = 1 + 2', '<template>')
+        self.assertEqual(self.cache.hits, 0)
+
+        # the configuration is part of the key
+        self.config.constant_folding = False
+        self.assertEqual(self.transform('x = 1 + 2', '<template>'),
+                         'x = 1 + 2')
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_lru(self):
+        self.transform('x = 1')
+        self.transform('x = 2')
+        self.transform('x = 1')
+        self.transform('x = 3')
+        self.assertEqual(len(self.cache), 2)
+        self.transform('x = 1')
+        self.assertEqual(self.cache.hits, 2)
+        self.transform('x = 2')
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_module(self):
+        # modules are not cached
+        self.assertEqual(self.transform('x = 1 + 2', 'mod.py'), 'x = 3')
+        self.assertEqual(self.cache.stores, 0)
+
+    def test_min_module_nodes(self):
+        self.config.min_module_nodes = 9
+        self.assertEqual(self.transform('x = 1 + 2'), 'x = 1 + 2')
+        self.assertEqual(self.cache.misses, 0)
+
+
+class ThreadTests(BaseAstTests):
+    def setUp(self):
+        super().setUp()
+        self.config.enable_all()
+        # use a short switch interval to run threads in parallel
+        old_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, old_interval)
+
+    def test_parallel_modules(self):
+        sources = ["""
+            __fatoptimizer__ = {'unroll_loops': %s}
+
+            def func%s(obj):
+                for i in (1, 2):
+                    obj.append(len("abc") + i)
+        """ % (index % 3, index) for index in range(16)]
+        expected = [ast.dump(self.optimize(source)) for source in sources]
+        fingerprint = self.config.fingerprint()
+
+        self.config.profiler = fatoptimizer.Profiler()
+        self.config.logger = io.StringIO()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.config.function_cache = fatoptimizer.FunctionCache(tmpdir.name)
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            trees = list(executor.map(self.optimize, sources * 2))
+        self.assertEqual([ast.dump(tree) for tree in trees], expected * 2)
+
+        # the shared configuration was not modified
+        self.assertEqual(self.config.fingerprint(), fingerprint)
+
+        stats = self.config.profiler.as_dict()
+        self.assertEqual(stats['modules'], 32)
+        for visitor_stats in stats['visitors'].values():
+            self.assertGreaterEqual(visitor_stats['self_time'], -1e-9)
+        cache = self.config.function_cache
+        self.assertEqual(cache.hits + cache.misses, 32)
+        for line in self.config.logger.getvalue().splitlines():
+            self.assertRegex(line, r'^(<string>:[0-9]+: fatoptimizer: |  )')
+
+
+class PrecompileTests(unittest.TestCase):
+    def setUp(self):
+        self.config = fatoptimizer.Config()
+        self.config.enable_all()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def write_module(self, name, source):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fp:
+            fp.write(textwrap.dedent(source))
+        return filename
+
+    def load_code(self, filename):
+        tag = fatoptimizer.precompile.get_optim_tag(self.config)
+        bytecode_filename = fatoptimizer.precompile.get_bytecode_filename(
+            filename, tag)
+        with open(bytecode_filename, 'rb') as fp:
+            return marshal.loads(fp.read()[16:])
+
+    def test_compile_file(self):
+        filename = self.write_module('mod.py', """
+            x = 1 + 2
+            def func():
+                return len("abc")
+        """)
+        result = fatoptimizer.precompile.compile_file(filename, self.config)
+        self.assertIsNone(result.error)
+        self.assertFalse(result.skipped)
+        self.assertEqual(result.specialized, 1)
+
+        code = self.load_code(filename)
+        self.assertIn(3, code.co_consts)
+        self.assertIn('__fat__', code.co_names)
+
+        # the bytecode file is up to date
+        result = fatoptimizer.precompile.compile_file(filename, self.config)
+        self.assertTrue(result.skipped)
+
+        result = fatoptimizer.precompile.compile_file(filename, self.config,
+                                                      force=True)
+        self.assertFalse(result.skipped)
+
+    def test_compile_files(self):
+        self.write_module('mod.py', "x = 1 + 2")
+        self.write_module('invalid.py', "def func(:")
+        filenames = list(fatoptimizer.precompile.find_sources([self.directory]))
+
+        results = fatoptimizer.precompile.compile_files(filenames, self.config,
+                                                        workers=2)
+        errors = {os.path.basename(result.filename): result.error
+                  for result in results}
+        self.assertIsNone(errors['mod.py'])
+        self.assertRegex(errors['invalid.py'], '^SyntaxError: ')
+
+        code = self.load_code(os.path.join(self.directory, 'mod.py'))
+        ns = {}
+        exec(code, ns, ns)
+        self.assertEqual(ns['x'], 3)
+
+
+class ImporterTests(unittest.TestCase):
+    def setUp(self):
+        self.config = fatoptimizer.Config()
+        self.config.enable_all()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.addCleanup(fatoptimizer.importer.uninstall)
+        sys.path.insert(0, self.directory)
+        self.addCleanup(sys.path.remove, self.directory)
+
+    def write_module(self, name, source):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fp:
+            fp.write(textwrap.dedent(source))
+        return filename
+
+    def import_module(self, name):
+        importlib.invalidate_caches()
+        sys.modules.pop(name, None)
+        self.addCleanup(sys.modules.pop, name, None)
+        return importlib.import_module(name)
+
+    def test_import(self):
+        filename = self.write_module('fatmod.py', """
+            def func():
+                return 'abc'.upper()
+        """)
+        fatoptimizer.importer.install(self.config, paths=[self.directory])
+
+        with mock.patch.object(sys, 'dont_write_bytecode', False):
+            mod = self.import_module('fatmod')
+        self.assertIn('ABC', mod.func.__code__.co_consts)
+        self.assertIsInstance(mod.__loader__, fatoptimizer.importer.FATLoader)
+        tag = fatoptimizer.importer.get_optim_tag(self.config)
+        bytecode_filename = fatoptimizer.precompile.get_bytecode_filename(
+            filename, tag)
+        self.assertEqual(mod.__cached__, bytecode_filename)
+        self.assertTrue(os.path.exists(bytecode_filename))
+
+        # the bytecode file is reused
+        with mock.patch.object(fatoptimizer.importer.FATLoader,
+                               'source_to_code') as source_to_code:
+            mod = self.import_module('fatmod')
+        self.assertFalse(source_to_code.called)
+        self.assertIn('ABC', mod.func.__code__.co_consts)
+
+    def test_precompiled(self):
+        # the import hook loads bytecode files written by compile_file()
+        filename = self.write_module('fatmod.py', """
+            def func():
+                return 'abc'.upper()
+        """)
+        result = fatoptimizer.precompile.compile_file(filename, self.config)
+        self.assertIsNone(result.error)
+        fatoptimizer.importer.install(self.config, paths=[self.directory])
+
+        with mock.patch.object(fatoptimizer.importer.FATLoader,
+                               'source_to_code') as source_to_code:
+            mod = self.import_module('fatmod')
+        self.assertFalse(source_to_code.called)
+        self.assertIn('ABC', mod.func.__code__.co_consts)
+
+    def test_paths(self):
+        self.write_module('fatmod.py', "x = 1")
+        fatoptimizer.importer.install(self.config,
+                                      paths=[os.path.dirname(__file__)])
+        mod = self.import_module('fatmod')
+        self.assertNotIsInstance(mod.__loader__,
+                                 fatoptimizer.importer.FATLoader)
+
+    def test_optim_tag(self):
+        tag = fatoptimizer.importer.get_optim_tag(self.config)
+        self.assertTrue(tag.isalnum(), tag)
+        self.assertTrue(tag.startswith('fat'), tag)
+
+        # optimized bytecode files depend on the configuration
+        self.config.constant_folding = False
+        self.assertNotEqual(fatoptimizer.importer.get_optim_tag(self.config),
+                            tag)
+
+
+class RuntimeTests(unittest.TestCase):
+    def create_funcs(self, source):
+        # use a copy of builtins to be able to modify them
+        self.builtins = dict(builtins.__dict__)
+        ns = {'__builtins__': self.builtins}
+        exec(textwrap.dedent(source), ns, ns)
+        return ns
+
+    def specialize(self, func, code, *names):
+        guards = [fatoptimizer.runtime.GuardBuiltins(*names)]
+        fatoptimizer.runtime.specialize(func, code, guards)
+
+    def test_replace_consts(self):
+        def func():
+            return 'LOAD_GLOBAL len'
+        code = fatoptimizer.runtime.replace_consts(func.__code__,
+                                                   {'LOAD_GLOBAL len': len})
+        self.assertIn(len, code.co_consts)
+
+    def test_specialize(self):
+        ns = self.create_funcs("""
+            def func(x, *args, y=2, **kw):
+                return (len('abc'), x, args, y, kw)
+
+            def fast(x, *args, y=2, **kw):
+                return (3, x, args, y, kw, 'fast')
+        """)
+        func = ns['func']
+        self.specialize(func, ns['fast'].__code__, 'len')
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(func)), 1)
+        self.assertEqual(func(1, 2, y=3, z=4),
+                         (3, 1, (2,), 3, {'z': 4}, 'fast'))
+        self.assertEqual(func(1), (3, 1, (), 2, {}, 'fast'))
+
+        # a global variable shadows the builtin: the specialization is
+        # removed
+        ns['len'] = lambda obj: 5
+        self.assertEqual(func(1), (5, 1, (), 2, {}))
+        self.assertEqual(fatoptimizer.runtime.get_specialized(func), [])
+        del ns['len']
+        self.assertEqual(func(1), (3, 1, (), 2, {}))
+
+    def test_replaced_builtin(self):
+        ns = self.create_funcs("""
+            def func():
+                return len('abc')
+
+            def fast():
+                return 'fast'
+        """)
+        func = ns['func']
+        self.specialize(func, ns['fast'].__code__, 'len')
+        self.assertEqual(func(), 'fast')
+        self.builtins['len'] = lambda obj: 5
+        self.assertEqual(func(), 5)
+
+        # a guard already fails
+        ns = self.create_funcs("""
+            def func():
+                return len('abc')
+        """)
+        self.builtins['len'] = lambda obj: 5
+        self.specialize(ns['func'], ns['func'].__code__, 'len')
+        self.assertEqual(fatoptimizer.runtime.get_specialized(ns['func']), [])
+
+    def test_unsupported(self):
+        ns = self.create_funcs("""
+            def gen():
+                yield len('abc')
+
+            def shadow(len):
+                return len
+
+            def fast():
+                return 'fast'
+        """)
+        for name in ('gen', 'shadow'):
+            func = ns[name]
+            self.specialize(func, ns['fast'].__code__, 'len')
+            self.assertEqual(fatoptimizer.runtime.get_specialized(func), [])
+
+    def test_optimized_code(self):
+        config = fatoptimizer.Config()
+        config.enable_all()
+        tree = compile_ast("""
+            def func(seq):
+                total = 0
+                for i in range(3):
+                    total += len(seq) * i
+                return total
+        """)
+        tree = fatoptimizer.optimize(tree, '<string>', config)
+        fatoptimizer.precompile.fix_locations(tree)
+        with warnings.catch_warnings():
+            # calls to constants replaced by replace_consts()
+            warnings.simplefilter('ignore', SyntaxWarning)
+            code = compile(tree, '<string>', 'exec')
+
+        # the pure-Python runtime is used if the fat module is missing
+        ns = {}
+        with mock.patch.dict(sys.modules, {'fat': None}):
+            exec(code, ns, ns)
+        self.assertIs(ns['__fat__'], fatoptimizer.runtime)
+        func = ns['func']
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(func)), 1)
+        self.assertEqual(func('ab'), 6)
+
+
+class LazyTests(unittest.TestCase):
+    def setUp(self):
+        self.config = fatoptimizer.Config()
+        self.config.enable_all()
+        self.config.lazy_specialization = 1
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, 'lazymod.py')
+        self.addCleanup(linecache.checkcache)
+
+    def exec_module(self, source):
+        source = textwrap.dedent(source)
+        with open(self.filename, 'w') as fp:
+            fp.write(source)
+        tree = ast.parse(source, self.filename)
+        tree = fatoptimizer.optimize(tree, self.filename, self.config)
+        fatoptimizer.precompile.fix_locations(tree)
+        code = compile(tree, self.filename, 'exec')
+        ns = {'__name__': 'lazymod', '__file__': self.filename}
+        exec(code, ns, ns)
+        return ns
+
+    def test_lazy(self):
+        ns = self.exec_module("""
+            def func(x, *, y=2):
+                return len("abc") + x + y
+
+            class Class:
+                def method(self):
+                    return len("abc")
+        """)
+        # methods are optimized when the module is compiled
+        method = ns['Class'].method
+        self.assertFalse(fatoptimizer.lazy.is_lazy(method))
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(method)), 1)
+
+        func = ns['func']
+        self.assertTrue(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(fatoptimizer.runtime.get_specialized(func), [])
+        with mock.patch.dict(sys.modules, {'fat': None}):
+            self.assertEqual(func(1, y=3), 7)
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(func)), 1)
+        self.assertEqual(func(1), 6)
+
+    def test_ncalls(self):
+        self.config.lazy_specialization = 3
+        ns = self.exec_module("""
+            def func():
+                return len("abc")
+        """)
+        func = ns['func']
+        for ncalls in range(2):
+            self.assertEqual(func(), 3)
+            self.assertTrue(fatoptimizer.lazy.is_lazy(func))
+        with mock.patch.dict(sys.modules, {'fat': None}):
+            self.assertEqual(func(), 3)
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(func)), 1)
+
+    def test_config(self):
+        self.config.disable_all()
+        self.config.lazy_specialization = 1
+        ns = self.exec_module("""
+            def func():
+                return len("abc")
+        """)
+        self.assertTrue(fatoptimizer.lazy.is_lazy(ns['func']))
+
+        # the function is optimized with the configuration used to compile
+        # the module
+        self.config.enable_all()
+        func = ns['func']
+        with mock.patch.dict(sys.modules, {'fat': None}):
+            self.assertEqual(func(), 3)
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(fatoptimizer.runtime.get_specialized(func), [])
+
+        # unknown configuration
+        def func2():
+            return len("abc")
+        fatoptimizer.lazy.lazy(func2, 1, 0, 'fingerprint')
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func2))
+
+    def test_module_name(self):
+        ns = self.exec_module("""
+            __fat_lazy__ = 'module'
+
+            def func():
+                return len("abc")
+        """)
+        self.assertEqual(ns['__fat_lazy__'], 'module')
+        self.assertTrue(fatoptimizer.lazy.is_lazy(ns['func']))
+
+    def test_generator(self):
+        # the trampoline cannot replace the code of a generator
+        ns = self.exec_module("""
+            def gen():
+                yield len("abc")
+        """)
+        gen = ns['gen']
+        self.assertFalse(fatoptimizer.lazy.is_lazy(gen))
+        self.assertTrue(gen.__code__.co_flags
+                        & fatoptimizer.runtime._GENERATOR_FLAGS)
+        self.assertEqual(list(gen()), [3])
+
+    def test_modified_source(self):
+        ns = self.exec_module("""
+            def func():
+                return len("abc")
+        """)
+        with open(self.filename, 'w') as fp:
+            fp.write('def func():\n    return len("abcd")\n')
+        linecache.checkcache(self.filename)
+
+        # the function is not optimized using the new source
+        func = ns['func']
+        self.assertEqual(func(), 3)
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(fatoptimizer.runtime.get_specialized(func), [])
+
+    def test_background(self):
+        self.config.background_specialization = 1
+        with mock.patch.object(fatoptimizer.lazy, 'BACKGROUND_DELAY', 0.0):
+            with mock.patch.dict(sys.modules, {'fat': None}):
+                ns = self.exec_module("""
+                    def func(x):
+                        return len("abc") + x
+                """)
+                func = ns['func']
+                # the function runs its original code until it is optimized
+                self.assertEqual(func(1), 4)
+                fatoptimizer.lazy.join()
+
+        self.assertFalse(fatoptimizer.lazy.is_lazy(func))
+        self.assertEqual(len(fatoptimizer.runtime.get_specialized(func)), 1)
+        self.assertEqual(func(1), 4)
+
+
+class FoldSettings(fatoptimizer.OptimizerStep):
+    # optimizer step used by PluginTests
+    config_option = 'fold_settings'
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            return
+        try:
+            value = self.config.settings[node.id]
+        except KeyError:
+            return
+        return self.new_constant(node, value)
+
+
+class PluginTests(BaseAstTests):
+    def register(self, step=FoldSettings, stage=fatoptimizer.STAGE1, **kw):
+        kw.setdefault('options', {'fold_settings': True, 'settings': {}})
+        fatoptimizer.register_step(step, stage, **kw)
+        self.addCleanup(fatoptimizer.unregister_step, step)
+
+    def test_stage1(self):
+        self.register(before=['ConstantFolding'])
+        self.config.constant_folding = True
+        self.config.settings = {'LEVEL': 3}
+
+        self.check_optimize("""
+            x = LEVEL * 2
+            def func():
+                return LEVEL + y
+        """, """
+            x = 6
+            def func():
+                return 3 + y
+        """)
+
+        # the step is skipped if its option is false
+        self.config.fold_settings = False
+        self.check_optimize("x = LEVEL", "x = LEVEL")
+
+        # options can be set by __fatoptimizer__
+        self.config.fold_settings = True
+        self.check_optimize("""
+            __fatoptimizer__ = {'fold_settings': False}
+            x = LEVEL
+        """, """
+            __fatoptimizer__ = {'fold_settings': False}
+            x = LEVEL
+        """)
+
+    def test_specialize(self):
+        self.register(stage=fatoptimizer.SPECIALIZE)
+        self.config.settings = {'LEVEL': 3}
+
+        # the step only optimizes functions
+        self.check_optimize("""
+            x = LEVEL
+            def func():
+                return LEVEL
+        """, """
+            x = LEVEL
+            def func():
+                return 3
+        """)
+
+    def test_order(self):
+        self.register(before=['ConstantFolding'], after=['SimplifyIterable'])
+        Optimizer = fatoptimizer.plugin.compose_optimizer(
+            fatoptimizer.optimizer.ModuleOptimizer)
+        self.assertTrue(issubclass(Optimizer,
+                                   fatoptimizer.optimizer.ModuleOptimizer))
+        steps = [step.__name__ for step in Optimizer._steps]
+        self.assertEqual(steps[-4:], ['BaseSimplifyIterable', 'FoldSettings',
+                                      'ConstantFolding', 'RemoveDeadCode'])
+        self.assertIs(fatoptimizer.plugin.compose_optimizer(
+                          fatoptimizer.optimizer.ModuleOptimizer),
+                      Optimizer)
+
+        # steps without constraint run after built-in steps
+        fatoptimizer.unregister_step(FoldSettings)
+        fatoptimizer.register_step(FoldSettings,
+                                   options={'fold_settings': True})
+        Optimizer = fatoptimizer.plugin.compose_optimizer(
+            fatoptimizer.optimizer.ModuleOptimizer)
+        self.assertEqual(Optimizer._steps[-1], FoldSettings)
+
+    def test_config(self):
+        config = fatoptimizer.Config()
+        fingerprint = config.fingerprint()
+        with self.assertRaises(AttributeError):
+            config.fold_settings
+
+        self.register()
+        self.assertEqual(config.fold_settings, True)
+        self.assertNotEqual(config.fingerprint(), fingerprint)
+        config.disable_all()
+        self.assertEqual(config.fold_settings, False)
+        config.enable_all()
+        self.assertEqual(config.fold_settings, True)
+        config = config.replace({'settings': {'LEVEL': 1}})
+        self.assertEqual(config.settings, {'LEVEL': 1})
+
+    def test_errors(self):
+        class NotStep:
+            pass
+
+        with self.assertRaises(TypeError):
+            fatoptimizer.register_step(NotStep)
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings, 'stage3')
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings, before=['Unknown'],
+                                       options={'fold_settings': True})
+        # unknown config option of the step
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings)
+        # existing option
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings,
+                                       options={'fold_settings': True,
+                                                'unroll_loops': 0})
+        # inconsistent order
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings,
+                                       before=['NamespaceStep'],
+                                       after=['ConstantFolding'],
+                                       options={'fold_settings': True})
+        with self.assertRaises(ValueError):
+            fatoptimizer.unregister_step(FoldSettings)
+
+        self.register()
+        with self.assertRaises(ValueError):
+            fatoptimizer.register_step(FoldSettings)
+
+
 class MiscTests(unittest.TestCase):
+    def test_lazy_import(self):
+        # optimizer steps are not imported by 'import fatoptimizer'
+        code = ("import fatoptimizer, sys; "
+                "print(sorted(name for name in sys.modules "
+                "if name.startswith('fatoptimizer.')))")
+        proc = subprocess.run([sys.executable, '-c', code],
+                              stdout=subprocess.PIPE,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              universal_newlines=True, check=True)
+        modules = eval(proc.stdout)
+        self.assertNotIn('fatoptimizer.optimizer', modules)
+        self.assertNotIn('fatoptimizer.builtins', modules)
+
     def test_version(self):
         import setup
         self.assertEqual(fatoptimizer.__version__, setup.VERSION)